@@ -1,16 +1,189 @@
 import argparse
+import datetime
+import itertools
+import os
+import pathlib
 import re
+import sys
+import tempfile
 
-from qfunnel.format import format_box_table, format_date
-from qfunnel.program import Program, JobFilter
-from qfunnel.real_backend import RealBackend
+from qfunnel.format import (
+    format_box_table,
+    format_date,
+    format_duration,
+    format_json_array,
+    format_json_lines,
+    format_memory,
+    format_tsv
+)
+from qfunnel.config import load_config
+from qfunnel.program import WAIT_INTERVAL, Program, JobFilter, paginate
+from qfunnel.rate_limit import TokenBucketRateLimiter, get_buckets
+from qfunnel.local_backend import LocalBackend
+from qfunnel.real_backend import DB_DIR, DB_FILE, RATE_LIMIT_DB_FILE, RealBackend
+from qfunnel.replay_backend import RecordingBackend, ReplayBackend
+from qfunnel.schedule import format_window, parse_window
+from qfunnel.simulate import DEFAULT_RUNTIME, SimulatedQueue, SimulationConfig, simulate
+from qfunnel.slurm_backend import SlurmBackend
+from qfunnel.sweep import parse_axis, parse_values
+from qfunnel.store import SNAPSHOT_INTERVAL, LocalSnapshotStore
 
 def print_limit_table(limits):
-    head = ['Queue', 'Limit']
-    rows = [(queue, str(limit)) for queue, limit in limits]
+    head = ['Queue', 'Limit', 'Pending', 'Next change']
+    rows = [
+        (
+            limit.queue,
+            format_limit_value(limit),
+            format_pending(limit.pending),
+            format_limit_change(limit.next_change)
+        )
+        for limit in limits
+    ]
     for line in format_box_table(head, rows):
         print(line)
 
+def print_limit_schedule_table(schedules):
+    head = ['ID', 'Queue', 'When', 'Limit', 'Pending']
+    rows = [
+        (
+            str(schedule.id),
+            schedule.queue,
+            format_window(schedule.days, schedule.start, schedule.end),
+            str(schedule.value),
+            format_pending(schedule.pending)
+        )
+        for schedule in schedules
+    ]
+    for line in format_box_table(head, rows):
+        print(line)
+
+def format_limit_value(limit):
+    if limit.floor is not None:
+        return f'{limit.value} (adaptive, {limit.floor}-{limit.ceiling})'
+    else:
+        return str(limit.value)
+
+def format_pending(pending):
+    return f'+{pending}' if pending is not None else ''
+
+def format_limit_change(change):
+    if change is None:
+        return ''
+    value = str(change.value)
+    if change.pending is not None:
+        value += f' {format_pending(change.pending)}'
+    return f'{value} at {format_date(change.time)}'
+
+def print_status(info):
+    if info.snapshot_time is not None:
+        print(f'Last check: {format_date(info.snapshot_time)}')
+    else:
+        print('Last check: never')
+    if info.leader is not None:
+        expired = ' (expired)' if info.leader.expires_at <= info.time else ''
+        print(
+            f'Leader: {info.leader.holder}, last seen '
+            f'{format_date(info.leader.heartbeat)}{expired}'
+        )
+    else:
+        print('Leader: none')
+    head = [
+        'Queue', 'Limit', 'Buffered', 'Queued', 'Running', 'Dispatched/h',
+        'Completed/h', 'Mean run', 'ETA'
+    ]
+    rows = [
+        format_status_row(status.queue, status)
+        for status in info.queues
+    ]
+    rows.append(format_status_row('(total)', info.total))
+    for line in format_box_table(head, rows):
+        print(line)
+
+def format_status_row(name, status):
+    return (
+        name,
+        str(status.limit) if status.limit is not None else '',
+        str(status.buffered),
+        str(status.pending),
+        str(status.running),
+        f'{status.dispatched_per_hour:.1f}',
+        f'{status.completed_per_hour:.1f}',
+        format_duration(status.mean_runtime) if status.mean_runtime is not None else '',
+        format_duration(status.eta.total_seconds()) if status.eta is not None else '?'
+    )
+
+def print_runtime_stats_table(stats):
+    head = ['Pattern', 'Queue', 'Jobs', 'Failed', 'Mean run', 'Max run', 'Max memory']
+    rows = [
+        (
+            s.pattern,
+            s.queue or '',
+            str(s.count),
+            str(s.failures),
+            format_duration(s.mean_runtime) if s.mean_runtime is not None else '',
+            format_duration(s.max_runtime) if s.max_runtime is not None else '',
+            format_memory(s.max_memory) if s.max_memory is not None else ''
+        )
+        for s in stats
+    ]
+    for line in format_box_table(head, rows):
+        print(line)
+
+def parse_axis_arg(s):
+    try:
+        return parse_axis(s)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def parse_queue_values_arg(s):
+    queue, sep, values_str = s.rpartition('=')
+    if not sep or not queue:
+        raise argparse.ArgumentTypeError(f'expected QUEUE=VALUES: {s!r}')
+    try:
+        values = [int(value) for value in parse_values(values_str)]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid values: {values_str!r}')
+    if any(value < 0 for value in values):
+        raise argparse.ArgumentTypeError('values must not be negative')
+    return queue, values
+
+def parse_intervals_arg(s):
+    try:
+        values = [float(value) for value in s.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid intervals: {s!r}')
+    if any(value <= 0 for value in values):
+        raise argparse.ArgumentTypeError('intervals must be positive')
+    return values
+
+def print_simulation_table(limit_queues, results):
+    percentiles = list(results[0].wait_percentiles) if results else []
+    head = [
+        *limit_queues, 'Interval', 'Makespan', 'Utilization',
+        *(f'Wait p{p}' for p in percentiles), 'Unfinished'
+    ]
+    rows = []
+    for result in results:
+        rows.append((
+            *(str(result.config.limits[queue]) for queue in limit_queues),
+            format_duration(result.config.interval),
+            format_duration(result.makespan) if result.makespan is not None else 'never',
+            f'{result.utilization:.0%}' if result.utilization is not None else '',
+            *(
+                format_duration(wait) if wait is not None else ''
+                for wait in result.wait_percentiles.values()
+            ),
+            str(result.unfinished)
+        ))
+    for line in format_box_table(head, rows):
+        print(line)
+
+def parse_window_arg(s):
+    try:
+        return parse_window(s)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
 def print_job_table(jobs, show_user):
     head = ['ID']
     if show_user:
@@ -22,7 +195,7 @@ def print_job_table(jobs, show_user):
         if show_user:
             row.append(job.user)
         row.extend([
-            job.name,
+            format_job_name(job),
             job.state,
             job.queue,
             format_date(job.since) if job.since is not None else ''
@@ -31,6 +204,50 @@ def print_job_table(jobs, show_user):
     for line in format_box_table(head, rows):
         print(line)
 
+def format_job_name(job):
+    if job.sweep is not None:
+        return f'{job.name} (sweep, {job.sweep.remaining} of {job.sweep.size} left)'
+    else:
+        return job.name
+
+JOB_FIELDS = [
+    'id', 'user', 'name', 'slots', 'state', 'queue', 'since', 'group',
+    'sweep_size', 'sweep_remaining'
+]
+
+def job_to_dict(job):
+    return {
+        'id' : job.id,
+        'user' : job.user,
+        'name' : job.name,
+        'slots' : job.slots,
+        'state' : job.state,
+        'queue' : job.queue,
+        'since' : job.since.isoformat() if job.since is not None else None,
+        'group' : job.group,
+        'sweep_size' : job.sweep.size if job.sweep is not None else None,
+        'sweep_remaining' : job.sweep.remaining if job.sweep is not None else None
+    }
+
+def print_jobs(jobs, format):
+    # Print jobs as they are produced without holding them all in memory.
+    if format == 'json':
+        lines = format_json_array(job_to_dict(job) for job in jobs)
+    elif format == 'jsonl':
+        lines = format_json_lines(job_to_dict(job) for job in jobs)
+    elif format == 'tsv':
+        lines = format_tsv(JOB_FIELDS, (
+            [
+                str(value) if value is not None else ''
+                for value in job_to_dict(job).values()
+            ]
+            for job in jobs
+        ))
+    else:
+        raise ValueError
+    for line in lines:
+        print(line)
+
 def print_capacity_table(limits):
     head = ['Queue', 'Taken', 'Limit', 'Available']
     rows = []
@@ -48,9 +265,107 @@ def add_job_filter_args(parser):
     parser.add_argument('--name',
         help='Only select jobs whose names match the given regular '
              'expression.')
+    parser.add_argument('--queue', dest='filter_queue', metavar='QUEUE',
+        help='Only select jobs that were submitted to this queue, or, for '
+             'locally buffered jobs, that may be submitted to it.')
+    parser.add_argument('--state', action='append',
+        help='Only select jobs in this state, as shown by `list`. Locally '
+             'buffered jobs have the state `-`. This option can be given '
+             'multiple times to select jobs in any of several states.')
+    parser.add_argument('--group',
+        help='Only select jobs in this group, as given to `submit --group`.')
+    parser.add_argument('--since', type=parse_datetime,
+        help='Only select jobs whose time in the Since column is at or after '
+             'this time, given in ISO format, e.g. 2022-07-09T13:00. For '
+             'locally buffered jobs, this is the time they were submitted '
+             'to qfunnel.')
+    parser.add_argument('--until', type=parse_datetime,
+        help='Only select jobs whose time in the Since column is before this '
+             'time.')
 
 def get_job_filter(args):
-    return JobFilter(name=args.name)
+    return JobFilter(
+        name=args.name,
+        queue=args.filter_queue,
+        states=args.state,
+        group=args.group,
+        since=args.since,
+        until=args.until
+    )
+
+def parse_datetime(s):
+    try:
+        return datetime.datetime.fromisoformat(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid date and time: {s!r}')
+
+def get_backend(config, record=None, replay=None, replay_db=None, speedup=None):
+    if replay is not None:
+        return ReplayBackend(replay, replay_db, speedup)
+    buckets = get_buckets(config.rate_limit)
+    if buckets:
+        DB_DIR.mkdir(parents=True, exist_ok=True)
+        rate_limiter = TokenBucketRateLimiter(RATE_LIMIT_DB_FILE, buckets)
+    else:
+        rate_limiter = None
+    if config.backend.type == 'slurm':
+        if record is not None:
+            raise ValueError('--record is only supported with the sge backend')
+        return SlurmBackend(rate_limiter)
+    elif config.backend.type == 'local':
+        if record is not None:
+            raise ValueError('--record is only supported with the sge backend')
+        max_processes = config.backend.max_processes
+        if max_processes is not None and max_processes < 1:
+            raise ValueError('max_processes must be at least 1')
+        return LocalBackend(max_processes=max_processes)
+    elif config.backend.type != 'sge':
+        raise ValueError(f'unknown backend type: {config.backend.type}')
+    if record is not None:
+        return RecordingBackend(record, rate_limiter)
+    else:
+        return RealBackend(rate_limiter)
+
+def get_store(config):
+    if config.storage.type == 'home':
+        # Use the backend's database.
+        return None
+    elif config.storage.type == 'local':
+        if config.storage.path is not None:
+            path = pathlib.Path(config.storage.path).expanduser()
+        else:
+            path = get_default_local_db_file()
+        interval = config.storage.snapshot_interval
+        if interval is None:
+            interval = SNAPSHOT_INTERVAL
+        elif interval < 0:
+            raise ValueError('snapshot_interval cannot be negative')
+        return LocalSnapshotStore(path, DB_FILE, interval)
+    else:
+        raise ValueError(f'unknown storage type: {config.storage.type}')
+
+def get_default_local_db_file():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return pathlib.Path(runtime_dir) / 'qfunnel.db'
+    else:
+        return pathlib.Path(tempfile.gettempdir()) / f'qfunnel-{os.environ["USER"]}.db'
+
+# Exit statuses of `qf wait`.
+WAIT_FAILED_EXIT_STATUS = 1
+WAIT_TIMEOUT_EXIT_STATUS = 124
+
+def positive_int(s):
+    value = int(s)
+    if value <= 0:
+        raise argparse.ArgumentTypeError('must be positive')
+    return value
+
+def nonnegative_int(s):
+    value = int(s)
+    if value < 0:
+        raise argparse.ArgumentTypeError('must not be negative')
+    return value
 
 def main():
 
@@ -59,6 +374,18 @@ def main():
         'A tool for limiting the number of CRC jobs you submit to certain '
         'queues.'
     )
+    parser.add_argument('--record', metavar='TRACE',
+        help='Append every scheduler command and its output to this trace '
+             'file.')
+    parser.add_argument('--replay', metavar='TRACE',
+        help='Instead of running scheduler commands, answer them from a '
+             'trace file written by --record. Requires --replay-db.')
+    parser.add_argument('--replay-db', metavar='FILE',
+        help='The database file to use with --replay.')
+    parser.add_argument('--replay-speedup', type=float, metavar='FACTOR',
+        help='With --replay, make each command take as long as it did when '
+             'recorded, divided by this factor. By default, commands '
+             'return immediately.')
     subparsers = parser.add_subparsers(dest='command', required=True,
         help='The sub-command to run.')
 
@@ -70,6 +397,25 @@ def main():
         help='A queue specifier as given to `qsub -q`.')
     limit_parser.add_argument('limit', type=int, nargs='?',
         help='If given, set the limit for this queue to this value.')
+    limit_parser.add_argument('--pending', type=nonnegative_int,
+        help='When setting a limit, also allow up to this many extra jobs to '
+             'wait in the queue once the limit is reached, so that they start '
+             'as soon as running jobs finish instead of at the next check. '
+             'If the queue has idle slots, these jobs will start running right '
+             'away, so this is best used on busy queues.')
+    limit_parser.add_argument('--floor', type=nonnegative_int,
+        help='When setting a limit, make it adaptive: whenever other users '
+             'have jobs waiting in the queue, lower the limit toward this '
+             'value, in proportion to the share of their jobs that are '
+             'waiting. When nobody else is waiting, the full limit applies.')
+    limit_parser.add_argument('--when', type=parse_window_arg, metavar='WINDOW',
+        help='When setting a limit, apply it only during a weekly time '
+             'window, such as "Mon-Fri 18:00-08:00", "Sat,Sun 00:00-24:00", '
+             'or "22:00-06:00" (every day). Outside of its windows, the '
+             'queue\'s usual limit applies, so the queue must already have '
+             'one. If windows overlap, the one added last wins.')
+    limit_parser.add_argument('--delete-schedule', type=int, metavar='ID',
+        help='Delete the time window with this ID, as shown by `qf limit`.')
     limit_parser.add_argument('--delete', action='store_true', default=False,
         help='Rather than showing or setting the limit for this queue, delete '
              'it, making it unlimited.')
@@ -95,12 +441,52 @@ def main():
              '`qsub`; just buffer it locally. This is much faster than the '
              'alternative, making it very convenient when submitting many '
              'jobs in a loop.')
+    submit_parser.add_argument('--group',
+        help='A label for selecting this job together with others, e.g. with '
+             '`list --group`.')
+    submit_parser.add_argument('--key',
+        help='A unique key for this job. If a job with the same key is still '
+             'locally buffered or was submitted in the last 30 days, and was '
+             'not deleted, nothing is submitted. This makes it safe to rerun a '
+             'script that submits many jobs after it fails partway.')
+    submit_parser.add_argument('--dedupe', action='store_true', default=False,
+        help='Use a hash of the name, arguments, and current directory as '
+             'the key if --key is not given.')
     submit_parser.add_argument('args', nargs=argparse.REMAINDER,
         help='Arguments that will be passed directly to the `qsub` command. '
              'If you need to pass any options beginning with `-` to `qsub`, '
              'use `--` as the first argument. Do not use the `-q` or `-N` '
              'options.')
 
+    sweep_parser = subparsers.add_parser('sweep',
+        help='Submit one job for every combination of values of some '
+             'parameters. The jobs are generated from a template one at a '
+             'time as slots become available, so even very large sweeps take '
+             'up little space, and they are listed as a single entry.')
+    sweep_parser.add_argument('--queue', required=True, action='append',
+        help='The queue to which the jobs will be submitted. As with '
+             '`submit`, this can be given multiple times.')
+    sweep_parser.add_argument('--name', required=True,
+        help='The name of each job. Occurrences of {parameter} are replaced '
+             'with the value of that parameter, e.g. "train-lr{lr}-{seed}".')
+    sweep_parser.add_argument('--axis', required=True, action='append', type=parse_axis_arg,
+        metavar='PARAMETER=VALUES',
+        help='A parameter and a comma-separated list of its values, e.g. '
+             '"lr=0.1,0.01". Ranges of integers can be written as "1..10". '
+             'This can be given multiple times; every combination of values '
+             'is submitted, varying the last parameter fastest.')
+    sweep_parser.add_argument('--deferred', action='store_true', default=False,
+        help='As with `submit`.')
+    sweep_parser.add_argument('--group',
+        help='As with `submit`.')
+    sweep_parser.add_argument('--key',
+        help='As with `submit`, for the whole sweep.')
+    sweep_parser.add_argument('--dedupe', action='store_true', default=False,
+        help='As with `submit`. The hash also covers the axes.')
+    sweep_parser.add_argument('args', nargs=argparse.REMAINDER,
+        help='Arguments for the `qsub` command, as with `submit`, in which '
+             'occurrences of {parameter} are replaced as in --name.')
+
     list_parser = subparsers.add_parser('list',
         help='List the status of all of your running, pending, and locally '
              'buffered jobs.')
@@ -108,6 +494,20 @@ def main():
         help='If given, only list jobs in this queue, including other users\' '
              'jobs.')
     add_job_filter_args(list_parser)
+    list_parser.add_argument('--format', choices=['table', 'json', 'jsonl', 'tsv'], default='table',
+        help='The output format. The default is a table meant for humans, '
+             'followed by a table of queue capacities. The other formats '
+             'print one job per line (except for the brackets of a JSON '
+             'array) as soon as it is read, and they omit queue capacities.')
+    list_parser.add_argument('--offset', type=nonnegative_int,
+        help='Skip this many jobs at the beginning of the list.')
+    list_parser.add_argument('--limit', type=nonnegative_int,
+        help='List at most this many jobs.')
+    list_parser.add_argument('--expand-sweeps', action='store_true', default=False,
+        help='List every remaining job of each sweep instead of one entry '
+             'per sweep. --offset and --limit then count individual jobs.')
+    list_parser.add_argument('--count', action='store_true', default=False,
+        help='Only print the number of selected jobs.')
 
     check_parser = subparsers.add_parser('check',
         help='Check if there are any locally buffered jobs that can be '
@@ -118,13 +518,93 @@ def main():
     watch_parser.add_argument('--seconds', type=float, default=600.0,
         help='The number of seconds to wait in between checks. The default is '
              '10 minutes.')
+    watch_parser.add_argument('--lease-seconds', type=float,
+        help='Only one daemon submits jobs at a time; any others stand by. '
+             'This is how long the active daemon may go without checking in '
+             'before another one takes over. The default is 3 times '
+             '--seconds.')
+
+    status_parser = subparsers.add_parser('status',
+        help='Show how quickly jobs are being dispatched to and completed in '
+             'each queue, how many are still waiting, and an estimate of how '
+             'long they will take to finish. This only reads the database, '
+             'so it reflects the last check by `qf watch` or `qf check`.')
+    status_parser.add_argument('--hours', type=positive_int, default=24,
+        help='The number of hours of history to average throughput, and run '
+             'times from accounting records, over. The default is 24.')
+
+    wait_parser = subparsers.add_parser('wait',
+        help='Wait until a selection of jobs, whether locally buffered, '
+             'pending, or running, have finished. This only reads the '
+             'database, so it relies on `qf watch` to keep track of jobs, and '
+             'it does not run qstat no matter how many processes are waiting. '
+             'The exit status is 0 if all of the jobs finished, '
+             f'{WAIT_FAILED_EXIT_STATUS} if the rest finished but some are '
+             f'stuck in an error state, and {WAIT_TIMEOUT_EXIT_STATUS} if the '
+             'timeout was reached first. Jobs that qfunnel is not tracking '
+             'count as finished.')
+    wait_parser.add_argument('id', nargs='*',
+        help='The IDs of the jobs to wait for as shown by `list`. A locally '
+             'buffered job can be given by its ID from before it was '
+             'submitted. Instead of giving IDs, you can select jobs with the '
+             'options below.')
+    add_job_filter_args(wait_parser)
+    wait_parser.add_argument('--timeout', type=float,
+        help='Give up after this many seconds. The default is to wait '
+             'indefinitely.')
+    wait_parser.add_argument('--seconds', type=float, default=WAIT_INTERVAL,
+        help='The number of seconds to wait in between reads of the database. '
+             f'The default is {WAIT_INTERVAL:g}.')
+
+    stats_parser = subparsers.add_parser('stats',
+        help='Show the run times, failures, and memory use of finished jobs, '
+             'grouped by the pattern of their names (with numbers replaced by '
+             '#) and by queue. `qf watch` reads these from the scheduler\'s '
+             'accounting records about once an hour.')
+    stats_parser.add_argument('--name',
+        help='Only show patterns that match the given regular expression.')
+
+    simulate_parser = subparsers.add_parser('simulate',
+        help='Predict how long the locally buffered jobs will take to run '
+             'under different limits and check intervals, without submitting '
+             'anything. This replays the dispatcher in simulated time, '
+             'starting from the buffer and the last snapshot, with run times '
+             'drawn from the history of finished jobs. It prints one row per '
+             'combination of the given settings.')
+    simulate_parser.add_argument('--limit', action='append', type=parse_queue_values_arg,
+        default=[], metavar='QUEUE=VALUES',
+        help='Limits to try for a queue instead of its current limit, as a '
+             'comma-separated list, e.g. "gpu@@a=4,8,16". Ranges can be '
+             'written as "1..10". This can be given for several queues.')
+    simulate_parser.add_argument('--interval', type=parse_intervals_arg, default=[600.0],
+        metavar='SECONDS',
+        help='A comma-separated list of numbers of seconds in between checks '
+             'to try. The default is 600, the default of `watch`.')
+    simulate_parser.add_argument('--capacity', action='append', type=parse_queue_values_arg,
+        default=[], metavar='QUEUE=SLOTS',
+        help='The total number of slots in a queue. By default, queues have '
+             'unlimited room.')
+    simulate_parser.add_argument('--others', action='append', type=parse_queue_values_arg,
+        default=[], metavar='QUEUE=SLOTS',
+        help='The number of slots in a queue occupied by other users. The '
+             'default is the number last seen for queues with adaptive '
+             'limits, and 0 otherwise.')
+    simulate_parser.add_argument('--runtime', type=float, default=DEFAULT_RUNTIME,
+        help='The run time in seconds to assume when there is no history of '
+             f'finished jobs. The default is {DEFAULT_RUNTIME:g}.')
+    simulate_parser.add_argument('--seed', type=int, default=0,
+        help='The random seed for drawing run times.')
 
     delete_parser = subparsers.add_parser('delete',
         help='Delete running, pending, or locally buffered jobs. Running and '
              'pending jobs are canceled with `qdel`. Locally buffered jobs are '
              'simply deleted.')
     delete_parser.add_argument('id', nargs='*',
-        help='The IDs of the jobs to delete as shown by `list`.')
+        help='The IDs of the jobs to delete as shown by `list`. Instead of '
+             'giving IDs, you can select jobs with the options below.')
+    add_job_filter_args(delete_parser)
+    delete_parser.add_argument('--local-only', action='store_true', default=False,
+        help='Only delete locally buffered jobs, not running or pending jobs.')
 
     bump_parser = subparsers.add_parser('bump',
         help='Move a selection of locally buffered jobs to the front of the '
@@ -133,7 +613,27 @@ def main():
 
     args = parser.parse_args()
 
-    program = Program(RealBackend())
+    if args.replay is not None:
+        if args.replay_db is None:
+            parser.error('--replay requires --replay-db')
+        if args.record is not None:
+            parser.error('cannot use --record and --replay at the same time')
+    elif args.replay_db is not None or args.replay_speedup is not None:
+        parser.error('--replay-db and --replay-speedup require --replay')
+    if args.replay_speedup is not None and args.replay_speedup <= 0:
+        parser.error('--replay-speedup must be positive')
+
+    config = load_config()
+    backend = get_backend(
+        config,
+        record=args.record,
+        replay=args.replay,
+        replay_db=args.replay_db,
+        speedup=args.replay_speedup
+    )
+    # Replays always use their own database.
+    store = get_store(config) if args.replay is None else None
+    program = Program(backend, store)
 
     if args.command == 'limit':
         if args.delete:
@@ -142,43 +642,173 @@ def main():
             if args.limit is not None:
                 parser.error('cannot use --delete and set a limit at the same time')
             program.delete_limit(args.queue)
+        elif args.delete_schedule is not None:
+            if args.queue is not None:
+                parser.error('cannot use --delete-schedule with a queue name')
+            try:
+                program.delete_limit_schedule(args.delete_schedule)
+            except ValueError as e:
+                parser.error(str(e))
         else:
             if args.limit is not None:
-                program.set_limit(args.queue, args.limit)
+                if args.when is not None:
+                    if args.floor is not None:
+                        parser.error('--floor cannot be used with --when; set it on the usual limit')
+                    try:
+                        program.add_limit_schedule(args.queue, *args.when, args.limit, args.pending)
+                    except ValueError as e:
+                        parser.error(str(e))
+                else:
+                    try:
+                        program.set_limit(args.queue, args.limit, args.pending, args.floor)
+                    except ValueError as e:
+                        parser.error(str(e))
+            elif args.pending is not None or args.when is not None or args.floor is not None:
+                parser.error('--pending, --floor, and --when require a limit')
             else:
                 if args.queue is not None:
-                    limit = program.get_limit(args.queue)
+                    limit = next(
+                        (limit for limit in program.get_limit_settings() if limit.queue == args.queue),
+                        None
+                    )
                     if limit is None:
                         print('no limit')
+                    elif limit.next_change is not None:
+                        print(f'{limit.value} (changes to {format_limit_change(limit.next_change)})')
                     else:
-                        print(limit)
+                        print(limit.value)
                 else:
-                    print_limit_table(program.get_all_limits())
+                    print_limit_table(program.get_limit_settings())
+                    schedules = program.get_limit_schedules()
+                    if schedules:
+                        print_limit_schedule_table(schedules)
     elif args.command == 'submit':
         command_args = args.args
         if command_args and command_args[0] == '--':
             command_args = command_args[1:]
-        program.submit(args.queue, args.name, command_args, args.deferred)
+        if not program.submit(args.queue, args.name, command_args, args.deferred, args.group,
+                args.key, args.dedupe):
+            print(f'skipped {args.name}: a job with the same key was already submitted', file=sys.stderr)
+    elif args.command == 'sweep':
+        command_args = args.args
+        if command_args and command_args[0] == '--':
+            command_args = command_args[1:]
+        try:
+            sweep_id = program.sweep(args.queue, args.name, command_args, args.axis, args.deferred,
+                args.group, args.key, args.dedupe)
+        except ValueError as e:
+            parser.error(str(e))
+        if sweep_id is None:
+            print(f'skipped {args.name}: a sweep with the same key was already submitted', file=sys.stderr)
     elif args.command == 'list':
-        if args.queue is not None:
-            info = program.list_queue_jobs(args.queue, get_job_filter(args))
-            print_job_table(info.jobs, show_user=True)
-            print()
-            print_capacity_table([(args.queue, info.capacity)])
+        job_filter = get_job_filter(args)
+        if args.count:
+            if args.queue is not None:
+                print(program.count_queue_jobs(args.queue, job_filter))
+            else:
+                print(program.count_own_jobs(job_filter))
+        elif args.format != 'table':
+            if args.expand_sweeps:
+                # Page through the expanded jobs rather than the entries.
+                offset, limit = None, None
+            else:
+                offset, limit = args.offset, args.limit
+            if args.queue is not None:
+                jobs = program.iter_queue_jobs(args.queue, job_filter, offset, limit)
+            else:
+                jobs = program.iter_own_jobs(job_filter, offset, limit)
+            if args.expand_sweeps:
+                jobs = paginate(program.expand_sweeps(jobs), args.offset, args.limit)
+            print_jobs(jobs, args.format)
         else:
-            info = program.list_own_jobs(get_job_filter(args))
-            print_job_table(info.jobs, show_user=False)
+            if args.queue is not None:
+                info = program.list_queue_jobs(args.queue, job_filter)
+            else:
+                info = program.list_own_jobs(job_filter)
+            jobs = info.jobs
+            if args.expand_sweeps:
+                jobs = program.expand_sweeps(jobs)
+            print_job_table(paginate(jobs, args.offset, args.limit), show_user=args.queue is not None)
             print()
-            print_capacity_table(info.queues)
+            if args.queue is not None:
+                print_capacity_table([(args.queue, info.capacity)])
+            else:
+                print_capacity_table(info.queues)
     elif args.command == 'check':
         program.check()
     elif args.command == 'watch':
         try:
-            program.watch(args.seconds)
+            program.watch(args.seconds, lease_seconds=args.lease_seconds)
         except KeyboardInterrupt:
             print()
+    elif args.command == 'status':
+        print_status(program.get_status(args.hours))
+    elif args.command == 'stats':
+        print_runtime_stats_table(program.get_runtime_stats(args.name))
+    elif args.command == 'simulate':
+        scenario = program.get_simulation_scenario(args.runtime)
+        for option, name in [(args.capacity, 'capacity'), (args.others, 'others')]:
+            for queue, values in option:
+                if len(values) != 1:
+                    parser.error(f'--{name} takes a single value per queue')
+                setattr(scenario.queues.setdefault(queue, SimulatedQueue()), name, values[0])
+        limit_queues = [queue for queue, values in args.limit]
+        if len(set(limit_queues)) != len(limit_queues):
+            parser.error('--limit was given more than once for the same queue')
+        results = [
+            simulate(scenario, SimulationConfig(dict(zip(limit_queues, limits)), interval), args.seed)
+            for limits in itertools.product(*(values for queue, values in args.limit))
+            for interval in args.interval
+        ]
+        print_simulation_table(limit_queues, results)
+    elif args.command == 'wait':
+        job_filter = get_job_filter(args)
+        if args.id and not job_filter.is_empty():
+            parser.error('cannot give job IDs and select jobs with options at the same time')
+        if not args.id and job_filter.is_empty():
+            parser.error('no jobs selected')
+        if args.timeout is not None and args.timeout < 0:
+            parser.error('--timeout must not be negative')
+        if args.seconds <= 0:
+            parser.error('--seconds must be positive')
+        try:
+            result = program.wait(
+                args.id or None,
+                None if job_filter.is_empty() else job_filter,
+                args.timeout,
+                args.seconds
+            )
+        except KeyboardInterrupt:
+            print()
+            sys.exit(130)
+        for job in result.failed:
+            print(f'error: job {job.id} ({job.name}) is in state {job.state}', file=sys.stderr)
+        if result.timed_out:
+            print(f'timed out with {len(result.remaining)} jobs remaining', file=sys.stderr)
+            sys.exit(WAIT_TIMEOUT_EXIT_STATUS)
+        elif result.failed:
+            sys.exit(WAIT_FAILED_EXIT_STATUS)
     elif args.command == 'delete':
-        program.delete(args.id)
+        job_filter = get_job_filter(args)
+        if args.id:
+            if not job_filter.is_empty() or args.local_only:
+                parser.error('cannot give job IDs and select jobs with options at the same time')
+            result = program.delete(args.id)
+        elif job_filter.is_empty():
+            parser.error('no jobs selected')
+        else:
+            result = program.delete_matching(job_filter, args.local_only)
+            print(
+                f'deleted {result.num_local_jobs} locally buffered jobs and '
+                f'canceled {len(result.backend_jobs)} jobs'
+            )
+        for failure in result.failures:
+            print(
+                f'error: failed to cancel {" ".join(failure.job_ids)}: {failure.message}',
+                file=sys.stderr
+            )
+        if result.failures:
+            sys.exit(1)
     elif args.command == 'bump':
         job_filter = get_job_filter(args)
         if job_filter.is_empty():
@@ -0,0 +1,78 @@
+import configparser
+import dataclasses
+import os
+import pathlib
+
+CONFIG_FILE = pathlib.Path.home() / '.config' / 'qfunnel.ini'
+
+@dataclasses.dataclass
+class RateLimitConfig:
+    # Average numbers of commands allowed per minute, and how many commands
+    # may be run back to back before the average applies. None means no
+    # limit.
+    query_per_minute: float=None
+    query_burst: int=None
+    submit_per_minute: float=None
+    submit_burst: int=None
+
+@dataclasses.dataclass
+class BackendConfig:
+    # The scheduler to submit jobs to: "sge", "slurm", or "local".
+    type: str='sge'
+    # The most jobs the local backend runs at once. None means the number of
+    # CPUs.
+    max_processes: int=None
+
+@dataclasses.dataclass
+class StorageConfig:
+    # Where to keep the database: "home" for the home directory, or "local"
+    # for node-local disk with periodic exports to the home directory.
+    type: str='home'
+    # The path of the local database. None means the default.
+    path: str=None
+    # Seconds between exports of the local database.
+    snapshot_interval: float=None
+
+@dataclasses.dataclass
+class Config:
+    rate_limit: RateLimitConfig
+    backend: BackendConfig=dataclasses.field(default_factory=BackendConfig)
+    storage: StorageConfig=dataclasses.field(default_factory=StorageConfig)
+
+def get_config_file():
+    path = os.environ.get('QFUNNEL_CONFIG')
+    if path is not None:
+        return pathlib.Path(path)
+    else:
+        return CONFIG_FILE
+
+def load_config(path=None):
+    """Read the config file. Missing files, sections, and options fall back
+    to the defaults."""
+    if path is None:
+        path = get_config_file()
+    parser = configparser.ConfigParser()
+    parser.read(path)
+    return Config(
+        rate_limit=RateLimitConfig(
+            query_per_minute=get_option(parser, 'rate_limit', 'query_per_minute', parser.getfloat),
+            query_burst=get_option(parser, 'rate_limit', 'query_burst', parser.getint),
+            submit_per_minute=get_option(parser, 'rate_limit', 'submit_per_minute', parser.getfloat),
+            submit_burst=get_option(parser, 'rate_limit', 'submit_burst', parser.getint)
+        ),
+        backend=BackendConfig(
+            type=get_option(parser, 'backend', 'type', parser.get, 'sge'),
+            max_processes=get_option(parser, 'backend', 'max_processes', parser.getint)
+        ),
+        storage=StorageConfig(
+            type=get_option(parser, 'storage', 'type', parser.get, 'home'),
+            path=get_option(parser, 'storage', 'path', parser.get),
+            snapshot_interval=get_option(parser, 'storage', 'snapshot_interval', parser.getfloat)
+        )
+    )
+
+def get_option(parser, section, option, get, default=None):
+    if parser.has_option(section, option):
+        return get(section, option)
+    else:
+        return default
@@ -1,4 +1,5 @@
 import itertools
+import json
 
 def format_box_table(head, rows):
     return format_table(
@@ -22,6 +23,38 @@ def format_table(head, rows, vert, horiz, cross):
 def format_row(row, widths, sep):
     return sep.join('{:{}}'.format(x, w) for x, w in zip(row, widths))
 
+def format_json_array(values):
+    # Emit one line per value so that output is produced as values arrive.
+    first = True
+    for value in values:
+        prefix = '[' if first else ','
+        yield prefix + json.dumps(value)
+        first = False
+    if first:
+        yield '[]'
+    else:
+        yield ']'
+
+def format_json_lines(values):
+    for value in values:
+        yield json.dumps(value)
+
+def format_tsv(head, rows):
+    yield format_tsv_row(head)
+    for row in rows:
+        yield format_tsv_row(row)
+
+def format_tsv_row(row):
+    return '\t'.join(escape_tsv_field(x) for x in row)
+
+def escape_tsv_field(s):
+    return (
+        s.replace('\\', '\\\\')
+         .replace('\t', '\\t')
+         .replace('\n', '\\n')
+         .replace('\r', '\\r')
+    )
+
 def format_date(d):
     weekday = d.strftime('%a')
     month = d.strftime('%b')
@@ -30,3 +63,23 @@ def format_date(d):
         hour = 12
     ampm = 'AM' if d.hour < 12 else 'PM'
     return f'{weekday} {month} {d.day} @ {hour}:{d.minute:02}:{d.second:02} {ampm}'
+
+def format_duration(seconds):
+    minutes = int(round(seconds / 60))
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days > 0:
+        return f'{days}d {hours:02}h'
+    elif hours > 0:
+        return f'{hours}h {minutes:02}m'
+    else:
+        return f'{minutes}m'
+
+def format_memory(num_bytes):
+    for unit in ['B', 'K', 'M', 'G']:
+        if num_bytes < 1024:
+            break
+        num_bytes /= 1024
+    else:
+        unit = 'T'
+    return f'{num_bytes:.1f}{unit}' if unit != 'B' else f'{num_bytes:.0f}B'
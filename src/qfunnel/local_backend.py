@@ -0,0 +1,352 @@
+import datetime
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import time
+
+from .program import BackendError, FinishedJob, Job
+from .real_backend import DB_DIR, RealBackend
+
+LOCAL_DB_FILE = DB_DIR / 'qfunnel-local.db'
+
+# How long, in seconds, to keep the records of finished processes.
+LOCAL_HISTORY = 30 * 24 * 3600.0
+
+# Each job is run by a shell that writes the job's exit status to a file
+# once it finishes, so that any process can tell how it ended, not only the
+# one that started it.
+RUNNER_SCRIPT = '"$@"; echo $? > "$0"'
+
+class LocalBackend(RealBackend):
+    """A backend that runs jobs as processes on the local machine. Queues
+    are just labels, so limits become the number of processes that may run
+    at once with each label (e.g. one queue per GPU). At most max_processes
+    jobs run at once in total; the rest wait in the pending state.
+
+    Jobs are tracked in their own SQLite database, so every qf command sees
+    the same jobs. Processes are started and reaped whenever jobs are listed,
+    which the daemon does on every check. Each job runs in its own process
+    group with the environment variables QFUNNEL_JOB_ID and QFUNNEL_QUEUE
+    set, and its output goes to NAME.oID and NAME.eID in its directory. The
+    arguments to `qf submit` are the command to run."""
+
+    def __init__(self, db_file=LOCAL_DB_FILE, max_processes=None, clock=time.time):
+        super().__init__()
+        self.db_file = db_file
+        self.max_processes = max_processes if max_processes is not None else os.cpu_count()
+        self.clock = clock
+        # Processes started by this object, which must be waited on so that
+        # they do not linger as zombies.
+        self.processes = {}
+
+    def submit_job(self, queue, name, args, cwd):
+        with self.connect_to_local_db() as conn:
+            job_id = conn.execute('''\
+insert into "local_jobs"("name", "queue", "user", "args_json", "cwd", "submitted_at")
+values (?, ?, ?, ?, ?, ?)
+''', (name, queue, self.get_own_user(), json.dumps(args), cwd, self.clock())).lastrowid
+            self.update_processes(conn)
+        return str(job_id)
+
+    def delete_jobs(self, job_ids):
+        unknown_job_ids = []
+        with self.connect_to_local_db() as conn:
+            self.update_processes(conn, start=False)
+            for job_id in job_ids:
+                row = conn.execute('''\
+select "pid", "process_start" from "local_jobs"
+where "id" = ? and "ended_at" is null
+''', (job_id,)).fetchone()
+                if row is None:
+                    unknown_job_ids.append(job_id)
+                    continue
+                pid, process_start = row
+                if pid is not None:
+                    signal_process_group(pid, process_start, signal.SIGTERM)
+                # The job is over as far as qf is concerned, but its processes
+                # linger until they have handled the signal.
+                conn.execute('''\
+update "local_jobs"
+set "ended_at" = ?, "exit_status" = ?, "lingering" = ?
+where "id" = ?
+''', (self.clock(), 128 + signal.SIGTERM, pid is not None, job_id))
+            self.update_processes(conn)
+        if unknown_job_ids:
+            raise BackendError(f'unknown jobs: {" ".join(unknown_job_ids)}')
+
+    def get_own_jobs(self):
+        return self.get_jobs()
+
+    def get_own_pending_jobs(self):
+        return [job for job in self.get_jobs() if job.state == 'qw']
+
+    def get_own_running_jobs_in_queue(self, queue):
+        return self.get_running_jobs_in_queue(queue)
+
+    def get_running_jobs_in_queue(self, queue):
+        return [job for job in self.get_jobs() if job.queue == queue and job.state == 'r']
+
+    def get_pending_jobs_in_queue(self, queue):
+        return [job for job in self.get_jobs() if job.queue == queue and job.state == 'qw']
+
+    def get_finished_jobs(self, start, end):
+        with self.connect_to_local_db() as conn:
+            self.update_processes(conn)
+            rows = conn.execute('''\
+select "id", "name", "queue", "started_at", "ended_at", "exit_status"
+from "local_jobs"
+where "ended_at" is not null and "started_at" >= ? and "started_at" <= ?
+order by "id" asc
+''', (start.timestamp(), end.timestamp())).fetchall()
+        return [
+            FinishedJob(
+                id=str(job_id),
+                name=name,
+                queue=queue,
+                start_time=datetime.datetime.fromtimestamp(started_at),
+                end_time=datetime.datetime.fromtimestamp(ended_at),
+                exit_status=exit_status,
+                failed=exit_status != 0
+            )
+            for job_id, name, queue, started_at, ended_at, exit_status in rows
+        ]
+
+    def get_jobs(self):
+        with self.connect_to_local_db() as conn:
+            self.update_processes(conn)
+            rows = conn.execute('''\
+select "id", "user", "name", "queue", "pid", "submitted_at", "started_at"
+from "local_jobs"
+where "ended_at" is null
+order by "id" asc
+''').fetchall()
+        return [
+            Job(
+                id=str(job_id),
+                user=user,
+                name=name,
+                slots=1,
+                state='r' if pid is not None else 'qw',
+                queue=queue,
+                since=datetime.datetime.fromtimestamp(started_at if started_at is not None else submitted_at)
+            )
+            for job_id, user, name, queue, pid, submitted_at, started_at in rows
+        ]
+
+    def update_processes(self, conn, start=True):
+        # Record the processes that have finished, then start pending jobs
+        # in order while there is room in the pool.
+        now = self.clock()
+        for job_id, name, cwd, pid, process_start in conn.execute('''\
+select "id", "name", "cwd", "pid", "process_start"
+from "local_jobs"
+where "ended_at" is null and "pid" is not null
+''').fetchall():
+            if self.is_running(job_id, pid, process_start):
+                continue
+            exit_status = read_exit_status(get_status_file(cwd, name, job_id))
+            if exit_status is None:
+                # The shell itself was killed before it could write the
+                # exit status.
+                exit_status = 128 + signal.SIGKILL
+            conn.execute('''\
+update "local_jobs"
+set "ended_at" = ?, "exit_status" = ?
+where "id" = ?
+''', (now, exit_status, job_id))
+        # Deleted jobs may still write their exit status while they shut
+        # down, so clean up after them once all of their processes are gone.
+        for job_id, name, cwd, pid, process_start in conn.execute('''\
+select "id", "name", "cwd", "pid", "process_start"
+from "local_jobs"
+where "lingering"
+''').fetchall():
+            # Reap the shell first if this object started it.
+            self.is_running(job_id, pid, process_start)
+            if not is_process_group_alive(pid, process_start):
+                read_exit_status(get_status_file(cwd, name, job_id))
+                conn.execute('''\
+update "local_jobs"
+set "lingering" = 0
+where "id" = ?
+''', (job_id,))
+        if start:
+            running, = conn.execute('''\
+select count(*) from "local_jobs"
+where "ended_at" is null and "pid" is not null
+''').fetchone()
+            for job_id, name, queue, args_json, cwd in conn.execute('''\
+select "id", "name", "queue", "args_json", "cwd"
+from "local_jobs"
+where "ended_at" is null and "pid" is null
+order by "id" asc
+limit ?
+''', (max(self.max_processes - running, 0),)).fetchall():
+                pid = self.start_process(str(job_id), name, queue, json.loads(args_json), cwd)
+                conn.execute('''\
+update "local_jobs"
+set "pid" = ?, "process_start" = ?, "started_at" = ?
+where "id" = ?
+''', (pid, get_process_start(pid), now, job_id))
+        conn.execute('''\
+delete from "local_jobs"
+where "ended_at" < ? and not "lingering"
+''', (now - LOCAL_HISTORY,))
+
+    def start_process(self, job_id, name, queue, args, cwd):
+        env = dict(os.environ, QFUNNEL_JOB_ID=job_id, QFUNNEL_QUEUE=queue)
+        with open(os.path.join(cwd, f'{name}.o{job_id}'), 'ab') as stdout, \
+             open(os.path.join(cwd, f'{name}.e{job_id}'), 'ab') as stderr:
+            try:
+                process = subprocess.Popen(
+                    ['sh', '-c', RUNNER_SCRIPT, get_status_file(cwd, name, job_id), *args],
+                    cwd=cwd,
+                    env=env,
+                    stdin=subprocess.DEVNULL,
+                    stdout=stdout,
+                    stderr=stderr,
+                    start_new_session=True
+                )
+            except OSError as e:
+                raise BackendError(f'failed to start job {job_id}: {e}')
+        self.processes[int(job_id)] = process
+        return process.pid
+
+    def is_running(self, job_id, pid, process_start):
+        # Return whether a job's shell is still running. Processes started
+        # by this object are waited on, so that they do not linger as
+        # zombies. Others are looked up by their IDs, which may have been
+        # reused since.
+        process = self.processes.get(job_id)
+        if process is not None:
+            if process.poll() is None:
+                return True
+            del self.processes[job_id]
+            return False
+        return is_job_process(pid, process_start)
+
+    def connect_to_local_db(self):
+        return LocalDatabase(self.db_file)
+
+class LocalDatabase:
+    """A connection to the database of local jobs that holds a write lock
+    for the duration of a with block and commits at the end of it."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.conn = sqlite3.connect(self.path, timeout=60.0, isolation_level=None)
+        self.conn.execute('begin immediate')
+        self.conn.execute('''\
+create table if not exists "local_jobs"(
+  "id" integer primary key autoincrement,
+  "name" text not null,
+  "queue" text not null,
+  "user" text not null,
+  "args_json" text not null,
+  "cwd" text not null,
+  "submitted_at" real not null,
+  "pid" integer,
+  "started_at" real,
+  "ended_at" real,
+  "exit_status" integer,
+  "process_start" integer,
+  "lingering" integer not null default 0
+)''')
+        # Add the columns that older versions did not have.
+        columns = {row[1] for row in self.conn.execute('pragma table_info("local_jobs")')}
+        if 'process_start' not in columns:
+            self.conn.execute('alter table "local_jobs" add column "process_start" integer')
+        if 'lingering' not in columns:
+            self.conn.execute('alter table "local_jobs" add column "lingering" integer not null default 0')
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.conn.close()
+
+def get_status_file(cwd, name, job_id):
+    return os.path.join(cwd, f'.{name}.s{job_id}')
+
+def read_exit_status(status_file):
+    # Return the exit status in a status file, or None if there is none, and
+    # remove the file.
+    try:
+        with open(status_file) as fin:
+            return int(fin.read().strip())
+    except (OSError, ValueError):
+        return None
+    finally:
+        try:
+            os.remove(status_file)
+        except OSError:
+            pass
+
+def get_process_start(pid):
+    # Return the time at which a process started, in clock ticks since boot,
+    # or None if it is not known (e.g. on systems without /proc). Together
+    # with the process ID, this identifies a process even after the ID is
+    # reused.
+    try:
+        with open(f'/proc/{pid}/stat') as fin:
+            stat = fin.read()
+    except OSError:
+        return None
+    # The start time is the 22nd field. The command name, the 2nd field, is
+    # in parentheses and may contain spaces.
+    try:
+        return int(stat[stat.rindex(')') + 2:].split()[19])
+    except (ValueError, IndexError):
+        return None
+
+def is_job_process(pid, process_start):
+    # Return whether the process with a job's recorded ID is still the job's
+    # shell, rather than another process that was given the same ID.
+    if process_start is not None:
+        return get_process_start(pid) == process_start
+    # Without a start time, check that the process still leads its own
+    # session, as the shell does.
+    try:
+        return os.getsid(pid) == pid
+    except OSError:
+        return False
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def is_process_group_alive(pid, process_start):
+    # A process group's ID is not reused while any of its processes are
+    # alive, so the group is the job's unless its leader's ID has been given
+    # to another process.
+    if is_process_alive(pid) and not is_job_process(pid, process_start):
+        return False
+    try:
+        os.killpg(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def signal_process_group(pid, process_start, signum):
+    # Send a signal to a job's processes, unless the group is gone.
+    if is_process_group_alive(pid, process_start):
+        try:
+            os.killpg(pid, signum)
+        except ProcessLookupError:
+            pass
@@ -2,51 +2,64 @@ import collections
 import contextlib
 import dataclasses
 import datetime
+import functools
+import hashlib
 import itertools
 import json
 import math
+import os
 import pathlib
 import re
+import socket
 import sqlite3
 import sys
 import time
 import traceback
 
+from .schedule import LimitSchedule, get_active_schedule, get_next_boundaries
+from .simulate import DEFAULT_RUNTIME, Scenario, SimulatedEntry, SimulatedQueue
+from .sweep import fill_template, get_point, get_sweep_size
+
 class Program:
 
-    def __init__(self, backend):
+    def __init__(self, backend, store=None):
         super().__init__()
         self.backend = backend
+        # By default, use the database that the backend provides.
+        self.store = store if store is not None else BackendStore(backend)
 
     def get_limit(self, queue):
-        with self.get_db_connection() as conn:
-            result = conn.execute('''\
-select "value"
-from "limits"
-where "queue" = ?
-''', (queue,)).fetchone()
-            if result is not None:
-                return result[0]
+        with self.get_db_connection() as conn, self.read_db(conn):
+            limit = self.get_limits(conn).get(queue)
+            if limit is not None:
+                return limit.value
             else:
                 return None
 
     def get_all_limits(self):
-        with self.get_db_connection() as conn:
-            return list(conn.execute('''\
-select "queue", "value"
-from "limits"
-order by "queue" asc
-''').fetchall())
+        with self.get_db_connection() as conn, self.read_db(conn):
+            return [(limit.queue, limit.value) for limit in self.get_limits(conn).values()]
+
+    def get_limit_settings(self):
+        with self.get_db_connection() as conn, self.read_db(conn):
+            return list(self.get_limits(conn, include_next_change=True).values())
 
-    def set_limit(self, queue, limit):
+    def set_limit(self, queue, limit, pending=None, floor=None):
         if limit < 0:
             raise ValueError('limit cannot be negative')
+        if pending is not None and pending < 0:
+            raise ValueError('pending headroom cannot be negative')
+        if floor is not None and not (0 <= floor <= limit):
+            raise ValueError('floor must be between 0 and the limit')
         with self.get_db_connection() as conn:
             with self.lock_db(conn):
                 conn.execute('''\
-insert or replace into "limits"("queue", "value")
-values (?, ?)
-''', (queue, limit))
+insert or replace into "limits"("queue", "value", "pending", "floor")
+values (?, ?, ?, ?)
+''', (queue, limit, pending, floor))
+                # Running jobs whose queue was not found among the limited
+                # queues may belong to this one.
+                self.unresolve_snapshot_jobs(conn)
 
     def delete_limit(self, queue):
         with self.get_db_connection() as conn:
@@ -55,30 +68,246 @@ values (?, ?)
 delete from "limits"
 where "queue" = ?
 ''', (queue,))
+                conn.execute('''\
+delete from "limit_schedules"
+where "queue" = ?
+''', (queue,))
+                conn.execute('''\
+delete from "adaptive_limits"
+where "queue" = ?
+''', (queue,))
+
+    def add_limit_schedule(self, queue, days, start, end, value, pending=None):
+        if value < 0:
+            raise ValueError('limit cannot be negative')
+        if pending is not None and pending < 0:
+            raise ValueError('pending headroom cannot be negative')
+        with self.get_db_connection() as conn:
+            with self.lock_db(conn):
+                # Outside of its windows, a queue falls back to its usual
+                # limit, so it must have one.
+                row = conn.execute('''\
+select 1
+from "limits"
+where "queue" = ?
+''', (queue,)).fetchone()
+                if row is None:
+                    raise ValueError(f'queue {queue} has no limit')
+                return conn.execute('''\
+insert into "limit_schedules"("queue", "days", "start", "end", "value", "pending")
+values (?, ?, ?, ?, ?, ?)
+''', (queue, days, start, end, value, pending)).lastrowid
+
+    def delete_limit_schedule(self, schedule_id):
+        with self.get_db_connection() as conn:
+            with self.lock_db(conn):
+                cursor = conn.execute('''\
+delete from "limit_schedules"
+where "id" = ?
+''', (schedule_id,))
+                if cursor.rowcount == 0:
+                    raise ValueError(f'no limit schedule with ID {schedule_id}')
+
+    def get_limit_schedules(self):
+        with self.get_db_connection() as conn, self.read_db(conn):
+            return self.get_schedules(conn)
 
-    def submit(self, queues, name, args, deferred=False):
-        command_json = json.dumps(args, separators=(',', ':'))
+    def submit(self, queues, name, args, deferred=False, group=None, key=None, dedupe=False):
+        # Return whether the job was added, which it is not if a job with the
+        # same key is still buffered or was submitted recently.
+        prefix, suffix = self.backend.split_command(args)
         cwd = self.backend.get_cwd()
+        enqueued_at = self.backend.get_current_time().timestamp()
+        if key is None and dedupe:
+            key = get_submission_key(name, args, cwd)
         with self.get_db_connection() as conn:
             with self.lock_db(conn):
+                if key is not None and self.has_submission_key(conn, key):
+                    return False
+                prefix_id = self.intern_value(conn, 'command_prefixes', 'args_json', encode_json(prefix))
+                cwd_id = self.intern_value(conn, 'cwds', 'path', cwd)
                 curs = conn.execute('''\
-insert into "jobs"("name", "command_json", "cwd")
-values (?, ?, ?)
-''', (name, command_json, cwd))
+insert into "jobs"("name", "prefix_id", "suffix_json", "cwd_id", "group", "enqueued_at")
+values (?, ?, ?, ?, ?, ?)
+''', (name, prefix_id, encode_json(suffix), cwd_id, group, enqueued_at))
                 job_id = curs.lastrowid
                 for queue in queues:
                     conn.execute('''\
 insert into "job_queues"("job_id", "queue")
 values (?, ?)
 ''', (job_id, queue))
+                if key is not None:
+                    self.add_submission_key(conn, key, job_id, enqueued_at)
             if not deferred:
                 self.check_impl(conn)
+        return True
 
-    def list_queue_jobs(self, queue, job_filter=None):
+    def sweep(self, queues, name, args, axes, deferred=False, group=None, key=None, dedupe=False):
+        # axes is a list of (parameter, values) pairs. Return the ID of the
+        # new sweep, or None if one with the same key already exists.
+        if not axes:
+            raise ValueError('a sweep needs at least one axis')
+        names = [axis_name for axis_name, values in axes]
+        if len(set(names)) != len(names):
+            raise ValueError('axis names must be unique')
+        if any(not values for axis_name, values in axes):
+            raise ValueError('every axis needs at least one value')
+        cwd = self.backend.get_cwd()
+        enqueued_at = self.backend.get_current_time().timestamp()
+        if key is None and dedupe:
+            key = get_submission_key(name, args, cwd, axes)
         with self.get_db_connection() as conn:
-            jobs = self.get_queue_jobs(conn, queue)
-            own_user = self.backend.get_own_user()
-            taken = sum(job.slots for job in jobs if job.user == own_user and job.state != '-')
+            with self.lock_db(conn):
+                if key is not None and self.has_submission_key(conn, key):
+                    return None
+                cwd_id = self.intern_value(conn, 'cwds', 'path', cwd)
+                sweep_id = conn.execute('''\
+insert into "sweeps"("name", "args_json", "cwd_id", "queues_json", "axes_json", "size", "next_index", "group", "enqueued_at")
+values (?, ?, ?, ?, ?, ?, 0, ?, ?)
+''', (
+                    name,
+                    encode_json(args),
+                    cwd_id,
+                    encode_json(queues),
+                    encode_json(axes),
+                    get_sweep_size(axes),
+                    group,
+                    enqueued_at
+                )).lastrowid
+                job_id = self.add_next_sweep_point(conn, sweep_id)
+                if key is not None:
+                    # The key stays with the sweep's entry, which keeps its
+                    # ID until the whole sweep has been submitted.
+                    self.add_submission_key(conn, key, job_id, enqueued_at)
+            if not deferred:
+                self.check_impl(conn)
+        return sweep_id
+
+    def add_next_sweep_point(self, conn, sweep_id, job_id=None):
+        # Add the sweep's next point to the buffer, with the given job ID if
+        # it is replacing a point that was just dispatched. Delete the sweep
+        # once all of its points have been added.
+        name, args_json, cwd_id, queues_json, axes_json, size, index, group, enqueued_at = conn.execute('''\
+select "name", "args_json", "cwd_id", "queues_json", "axes_json", "size", "next_index", "group", "enqueued_at"
+from "sweeps"
+where "id" = ?
+''', (sweep_id,)).fetchone()
+        if index >= size:
+            conn.execute('''\
+delete from "sweeps" where "id" = ?
+''', (sweep_id,))
+            return
+        point = get_point(json.loads(axes_json), index)
+        args = [fill_template(arg, point) for arg in json.loads(args_json)]
+        prefix, suffix = self.backend.split_command(args)
+        prefix_id = self.intern_value(conn, 'command_prefixes', 'args_json', encode_json(prefix))
+        job_id = conn.execute('''\
+insert into "jobs"("id", "name", "prefix_id", "suffix_json", "cwd_id", "group", "enqueued_at", "sweep_id", "sweep_index")
+values (?, ?, ?, ?, ?, ?, ?, ?, ?)
+''', (
+            job_id,
+            fill_template(name, point),
+            prefix_id,
+            encode_json(suffix),
+            cwd_id,
+            group,
+            enqueued_at,
+            sweep_id,
+            index
+        )).lastrowid
+        conn.executemany('''\
+insert into "job_queues"("job_id", "queue")
+values (?, ?)
+''', [(job_id, queue) for queue in json.loads(queues_json)])
+        conn.execute('''\
+update "sweeps"
+set "next_index" = "next_index" + 1
+where "id" = ?
+''', (sweep_id,))
+        return job_id
+
+    def has_submission_key(self, conn, key):
+        return conn.execute('''\
+select 1 from "submission_keys" where "key" = ?
+''', (key,)).fetchone() is not None
+
+    def add_submission_key(self, conn, key, local_id, time):
+        conn.execute('''\
+insert into "submission_keys"("key", "local_id", "time")
+values (?, ?, ?)
+''', (key, local_id, time))
+
+    def update_submission_key(self, conn, local_id, job_id):
+        # Once a job is submitted, its key refers to the backend job. A
+        # sweep's key stays with its entry until the last point is gone.
+        conn.execute('''\
+update "submission_keys"
+set
+  "job_id" = ?,
+  "time" = ?,
+  "local_id" = case
+    when exists (select 1 from "jobs" where "id" = "submission_keys"."local_id") then "local_id"
+    else null
+  end
+where "local_id" = ?
+''', (job_id, self.backend.get_current_time().timestamp(), local_id))
+
+    def prune_submission_keys(self, conn):
+        conn.execute('''\
+delete from "submission_keys"
+where "local_id" is null and "time" < ?
+''', (self.backend.get_current_time().timestamp() - SUBMISSION_KEY_LIFETIME,))
+
+    def prune_job_events(self, conn):
+        # Keep the events of jobs that are still in the snapshot, however
+        # old, since qf wait and run times depend on them.
+        conn.execute('''\
+delete from "job_events"
+where
+  "time" < ? and
+  not exists (select 1 from "snapshot_jobs" where "id" = "job_events"."job_id")
+''', (self.backend.get_current_time().timestamp() - JOB_EVENT_HISTORY,))
+
+    def iter_sweep_points(self, job):
+        # Yield a job for each of the points of a sweep that have not been
+        # dispatched yet, given the sweep's entry in the buffer. Only the
+        # first one exists in the buffer; the rest are generated here.
+        yield dataclasses.replace(job, name=job.sweep.next_name, sweep=None)
+        with self.get_db_connection() as conn, self.read_db(conn):
+            row = conn.execute('''\
+select "name", "axes_json", "size", "next_index"
+from "sweeps"
+where "id" = ?
+''', (job.sweep.id,)).fetchone()
+        if row is None:
+            return
+        name, axes_json, size, next_index = row
+        axes = json.loads(axes_json)
+        for index in range(next_index, size):
+            yield dataclasses.replace(
+                job,
+                id='',
+                name=fill_template(name, get_point(axes, index)),
+                local_id=None,
+                sweep=None
+            )
+
+    def expand_sweeps(self, jobs):
+        for job in jobs:
+            if job.sweep is not None:
+                yield from self.iter_sweep_points(job)
+            else:
+                yield job
+
+    def list_queue_jobs(self, queue, job_filter=None):
+        # Query the backend before opening a read transaction so that the
+        # transaction stays short.
+        backend_jobs = self.get_queue_backend_jobs(queue)
+        own_user = self.backend.get_own_user()
+        taken = sum(job.slots for job in backend_jobs if job.user == own_user)
+        with self.get_db_connection() as conn, self.read_db(conn):
+            self.add_backend_job_groups(conn, backend_jobs)
+            local_jobs = list(self.get_local_jobs(conn, self.select_local_jobs(conn, queue, job_filter)))
             row = conn.execute('''\
 select "value" from "limits" where "queue" = ?
 ''', (queue,)).fetchone()
@@ -87,22 +316,19 @@ select "value" from "limits" where "queue" = ?
             else:
                 limit = None
         if job_filter is not None:
-            jobs = list(job_filter.filter_jobs(jobs))
+            backend_jobs = job_filter.filter_jobs(backend_jobs)
+        jobs = [*backend_jobs, *local_jobs]
         return ListQueueInfo(jobs, Capacity(taken, limit))
 
     def list_own_jobs(self, job_filter=None):
         with self.get_db_connection() as conn:
-            own_backend_jobs = self.backend.get_own_jobs()
-            rows = conn.execute('''\
-select "id", "name" from "jobs" order by "id" asc
-''').fetchall()
-            local_jobs = self.get_local_jobs(conn, rows)
-            jobs = [*own_backend_jobs, *local_jobs]
-            rows = conn.execute('''\
+            with self.read_db(conn):
+                rows = conn.execute('''\
 select "queue", "value"
 from "limits"
 order by "queue" asc
 ''').fetchall()
+            own_backend_jobs = self.backend.get_own_jobs()
             pending_jobs = collections.defaultdict(list)
             for job in own_backend_jobs:
                 if job.state == 'qw':
@@ -115,96 +341,457 @@ order by "queue" asc
                 )
                 taken = sum(job.slots for job in queue_jobs)
                 queues.append((queue, Capacity(taken, limit)))
-        if job_filter is not None:
-            jobs = list(job_filter.filter_jobs(jobs))
+            backend_jobs, backend_job_filter = self.get_own_backend_jobs(job_filter, own_backend_jobs)
+            with self.read_db(conn):
+                self.add_backend_job_groups(conn, backend_jobs)
+                local_jobs = list(self.get_local_jobs(conn, self.select_local_jobs(conn, None, job_filter)))
+        if backend_job_filter is not None:
+            backend_jobs = backend_job_filter.filter_jobs(backend_jobs)
+        jobs = [*backend_jobs, *local_jobs]
         return ListOwnInfo(jobs, queues)
 
+    def iter_own_jobs(self, job_filter=None, offset=None, limit=None):
+        # Unlike list_own_jobs(), this streams locally buffered jobs from the
+        # database one at a time, and it does not compute queue capacities.
+        backend_jobs, backend_job_filter = self.get_own_backend_jobs(job_filter)
+        return self.iter_jobs_impl(backend_jobs, backend_job_filter, None, job_filter, offset, limit)
+
+    def iter_queue_jobs(self, queue, job_filter=None, offset=None, limit=None):
+        backend_jobs = self.get_queue_backend_jobs(queue)
+        return self.iter_jobs_impl(backend_jobs, job_filter, queue, job_filter, offset, limit)
+
+    def iter_jobs_impl(self, backend_jobs, backend_job_filter, queue, job_filter, offset, limit):
+        # Nothing is yielded while a transaction is open, since the consumer
+        # may take arbitrarily long (e.g. a pager), and in rollback journal
+        # mode an open read transaction blocks the dispatcher's commits.
+        with self.get_db_connection() as conn:
+            with self.read_db(conn):
+                self.add_backend_job_groups(conn, backend_jobs)
+            if backend_job_filter is not None:
+                backend_jobs = list(backend_job_filter.filter_jobs(backend_jobs))
+            yield from paginate(backend_jobs, offset, limit)
+            # Page through the buffered jobs in SQL, after accounting for the
+            # backend jobs that came before them.
+            if offset is None:
+                offset = 0
+            num_listed = max(0, min(len(backend_jobs) - offset, limit if limit is not None else math.inf))
+            local_offset = max(0, offset - len(backend_jobs))
+            local_limit = limit - num_listed if limit is not None else math.inf
+            # Read one page at a time in its own transaction, resuming after
+            # the last ID seen rather than using an offset, so that each page
+            # is cheap to find.
+            after_id = None
+            while local_limit > 0:
+                page_size = min(LIST_PAGE_SIZE, local_limit)
+                with self.read_db(conn):
+                    rows = self.select_local_jobs(conn, queue, job_filter, local_offset, page_size, after_id).fetchall()
+                    jobs = list(self.get_local_jobs(conn, rows))
+                yield from jobs
+                if len(rows) < page_size:
+                    break
+                after_id = rows[-1][0]
+                local_offset = 0
+                local_limit -= len(rows)
+
+    def count_own_jobs(self, job_filter=None):
+        backend_jobs, backend_job_filter = self.get_own_backend_jobs(job_filter)
+        return self.count_jobs_impl(backend_jobs, backend_job_filter, None, job_filter)
+
+    def count_queue_jobs(self, queue, job_filter=None):
+        backend_jobs = self.get_queue_backend_jobs(queue)
+        return self.count_jobs_impl(backend_jobs, job_filter, queue, job_filter)
+
+    def count_jobs_impl(self, backend_jobs, backend_job_filter, queue, job_filter):
+        with self.get_db_connection() as conn, self.read_db(conn):
+            if backend_job_filter is not None and backend_job_filter.group is not None:
+                self.add_backend_job_groups(conn, backend_jobs)
+            condition, params = self.get_local_job_condition(queue, job_filter)
+            local_count, = conn.execute(f'''\
+select coalesce(sum({LOCAL_JOB_COUNT}), 0)
+from "jobs"
+where {condition}
+''', params).fetchone()
+        if backend_job_filter is not None:
+            backend_jobs = backend_job_filter.filter_jobs(backend_jobs)
+        return sum(1 for job in backend_jobs) + local_count
+
     def check(self):
         with self.get_db_connection() as conn:
             self.check_impl(conn)
 
-    def watch(self, seconds, stdout=sys.stdout, stderr=sys.stderr):
-        while True:
-            self.log_message('checking...', stdout)
-            try:
-                self.check()
-            except Exception as e:
-                print(traceback.format_exc(), end='', file=stderr)
-            self.log_message('...done', stdout)
-            time.sleep(seconds)
+    def watch(self, seconds, stdout=sys.stdout, stderr=sys.stderr, lease_seconds=None):
+        # Only one daemon dispatches jobs at a time. It holds a lease in the
+        # database that it renews on every cycle, while any others stand by
+        # and take over once the lease expires.
+        if lease_seconds is None:
+            lease_seconds = 3 * seconds
+        holder = self.backend.get_daemon_id()
+        is_leader = False
+        # Keep one connection open for the lifetime of the daemon rather than
+        # reconnecting on every cycle.
+        conn = None
+        try:
+            while True:
+                try:
+                    if conn is None:
+                        conn = self.open_db_connection()
+                    was_leader = is_leader
+                    is_leader = False
+                    lease = self.renew_lease(conn, holder, lease_seconds)
+                    is_leader = lease.holder == holder
+                    if is_leader:
+                        if not was_leader:
+                            self.log_message(f'acquired leadership as {holder}', stdout)
+                        self.log_message('checking...', stdout)
+                        # A cycle may outlast the lease, so it is renewed in
+                        # between the steps that can take a while.
+                        lease = (holder, lease_seconds)
+                        try:
+                            self.check_impl(conn, lease)
+                            self.ingest_accounting(conn, stderr, lease)
+                        except LeaseLostError as e:
+                            is_leader = False
+                            self.log_message(f'lost leadership to {e.holder}', stdout)
+                        finally:
+                            self.store.sync(conn)
+                        if is_leader:
+                            self.log_message('...done', stdout)
+                    else:
+                        self.log_message(f'standing by; {lease.holder} is the leader', stdout)
+                except Exception as e:
+                    print(traceback.format_exc(), end='', file=stderr)
+                    # The connection may be in a bad state, so replace it on
+                    # the next cycle.
+                    if conn is not None:
+                        conn.close()
+                        conn = None
+                time.sleep(seconds)
+        finally:
+            if conn is not None:
+                try:
+                    if is_leader:
+                        self.release_lease(conn, holder)
+                finally:
+                    conn.close()
+
+    def wait(self, job_ids=None, job_filter=None, timeout=None, seconds=None,
+            stderr=sys.stderr):
+        # Wait for jobs to finish by reading what the daemon has recorded in
+        # the database, rather than querying the backend, so that waiting
+        # costs the scheduler nothing no matter how many processes do it.
+        if seconds is None:
+            seconds = WAIT_INTERVAL
+        if job_ids is not None:
+            backend_ids, local_ids = self.parse_job_ids(job_ids)
+        else:
+            backend_ids, local_ids = [], []
+        start = time.monotonic()
+        conn = self.open_db_connection()
+        try:
+            with self.read_db(conn):
+                lease = self.get_lease(conn)
+            if lease is None or lease.expires_at <= self.backend.get_current_time():
+                self.log_message(
+                    'warning: no daemon is running `qf watch`, so jobs will '
+                    'only be tracked when `qf check` is run',
+                    stderr)
+            while True:
+                with self.read_db(conn):
+                    jobs = self.get_waited_jobs(conn, backend_ids, local_ids, job_filter)
+                result = WaitResult(
+                    remaining=[job for job in jobs if not is_error_state(job.state)],
+                    failed=[job for job in jobs if is_error_state(job.state)]
+                )
+                if not result.remaining:
+                    return result
+                if timeout is not None:
+                    time_left = timeout - (time.monotonic() - start)
+                    if time_left <= 0:
+                        result.timed_out = True
+                        return result
+                    time.sleep(min(seconds, time_left))
+                else:
+                    time.sleep(seconds)
+        finally:
+            conn.close()
+
+    def get_waited_jobs(self, conn, backend_ids, local_ids, job_filter):
+        # Return the selected jobs that are locally buffered or in the last
+        # snapshot. Jobs selected by local ID are followed into the backend
+        # through their "submitted" events.
+        jobs = collections.OrderedDict()
+        selected_ids = set(backend_ids)
+        for chunk in chunk_list(local_ids, DELETE_CHUNK_SIZE):
+            placeholders = ', '.join('?' for job_id in chunk)
+            rows = conn.execute(f'''\
+select "id", "name", "group", "enqueued_at", "sweep_id"
+from "jobs"
+where "id" in ({placeholders})
+order by "id" asc
+''', chunk).fetchall()
+            for job in self.get_local_jobs(conn, rows):
+                jobs[job.id] = job
+            # A sweep's entry keeps its ID as each of its points is
+            # submitted, so this follows all of them. Since IDs of locally
+            # buffered jobs can be reused, this may also select an older
+            # job, but only while it is still running.
+            selected_ids.update(job_id for job_id, in conn.execute(f'''\
+select "job_id"
+from "job_events"
+where "event" = 'submitted' and "local_id" in ({placeholders}) and "job_id" is not null
+''', chunk))
+        if job_filter is not None:
+            for job in self.get_local_jobs(conn, self.select_local_jobs(conn, job_filter=job_filter)):
+                jobs[job.id] = job
+        user = self.backend.get_own_user()
+        for job_id, name, slots, state, queue, since, group in conn.execute('''\
+select "id", "name", "slots", "state", "queue", "since", "group"
+from "snapshot_jobs"
+order by "id" asc
+'''):
+            job = Job(
+                id=job_id,
+                user=user,
+                name=name,
+                slots=slots,
+                state=state,
+                queue=queue,
+                since=datetime.datetime.fromisoformat(since) if since is not None else None,
+                group=group
+            )
+            if job_id in selected_ids or (job_filter is not None and job_filter.matches_job(job)):
+                jobs[job.id] = job
+        return list(jobs.values())
+
+    def renew_lease(self, conn, holder, lease_seconds):
+        # Take or renew the lease if it is free, expired, or already ours.
+        # Return the lease as it stands afterward.
+        now = self.backend.get_current_time().timestamp()
+        with self.lock_db(conn):
+            lease = self.get_lease(conn)
+            if lease is None or lease.holder == holder or lease.expires_at.timestamp() <= now:
+                if lease is None or lease.holder != holder:
+                    acquired_at = now
+                else:
+                    acquired_at = lease.acquired_at.timestamp()
+                conn.execute('''\
+insert or replace into "leader_lease"("id", "holder", "acquired_at", "heartbeat", "expires_at")
+values (1, ?, ?, ?, ?)
+''', (holder, acquired_at, now, now + lease_seconds))
+                lease = self.get_lease(conn)
+        return lease
+
+    def keep_lease(self, conn, lease):
+        # Renew a lease given as a holder and a duration, or raise
+        # LeaseLostError if another daemon has taken it over. Do nothing if
+        # there is no lease.
+        if lease is not None:
+            holder, lease_seconds = lease
+            current_lease = self.renew_lease(conn, holder, lease_seconds)
+            if current_lease.holder != holder:
+                raise LeaseLostError(current_lease.holder)
+
+    def release_lease(self, conn, holder):
+        with self.lock_db(conn):
+            conn.execute('''\
+delete from "leader_lease"
+where "holder" = ?
+''', (holder,))
+
+    def get_lease(self, conn):
+        row = conn.execute('''\
+select "holder", "acquired_at", "heartbeat", "expires_at"
+from "leader_lease"
+''').fetchone()
+        if row is not None:
+            holder, *times = row
+            return LeaderLease(holder, *(datetime.datetime.fromtimestamp(t) for t in times))
+        else:
+            return None
 
     def delete(self, job_ids):
         backend_jobs, local_jobs = self.parse_job_ids(job_ids)
+        num_local_jobs = 0
         if local_jobs:
             with self.get_db_connection() as conn:
                 with self.lock_db(conn):
-                    for job_id in local_jobs:
-                        self.delete_local_job(conn, job_id)
-        if backend_jobs:
-            self.backend.delete_jobs(backend_jobs)
+                    # Stay well below SQLite's limit on the number of
+                    # parameters in a statement.
+                    for chunk in chunk_list(local_jobs, DELETE_CHUNK_SIZE):
+                        placeholders = ', '.join('?' for job_id in chunk)
+                        num_local_jobs += self.delete_local_jobs_where(
+                            conn, f'"jobs"."id" in ({placeholders})', chunk)
+                    self.prune_interned_values(conn)
+        return self.delete_backend_jobs(backend_jobs, num_local_jobs)
+
+    def delete_matching(self, job_filter, local_only=False):
+        if local_only:
+            backend_jobs = []
+        else:
+            backend_jobs, backend_job_filter = self.get_own_backend_jobs(job_filter)
+        with self.get_db_connection() as conn:
+            with self.lock_db(conn):
+                condition, params = job_filter.get_sql_condition()
+                num_local_jobs = self.delete_local_jobs_where(conn, condition, params)
+                self.prune_interned_values(conn)
+            if backend_jobs:
+                with self.read_db(conn):
+                    self.add_backend_job_groups(conn, backend_jobs)
+        if backend_jobs and backend_job_filter is not None:
+            backend_jobs = backend_job_filter.filter_jobs(backend_jobs)
+        return self.delete_backend_jobs([job.id for job in backend_jobs], num_local_jobs)
+
+    def delete_backend_jobs(self, job_ids, num_local_jobs):
+        # Cancel jobs in chunks so that a single command line does not get
+        # too long, and so that one bad chunk does not stop the others.
+        result = DeleteResult(num_local_jobs, [], [])
+        for chunk in chunk_list(job_ids, DELETE_CHUNK_SIZE):
+            try:
+                self.backend.delete_jobs(chunk)
+            except BackendError as e:
+                result.failures.append(DeleteFailure(chunk, str(e)))
+            else:
+                result.backend_jobs.extend(chunk)
+        if result.backend_jobs:
+            # Canceled jobs may be submitted again with the same keys.
+            with self.get_db_connection() as conn, self.lock_db(conn):
+                for chunk in chunk_list(result.backend_jobs, DELETE_CHUNK_SIZE):
+                    placeholders = ', '.join('?' for job_id in chunk)
+                    conn.execute(f'''\
+delete from "submission_keys"
+where "job_id" in ({placeholders}) and "local_id" is null
+''', chunk)
+        return result
 
     def bump(self, job_filter):
         with self.get_db_connection() as conn:
             with self.lock_db(conn):
                 conn.execute('pragma defer_foreign_keys = ON')
-                rows = conn.execute('''\
-select "id", "name" from "jobs" order by "id" asc
-''').fetchall()
-                all_jobs = self.get_local_jobs(conn, rows)
-                selected_jobs = []
-                unselected_jobs = []
-                for job in all_jobs:
-                    if job_filter.matches_job(job):
-                        selected_jobs.append(job)
-                    else:
-                        unselected_jobs.append(job)
-                max_selected_id = max(job.local_id for job in selected_jobs) if selected_jobs else -math.inf
-                min_unselected_id = min(job.local_id for job in unselected_jobs) if unselected_jobs else math.inf
-                if max_selected_id < min_unselected_id:
+                condition, params = job_filter.get_sql_condition()
+                max_selected_id, = conn.execute(f'''\
+select max("id") from "jobs" where {condition}
+''', params).fetchone()
+                min_unselected_id, = conn.execute(f'''\
+select min("id") from "jobs" where not ({condition})
+''', params).fetchone()
+                if (
+                    max_selected_id is None or
+                    min_unselected_id is None or
+                    max_selected_id < min_unselected_id
+                ):
                     # Do nothing; the jobs are already in the correct order.
                     pass
                 else:
                     offset = max_selected_id + 1 - min_unselected_id
-                    for job in reversed(unselected_jobs):
-                        new_id = job.local_id + offset
-                        conn.execute('''\
-update "jobs"
-set "id" = ?
-where "id" = ?
-''', (new_id, job.local_id))
-                        # TODO It might be better to use ON UPDATE CASCADE.
-                        conn.execute('''\
+                    conn.execute('drop table if exists temp."bumped_jobs"')
+                    conn.execute(f'''\
+create temp table "bumped_jobs" as
+select "id" from "jobs" where not ({condition})
+''', params)
+                    # Move the unselected jobs back in two steps, through
+                    # negative IDs, so that no two jobs ever share an ID.
+                    # TODO It might be better to use ON UPDATE CASCADE.
+                    conn.execute('''\
 update "job_queues"
-set "job_id" = ?
-where "job_id" = ?
-''', (new_id, job.local_id))
+set "job_id" = -("job_id" + ?)
+where "job_id" in (select "id" from temp."bumped_jobs")
+''', (offset,))
+                    conn.execute('''\
+update "submission_keys"
+set "local_id" = -("local_id" + ?)
+where "local_id" in (select "id" from temp."bumped_jobs")
+''', (offset,))
+                    conn.execute('''\
+update "jobs"
+set "id" = -("id" + ?)
+where "id" in (select "id" from temp."bumped_jobs")
+''', (offset,))
+                    conn.execute('''\
+update "job_queues" set "job_id" = -"job_id" where "job_id" < 0
+''')
+                    conn.execute('''\
+update "submission_keys" set "local_id" = -"local_id" where "local_id" < 0
+''')
+                    conn.execute('''\
+update "jobs" set "id" = -"id" where "id" < 0
+''')
+                    conn.execute('drop table temp."bumped_jobs"')
 
     @contextlib.contextmanager
     def get_db_connection(self):
-        conn = self.backend.connect_to_db()
+        conn = self.open_db_connection()
         try:
-            conn.execute('pragma foreign_keys = ON')
-            with self.lock_db(conn):
-                self.ensure_db_initialized(conn)
             yield conn
+            self.store.sync(conn)
         finally:
             conn.close()
 
-    def ensure_db_initialized(self, conn):
+    def open_db_connection(self):
+        conn = self.store.connect()
         try:
-            conn.execute('select "value" from "limits" limit 1')
-        except sqlite3.OperationalError as e:
-            if e.args[0] == 'no such table: limits':
-                self.initialize_db(conn)
-            else:
-                raise
+            conn.create_function('regexp', 2, sqlite_regexp)
+            self.set_journal_mode(conn)
+            # Foreign keys are enabled only after migrating, since migrations
+            # may need to rebuild tables that other tables refer to.
+            self.ensure_db_initialized(conn)
+            conn.execute('pragma foreign_keys = ON')
+        except:
+            conn.close()
+            raise
+        return conn
+
+    def set_journal_mode(self, conn):
+        # In WAL mode, readers do not wait for the writer that is holding the
+        # lock while it runs qstat and qsub. WAL relies on shared memory,
+        # which network filesystems like AFS do not support, so fall back to
+        # the default rollback journal on those.
+        if self.store.supports_wal():
+            try:
+                mode, = conn.execute('pragma journal_mode = wal').fetchone()
+                # Some filesystems only fail once the shared-memory index is
+                # actually used.
+                conn.execute('select count(*) from "sqlite_master"').fetchone()
+            except sqlite3.OperationalError:
+                mode = None
+            if mode == 'wal':
+                return
+        mode, = conn.execute('pragma journal_mode').fetchone()
+        if mode == 'wal':
+            conn.execute('pragma journal_mode = delete')
+
+    def ensure_db_initialized(self, conn):
+        # Check the schema version without taking the write lock, so that
+        # readers do not wait on the dispatcher in the common case.
+        with self.read_db(conn):
+            version, = conn.execute('pragma user_version').fetchone()
+        if version != len(get_migration_files()):
+            with self.lock_db(conn):
+                try:
+                    conn.execute('select "value" from "limits" limit 1')
+                except sqlite3.OperationalError as e:
+                    if e.args[0] == 'no such table: limits':
+                        self.initialize_db(conn)
+                    else:
+                        raise
+                self.migrate_db(conn)
 
     def initialize_db(self, conn):
-        conn.executescript(TABLES_FILE.read_text())
+        execute_script(conn, TABLES_FILE.read_text())
+
+    def migrate_db(self, conn):
+        # The user_version pragma records how many migrations have been
+        # applied. Databases created before migrations existed have version 0.
+        version, = conn.execute('pragma user_version').fetchone()
+        for new_version, migration_file in enumerate(get_migration_files(), 1):
+            if new_version > version:
+                execute_script(conn, migration_file.read_text())
+                conn.execute(f'pragma user_version = {new_version}')
 
     @contextlib.contextmanager
     def lock_db(self, conn):
-        conn.execute('begin exclusive')
+        # An immediate transaction excludes other writers but, unlike an
+        # exclusive one, still lets readers in until it commits.
+        conn.execute('begin immediate')
         try:
             yield
         except:
@@ -213,64 +800,714 @@ where "job_id" = ?
         else:
             conn.commit()
 
-    def check_impl(self, conn):
-        while self.try_dequeue_one(conn):
-            pass
+    @contextlib.contextmanager
+    def read_db(self, conn):
+        conn.execute('begin deferred')
+        try:
+            yield
+        except:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    def check_impl(self, conn, lease=None):
+        # Query the backend before taking the write lock, since queries may
+        # have to wait for the rate limit, and other users' demand may take a
+        # query per queue to find out.
+        with self.read_db(conn):
+            adaptive_queues = [
+                queue
+                for queue, limit in self.get_limits(conn).items()
+                if limit.floor is not None
+            ]
+        if adaptive_queues:
+            occupancy = self.backend.get_other_users_occupancy(adaptive_queues)
+        else:
+            occupancy = {}
+        now = self.backend.get_current_time()
+        jobs = self.backend.get_own_jobs()
+        job_queues = self.resolve_job_queues(conn, jobs)
+        with self.lock_db(conn):
+            self.update_snapshot(conn, now, jobs, job_queues)
+            self.update_adaptive_limits(conn, occupancy)
+        while True:
+            # Wait for the backend's permission to submit before taking the
+            # write lock, so that other commands are not kept waiting too,
+            # but only if there is a job to submit.
+            with self.read_db(conn):
+                if self.select_next_job(conn) is None:
+                    break
+            self.backend.reserve_submission()
+            self.keep_lease(conn, lease)
+            if not self.try_dequeue_one(conn):
+                break
+        with self.lock_db(conn):
+            self.prune_interned_values(conn)
+            self.prune_submission_keys(conn)
+            self.prune_job_events(conn)
 
     def try_dequeue_one(self, conn):
         with self.lock_db(conn):
-            # The "id" of the "job" table determines the priority of each
-            # locally buffered job. Using min() on "id" ensures that all the
-            # other columns are for the highest-priority job for each queue.
-            # (This is a special case in SQLite.)
-            # The rowid of "job_queues" determines the order in which to test
-            # queues for the same job.
-            rows = conn.execute('''\
+            row = self.select_next_job(conn)
+            if row is None:
+                return False
+            queue, job_id, name, prefix_json, suffix_json, cwd, group, sweep_id = row
+            args = [*json.loads(prefix_json), *json.loads(suffix_json)]
+            self.delete_local_job(conn, job_id)
+            if sweep_id is not None:
+                self.add_next_sweep_point(conn, sweep_id, job_id)
+            backend_job_id = self.backend.submit_job(queue, name, args, cwd)
+            self.record_submitted_job(conn, backend_job_id, name, queue, group, job_id)
+            self.update_submission_key(conn, job_id, backend_job_id)
+            return True
+
+    def select_next_job(self, conn):
+        # Return the highest-priority buffered job that can be submitted to
+        # a queue with open slots, along with that queue, or None.
+        # The "id" of the "job" table determines the priority of each
+        # locally buffered job. Using min() on "id" ensures that all the
+        # other columns are for the highest-priority job for each queue.
+        # (This is a special case in SQLite.)
+        # The rowid of "job_queues" determines the order in which to test
+        # queues for the same job.
+        limits = self.get_limits(conn)
+        rows = conn.execute('''\
 select
   "job_queues"."queue" as "queue",
-  (
-    select "value"
-    from "limits"
-    where "limits"."queue" = "job_queues"."queue"
-  ) as "limit",
   min("jobs"."id") as "job_id",
   "jobs"."name" as "name",
-  "jobs"."command_json" as "command_json",
-  "jobs"."cwd" as "cwd"
+  "command_prefixes"."args_json" as "prefix_json",
+  "jobs"."suffix_json" as "suffix_json",
+  "cwds"."path" as "cwd",
+  "jobs"."group" as "group",
+  "jobs"."sweep_id" as "sweep_id"
 from "job_queues"
   join "jobs" on "job_queues"."job_id" = "jobs"."id"
+  join "command_prefixes" on "jobs"."prefix_id" = "command_prefixes"."id"
+  join "cwds" on "jobs"."cwd_id" = "cwds"."id"
 group by "job_queues"."queue"
 order by "jobs"."id", "job_queues".rowid asc
 ''').fetchall()
-            for queue, limit, job_id, name, command_json, cwd in rows:
-                if limit is None or self.queue_has_open_slots(queue, limit):
-                    args = json.loads(command_json)
-                    self.delete_local_job(conn, job_id)
-                    self.backend.submit_job(queue, name, args, cwd)
-                    return True
-        return False
+        for row in rows:
+            queue = row[0]
+            limit = limits.get(queue)
+            if limit is None or self.queue_has_open_slots(conn, queue, limit):
+                return row
+        return None
 
-    def queue_has_open_slots(self, queue, limit):
-        slots = 0
-        if slots >= limit:
-            return False
-        for job in self.enumerate_own_backend_jobs_in_queue(queue):
-            slots += job.slots
-            if slots >= limit:
-                return False
-        return True
+    def queue_has_open_slots(self, conn, queue, limit):
+        # Occupancy is read from the snapshot, which every dispatcher updates
+        # when it submits a job, so this does not need to call qstat.
+        running, pending = conn.execute('''\
+select
+  coalesce(sum(case when instr("state", 'q') = 0 then "slots" end), 0),
+  coalesce(sum(case when instr("state", 'q') > 0 then "slots" end), 0)
+from "snapshot_jobs"
+where "queue" = ?
+''', (queue,)).fetchone()
+        taken = running + pending
+        if taken < limit.value:
+            return True
+        # Beyond the limit, keep up to the pending headroom's worth of jobs
+        # waiting in the backend, so that it can start them as soon as
+        # running jobs finish.
+        headroom = limit.pending if limit.pending is not None else 0
+        return pending < headroom and taken < limit.value + headroom
 
-    def enumerate_own_backend_jobs_in_queue(self, queue):
-        # Query the pending jobs before querying the running jobs to avoid
-        # a race condition where a pending job becomes a running job in
-        # between queries.
-        pending_jobs = (
-            job
-            for job in self.backend.get_own_pending_jobs()
-            if job.queue == queue
+    def get_limits(self, conn, include_next_change=False):
+        # Return the limit that applies to each limited queue right now,
+        # taking any schedules and adaptive limits into account.
+        now = self.backend.get_current_time()
+        schedules_by_queue = collections.defaultdict(list)
+        for schedule in self.get_schedules(conn):
+            schedules_by_queue[schedule.queue].append(schedule)
+        adaptive_values = dict(conn.execute('''\
+select "queue", "value"
+from "adaptive_limits"
+''').fetchall())
+        result = collections.OrderedDict()
+        for queue, value, pending, floor in conn.execute('''\
+select "queue", "value", "pending", "floor"
+from "limits"
+order by "queue" asc
+''').fetchall():
+            base_limit = Limit(queue, value, pending)
+            schedules = schedules_by_queue.get(queue, [])
+            limit = get_scheduled_limit(base_limit, schedules, now)
+            if include_next_change:
+                limit.next_change = get_next_limit_change(base_limit, schedules, now)
+            if floor is not None:
+                # The scheduled limit is the ceiling of the adaptive one.
+                limit.ceiling = limit.value
+                limit.floor = min(floor, limit.ceiling)
+                adaptive_value = adaptive_values.get(queue)
+                if adaptive_value is not None:
+                    limit.value = min(max(adaptive_value, limit.floor), limit.ceiling)
+            result[queue] = limit
+        return result
+
+    def update_adaptive_limits(self, conn, occupancy):
+        # Scale each adaptive limit between its floor and ceiling according
+        # to how much of other users' demand on the queue is still waiting.
+        # occupancy maps queues to the slots that other users' jobs are
+        # running and pending in them.
+        now = self.backend.get_current_time()
+        previous_values = dict(conn.execute('''\
+select "queue", "value"
+from "adaptive_limits"
+''').fetchall())
+        for queue, limit in self.get_limits(conn).items():
+            # Skip limits that became adaptive after occupancy was read.
+            if limit.floor is None or queue not in occupancy:
+                continue
+            others_running, others_pending = occupancy[queue]
+            value = get_adaptive_limit(
+                limit.floor,
+                limit.ceiling,
+                others_running,
+                others_pending,
+                previous_values.get(queue)
+            )
+            conn.execute('''\
+insert or replace into "adaptive_limits"("queue", "value", "others_running", "others_pending", "time")
+values (?, ?, ?, ?, ?)
+''', (queue, value, others_running, others_pending, now.timestamp()))
+
+    def get_schedules(self, conn):
+        return [
+            LimitSchedule(*row)
+            for row in conn.execute('''\
+select "id", "queue", "days", "start", "end", "value", "pending"
+from "limit_schedules"
+order by "id" asc
+''')
+        ]
+
+    def resolve_job_queues(self, conn, jobs):
+        # Running jobs only report the queue instance they are running on,
+        # so find out which limited queue they belong to by querying each
+        # one. This only happens for jobs that started running without first
+        # showing up as pending in a snapshot. Return the limited queue of
+        # each job that was found.
+        with self.read_db(conn):
+            resolved_ids = {
+                job_id
+                for job_id, in conn.execute('''\
+select "id" from "snapshot_jobs" where "resolved"
+''')
+            }
+            queues = [
+                queue
+                for queue, in conn.execute('''\
+select "queue" from "limits" order by "queue" asc
+''')
+            ]
+        unresolved_ids = {
+            job.id
+            for job in jobs
+            if not is_pending_state(job.state) and job.id not in resolved_ids
+        }
+        job_queues = {}
+        if unresolved_ids:
+            for queue in queues:
+                for job in self.backend.get_own_running_jobs_in_queue(queue):
+                    if job.id in unresolved_ids:
+                        unresolved_ids.remove(job.id)
+                        job_queues[job.id] = queue
+                if not unresolved_ids:
+                    break
+        return job_queues
+
+    def update_snapshot(self, conn, now, jobs, job_queues):
+        # Save a new snapshot of the current user's backend jobs, listed at
+        # the given time, and log how they changed since the last snapshot.
+        # Placeholders for jobs whose IDs are unknown have served their
+        # purpose once the backend has been listed again.
+        placeholders = conn.execute('''\
+select "id", "name" from "snapshot_jobs"
+where substr("id", 1, 1) = ?
+order by length("id") asc, "id" asc
+''', (PLACEHOLDER_PREFIX,)).fetchall()
+        conn.execute('''\
+delete from "snapshot_jobs" where substr("id", 1, 1) = ?
+''', (PLACEHOLDER_PREFIX,))
+        old_jobs = {
+            row[0] : SnapshotJob(*row)
+            for row in conn.execute('''\
+select "id", "name", "slots", "state", "queue", "since", "resolved", "group"
+from "snapshot_jobs"
+''')
+        }
+        new_jobs = collections.OrderedDict()
+        for job in jobs:
+            old_job = old_jobs.get(job.id)
+            if is_pending_state(job.state):
+                # Pending jobs report the queue specifier they requested.
+                queue = job.queue
+                resolved = True
+            elif old_job is not None and old_job.resolved:
+                # Jobs that were pending in the last snapshot keep the queue
+                # they requested after they start running.
+                queue = old_job.queue
+            else:
+                queue = job_queues.get(job.id)
+            new_jobs[job.id] = SnapshotJob(
+                id=job.id,
+                name=job.name,
+                slots=job.slots,
+                state=job.state,
+                queue=queue,
+                since=job.since.isoformat() if job.since is not None else None,
+                resolved=True,
+                group=old_job.group if old_job is not None else None
+            )
+        if placeholders:
+            # Each placeholder's job is the first new job with the same name,
+            # if it has not finished already. Point the events logged under
+            # the placeholder at it, so that qf wait can follow it.
+            claimed_ids = set()
+            for placeholder_id, name in placeholders:
+                job_id = next((
+                    job.id
+                    for job in new_jobs.values()
+                    if job.name == name and job.id not in old_jobs and job.id not in claimed_ids
+                ), None)
+                claimed_ids.add(job_id)
+                conn.execute('''\
+update "job_events"
+set "job_id" = ?
+where "job_id" = ?
+''', (job_id, placeholder_id))
+        events = []
+        for job in new_jobs.values():
+            old_job = old_jobs.get(job.id)
+            if old_job is None:
+                if is_pending_state(job.state):
+                    events.append((job, 'queued'))
+                else:
+                    events.append((job, 'started'))
+            elif is_pending_state(old_job.state) and not is_pending_state(job.state):
+                events.append((job, 'started'))
+            if is_error_state(job.state) and (old_job is None or not is_error_state(old_job.state)):
+                events.append((job, 'error'))
+        for old_job in old_jobs.values():
+            if old_job.id not in new_jobs:
+                events.append((old_job, 'finished'))
+        self.log_job_events(conn, now, events)
+        # Only write the rows that changed.
+        conn.executemany('''\
+delete from "snapshot_jobs" where "id" = ?
+''', [
+            (old_job.id,)
+            for old_job in old_jobs.values()
+            if old_job.id not in new_jobs
+        ])
+        conn.executemany('''\
+insert or replace into "snapshot_jobs"("id", "name", "slots", "state", "queue", "since", "resolved", "group")
+values (?, ?, ?, ?, ?, ?, ?, ?)
+''', [
+            dataclasses.astuple(job)
+            for job in new_jobs.values()
+            if job != old_jobs.get(job.id)
+        ])
+        conn.execute('''\
+insert or replace into "snapshot_info"("id", "time")
+values (1, ?)
+''', (now.timestamp(),))
+
+    def record_submitted_job(self, conn, job_id, name, queue, group, local_id=None):
+        now = self.backend.get_current_time()
+        job = SnapshotJob(job_id, name, 1, 'qw', queue, now.isoformat(), True, group)
+        # Count the job against its queue until the next snapshot. Its real
+        # number of slots will only be known then. If the backend did not
+        # say what the job's ID is, count it under a placeholder ID, which
+        # the next snapshot drops, so that later dispatches in this cycle
+        # still see it.
+        # The job's events are logged under the placeholder too, until the
+        # next snapshot finds the job.
+        if job_id is None:
+            num_placeholders, = conn.execute('''\
+select count(*) from "snapshot_jobs" where substr("id", 1, 1) = ?
+''', (PLACEHOLDER_PREFIX,)).fetchone()
+            job.id = f'{PLACEHOLDER_PREFIX}{num_placeholders + 1}'
+        conn.execute('''\
+insert or replace into "snapshot_jobs"("id", "name", "slots", "state", "queue", "since", "resolved", "group")
+values (?, ?, ?, ?, ?, ?, ?, ?)
+''', dataclasses.astuple(job))
+        self.log_job_events(conn, now, [(job, 'submitted')], local_id)
+
+    def log_job_events(self, conn, time, events, local_id=None):
+        conn.executemany('''\
+insert into "job_events"("time", "job_id", "name", "queue", "event", "group", "local_id")
+values (?, ?, ?, ?, ?, ?, ?)
+''', [
+            (time.timestamp(), job.id, job.name, job.queue, event, job.group, local_id)
+            for job, event in events
+        ])
+        self.update_throughput(conn, time, events)
+
+    def update_throughput(self, conn, time, events):
+        # Add the events to the hourly totals for their queues.
+        hour = int(time.timestamp() // 3600)
+        totals = collections.defaultdict(lambda: [0, 0, 0.0])
+        for job, event in events:
+            if job.queue is None:
+                continue
+            if event == 'submitted':
+                totals[job.queue][0] += 1
+            elif event == 'finished' and not is_pending_state(job.state) and job.since is not None:
+                # For running jobs, "since" is the time the job started.
+                start_time = datetime.datetime.fromisoformat(job.since)
+                totals[job.queue][1] += 1
+                totals[job.queue][2] += (time - start_time).total_seconds()
+        conn.executemany('''\
+insert or ignore into "queue_throughput"("queue", "hour")
+values (?, ?)
+''', [(queue, hour) for queue in totals])
+        conn.executemany('''\
+update "queue_throughput"
+set
+  "dispatched" = "dispatched" + ?,
+  "completed" = "completed" + ?,
+  "runtime" = "runtime" + ?
+where "queue" = ? and "hour" = ?
+''', [
+            (dispatched, completed, runtime, queue, hour)
+            for queue, (dispatched, completed, runtime) in totals.items()
+        ])
+
+    def ingest_accounting(self, conn, stderr=sys.stderr, lease=None):
+        # Read the accounting records of finished jobs, one window of start
+        # times at a time, at most every ACCOUNTING_INTERVAL seconds. Every
+        # job that started before the last snapshot, other than the ones
+        # still running in it, has finished, so the high-water mark can
+        # safely advance up to the earliest of those without missing any
+        # records. Jobs that started after the snapshot may still be
+        # running, so it never passes the snapshot's time. So that one long
+        # job does not hold up the statistics of all the others, jobs that
+        # have been running for more than ACCOUNTING_MAX_LAG seconds are not
+        # waited for, and their records are missed.
+        now = self.backend.get_current_time().timestamp()
+        with self.read_db(conn):
+            row = conn.execute('''\
+select "high_water_mark", "time" from "accounting_info"
+''').fetchone()
+            snapshot_row = conn.execute('''\
+select "time" from "snapshot_info"
+''').fetchone()
+            if snapshot_row is None:
+                return
+            bound = snapshot_row[0] - ACCOUNTING_MARGIN
+            for since, in conn.execute('''\
+select "since"
+from "snapshot_jobs"
+where instr("state", 'q') = 0 and "since" is not null
+'''):
+                bound = min(bound, datetime.datetime.fromisoformat(since).timestamp())
+            bound = max(bound, snapshot_row[0] - ACCOUNTING_MARGIN - ACCOUNTING_MAX_LAG)
+        if row is not None:
+            high_water_mark, last_time = row
+            if now - last_time < ACCOUNTING_INTERVAL:
+                return
+        else:
+            high_water_mark = now - ACCOUNTING_HISTORY
+        for i in range(MAX_ACCOUNTING_WINDOWS):
+            if high_water_mark >= bound:
+                break
+            end = min(high_water_mark + ACCOUNTING_WINDOW, bound)
+            self.keep_lease(conn, lease)
+            try:
+                records = self.backend.get_finished_jobs(
+                    datetime.datetime.fromtimestamp(high_water_mark),
+                    datetime.datetime.fromtimestamp(end))
+            except NotImplementedError:
+                return
+            except BackendError as e:
+                # Accounting is often unavailable for a while (e.g. when its
+                # files cannot be read from this host), so report it and try
+                # again after the usual interval rather than on every cycle.
+                self.log_message(f'could not read accounting records: {e}', stderr)
+                break
+            with self.lock_db(conn):
+                self.record_finished_jobs(conn, records)
+                high_water_mark = end
+                self.set_accounting_info(conn, high_water_mark, now)
+        with self.lock_db(conn):
+            self.set_accounting_info(conn, high_water_mark, now)
+
+    def set_accounting_info(self, conn, high_water_mark, time):
+        conn.execute('''\
+insert or replace into "accounting_info"("id", "high_water_mark", "time")
+values (1, ?, ?)
+''', (high_water_mark, time))
+
+    def record_finished_jobs(self, conn, records):
+        # Windows overlap at their ends, so skip records that were already
+        # read.
+        for record in records:
+            # Prefer the queue the job was submitted to, since the scheduler
+            # reports the queue it ran in, which may not be the limited one.
+            row = conn.execute('''\
+select "queue"
+from "job_events"
+where "job_id" = ? and "event" = 'submitted' and "queue" is not null
+order by "id" desc
+limit 1
+''', (record.id,)).fetchone()
+            queue = row[0] if row is not None else record.queue
+            pattern = get_name_pattern(record.name)
+            curs = conn.execute('''\
+insert or ignore into "job_accounting"(
+  "job_id", "task_id", "name", "pattern", "queue", "start_time",
+  "end_time", "exit_status", "failed", "max_memory"
+)
+values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+''', (
+                record.id,
+                record.task_id or '',
+                record.name,
+                pattern,
+                queue,
+                record.start_time.timestamp() if record.start_time is not None else None,
+                record.end_time.timestamp(),
+                record.exit_status,
+                record.failed,
+                record.max_memory
+            ))
+            if curs.rowcount == 0:
+                continue
+            runtime = record.get_runtime()
+            conn.execute('''\
+insert or ignore into "runtime_stats"("pattern", "queue")
+values (?, ?)
+''', (pattern, queue or ''))
+            conn.execute('''\
+update "runtime_stats"
+set
+  "count" = "count" + 1,
+  "failures" = "failures" + ?,
+  "runtime" = "runtime" + coalesce(?, 0.0),
+  "max_runtime" = max(coalesce("max_runtime", ?), coalesce(?, "max_runtime")),
+  "max_memory" = max(coalesce("max_memory", ?), coalesce(?, "max_memory"))
+where "pattern" = ? and "queue" = ?
+''', (
+                int(record.failed),
+                runtime,
+                runtime, runtime,
+                record.max_memory, record.max_memory,
+                pattern, queue or ''
+            ))
+
+    def get_runtime_stats(self, name=None):
+        # Return the totals for the name patterns that match a regular
+        # expression, or all of them.
+        with self.get_db_connection() as conn, self.read_db(conn):
+            rows = conn.execute('''\
+select "pattern", "queue", "count", "failures", "runtime", "max_runtime", "max_memory"
+from "runtime_stats"
+where ? is null or "pattern" regexp ?
+order by "pattern" asc, "queue" asc
+''', (name, name)).fetchall()
+        return [
+            RuntimeStats(
+                pattern=pattern,
+                queue=queue or None,
+                count=count,
+                failures=failures,
+                mean_runtime=runtime / count if count > 0 else None,
+                max_runtime=max_runtime,
+                max_memory=max_memory
+            )
+            for pattern, queue, count, failures, runtime, max_runtime, max_memory in rows
+        ]
+
+    def get_status(self, hours=24):
+        # Summarize each queue from the database alone: the jobs waiting in
+        # the buffer and in the backend as of the last snapshot, and the
+        # throughput over the last few hours.
+        now = self.backend.get_current_time()
+        first_hour = int(now.timestamp() // 3600) - hours + 1
+        with self.get_db_connection() as conn, self.read_db(conn):
+            limits = self.get_limits(conn)
+            row = conn.execute('''\
+select "time" from "snapshot_info"
+''').fetchone()
+            snapshot_time = datetime.datetime.fromtimestamp(row[0]) if row is not None else None
+            statuses = collections.defaultdict(lambda: QueueStatus(None))
+            for queue, limit in limits.items():
+                statuses[queue].limit = limit.value
+            for queue, buffered in conn.execute(f'''\
+select "job_queues"."queue", sum({LOCAL_JOB_COUNT})
+from "job_queues"
+  join "jobs" on "job_queues"."job_id" = "jobs"."id"
+group by "job_queues"."queue"
+'''):
+                statuses[queue].buffered = buffered
+            for queue, pending, running in conn.execute('''\
+select
+  "queue",
+  sum(instr("state", 'q') > 0),
+  sum(instr("state", 'q') = 0)
+from "snapshot_jobs"
+where "queue" is not null
+group by "queue"
+'''):
+                statuses[queue].pending = pending
+                statuses[queue].running = running
+            for queue, start_hour, dispatched, completed in conn.execute('''\
+select "queue", min("hour"), sum("dispatched"), sum("completed")
+from "queue_throughput"
+where "hour" >= ?
+group by "queue"
+''', (first_hour,)):
+                # Do not count the time before the history starts, but
+                # average over at least an hour so that a burst right after
+                # it starts does not look like a high rate.
+                elapsed_hours = max((now.timestamp() - start_hour * 3600) / 3600, 1.0)
+                status = statuses[queue]
+                status.dispatched_per_hour = dispatched / elapsed_hours
+                status.completed_per_hour = completed / elapsed_hours
+            # Run times change less than throughput, so use all of the
+            # history for them.
+            for queue, completed, runtime in conn.execute('''\
+select "queue", sum("completed"), sum("runtime")
+from "queue_throughput"
+group by "queue"
+having sum("completed") > 0
+'''):
+                statuses[queue].mean_runtime = runtime / completed
+            # Accounting records give exact run times, so prefer those of
+            # jobs that finished in the same hours as the throughput.
+            for queue, completed, runtime in conn.execute('''\
+select "queue", count(*), sum("end_time" - "start_time")
+from "job_accounting"
+where "queue" is not null and "start_time" is not null and "end_time" >= ?
+group by "queue"
+''', (now.timestamp() - hours * 3600,)):
+                statuses[queue].mean_runtime = runtime / completed
+            total_buffered, = conn.execute(f'''\
+select coalesce(sum({LOCAL_JOB_COUNT}), 0) from "jobs"
+''').fetchone()
+            leader = self.get_lease(conn)
+        queues = []
+        for queue in sorted(statuses):
+            status = statuses[queue]
+            status.queue = queue
+            status.eta = estimate_drain_time(status)
+            queues.append(status)
+        total = QueueStatus(
+            queue=None,
+            buffered=total_buffered,
+            pending=sum(status.pending for status in queues),
+            running=sum(status.running for status in queues),
+            dispatched_per_hour=sum(status.dispatched_per_hour for status in queues),
+            completed_per_hour=sum(status.completed_per_hour for status in queues)
         )
-        running_jobs = self.backend.get_own_running_jobs_in_queue(queue)
-        return self.merge_pending_and_running_jobs(pending_jobs, running_jobs)
+        total.eta = estimate_drain_time(total)
+        return StatusInfo(now, snapshot_time, queues, total, leader)
+
+    def get_simulation_scenario(self, default_runtime=DEFAULT_RUNTIME):
+        # Gather everything the simulator needs from the database alone: the
+        # buffer, the last snapshot, the limits, and past run times.
+        now = self.backend.get_current_time()
+        with self.get_db_connection() as conn, self.read_db(conn):
+            queues_by_job = collections.defaultdict(list)
+            for job_id, queue in conn.execute('''\
+select "job_id", "queue"
+from "job_queues"
+order by rowid asc
+'''):
+                queues_by_job[job_id].append(queue)
+            entries = [
+                SimulatedEntry(queues_by_job[job_id], count)
+                for job_id, count in conn.execute('''\
+select "jobs"."id", coalesce("sweeps"."size" - "sweeps"."next_index" + 1, 1)
+from "jobs"
+  left join "sweeps" on "jobs"."sweep_id" = "sweeps"."id"
+order by "jobs"."id" asc
+''')
+            ]
+            queues = {}
+            for queue, value, pending, others_running in conn.execute('''\
+select "limits"."queue", "limits"."value", "limits"."pending", "adaptive_limits"."others_running"
+from "limits"
+  left join "adaptive_limits" on "limits"."queue" = "adaptive_limits"."queue"
+order by "limits"."queue" asc
+'''):
+                # Adaptive limits are simulated at their ceilings.
+                queues[queue] = SimulatedQueue(value, pending, others=others_running or 0)
+            schedules = self.get_schedules(conn)
+            running = []
+            pending = []
+            for queue, slots, state, since in conn.execute('''\
+select "queue", "slots", "state", "since"
+from "snapshot_jobs"
+where "queue" is not null
+order by "id" asc
+'''):
+                if is_pending_state(state):
+                    pending.append((queue, slots))
+                else:
+                    elapsed = (now - datetime.datetime.fromisoformat(since)).total_seconds() if since is not None else 0.0
+                    running.append((queue, slots, max(elapsed, 0.0)))
+            # A job's run time is the time between the snapshots in which it
+            # was first seen running and first seen gone.
+            runtimes = collections.defaultdict(list)
+            for queue, runtime in conn.execute('''\
+select
+  "finished"."queue",
+  "finished"."time" - (
+    select max("started"."time")
+    from "job_events" as "started"
+    where
+      "started"."job_id" = "finished"."job_id" and
+      "started"."event" = 'started' and
+      "started"."time" <= "finished"."time"
+  ) as "runtime"
+from "job_events" as "finished"
+where "finished"."event" = 'finished' and "finished"."queue" is not null
+'''):
+                if runtime is not None:
+                    runtimes[queue].append(runtime)
+            # Accounting records give exact run times, so prefer them for
+            # the queues that have any.
+            accounted_runtimes = collections.defaultdict(list)
+            for queue, runtime in conn.execute('''\
+select "queue", "end_time" - "start_time"
+from "job_accounting"
+where "queue" is not null and "start_time" is not null
+'''):
+                accounted_runtimes[queue].append(runtime)
+            runtimes.update(accounted_runtimes)
+            runtimes[None] = [runtime for values in runtimes.values() for runtime in values]
+            if not runtimes[None]:
+                del runtimes[None]
+        for values in runtimes.values():
+            values.sort()
+        return Scenario(
+            start_time=now,
+            entries=entries,
+            queues=queues,
+            schedules=schedules,
+            running=running,
+            pending=pending,
+            runtimes=dict(runtimes),
+            default_runtime=default_runtime
+        )
+
+    def get_job_events(self, since=None):
+        with self.get_db_connection() as conn, self.read_db(conn):
+            rows = conn.execute('''\
+select "time", "job_id", "name", "queue", "event", "group"
+from "job_events"
+where "time" >= ?
+order by "id" asc
+''', (since.timestamp() if since is not None else -math.inf,)).fetchall()
+        return [
+            JobEvent(datetime.datetime.fromtimestamp(time), job_id, name, queue, event, group)
+            for time, job_id, name, queue, event, group in rows
+        ]
 
     def merge_pending_and_running_jobs(self, pending_jobs, running_jobs):
         # Pending jobs should be queried before the running jobs to avoid
@@ -287,7 +1524,8 @@ order by "jobs"."id", "job_queues".rowid asc
         # group_concat(), but according to the SQLite docs, the order of
         # concatenation is arbitrary.
         user = self.backend.get_own_user()
-        for job_id, name in rows:
+        sweeps = {}
+        for job_id, name, group, enqueued_at, sweep_id in rows:
             if include_queue:
                 queue_rows = conn.execute('''\
 select "queue"
@@ -298,6 +1536,20 @@ order by rowid asc
                 queue = ' '.join(queue for queue, in queue_rows)
             else:
                 queue = None
+            if sweep_id is not None:
+                # Show the whole sweep as one entry, named after its template.
+                if sweep_id not in sweeps:
+                    sweep_name, size, next_index = conn.execute('''\
+select "name", "size", "next_index"
+from "sweeps"
+where "id" = ?
+''', (sweep_id,)).fetchone()
+                    sweeps[sweep_id] = (sweep_name, size, next_index)
+                sweep_name, size, next_index = sweeps[sweep_id]
+                sweep = SweepProgress(sweep_id, name, size, size - next_index + 1)
+                name = sweep_name
+            else:
+                sweep = None
             yield Job(
                 id=f'x{job_id}',
                 user=user,
@@ -305,29 +1557,83 @@ order by rowid asc
                 slots=1,
                 state='-',
                 queue=queue,
-                # TODO Add timestamp to database?
-                since=None,
-                local_id=job_id
+                since=datetime.datetime.fromtimestamp(enqueued_at) if enqueued_at is not None else None,
+                local_id=job_id,
+                group=group,
+                sweep=sweep
             )
 
-    def get_queue_jobs(self, conn, queue):
+    def get_own_backend_jobs(self, job_filter=None, own_jobs=None):
+        # Return the current user's backend jobs that could match a filter,
+        # and the filter that still needs to be applied to them in Python.
+        # The result of get_own_jobs() can be passed to avoid querying again.
+        if job_filter is not None and job_filter.queue is not None:
+            # Running jobs only report the queue instance they are running
+            # on, so ask the backend which jobs are in the queue.
+            jobs = self.get_own_backend_jobs_in_queue(job_filter.queue)
+            job_filter = dataclasses.replace(job_filter, queue=None)
+        elif own_jobs is not None:
+            jobs = own_jobs
+        else:
+            jobs = self.backend.get_own_jobs()
+        return jobs, job_filter
+
+    def get_own_backend_jobs_in_queue(self, queue):
+        own_pending_jobs = (
+            job
+            for job in self.backend.get_own_pending_jobs()
+            if job.queue == queue
+        )
+        running_jobs = self.backend.get_own_running_jobs_in_queue(queue)
+        return self.merge_pending_and_running_jobs(own_pending_jobs, running_jobs)
+
+    def get_queue_backend_jobs(self, queue):
         own_pending_jobs = (
             job
             for job in self.backend.get_own_pending_jobs()
             if job.queue == queue
         )
         running_jobs = self.backend.get_running_jobs_in_queue(queue)
-        backend_jobs = self.merge_pending_and_running_jobs(own_pending_jobs, running_jobs)
-        rows = conn.execute('''\
-select "id", "name"
+        return self.merge_pending_and_running_jobs(own_pending_jobs, running_jobs)
+
+    def add_backend_job_groups(self, conn, jobs):
+        # Groups are only known for jobs that were submitted through qfunnel.
+        groups = dict(conn.execute('''\
+select "id", "group"
+from "snapshot_jobs"
+where "group" is not null
+''').fetchall())
+        for job in jobs:
+            job.group = groups.get(job.id)
+
+    def select_local_jobs(self, conn, queue=None, job_filter=None, offset=None, limit=None, after_id=None):
+        # Return a cursor over the locally buffered jobs, in priority order,
+        # that may run in a queue and match a filter, optionally starting
+        # after a given ID.
+        condition, params = self.get_local_job_condition(queue, job_filter)
+        if after_id is not None:
+            condition = f'({condition}) and "id" > ?'
+            params = [*params, after_id]
+        return conn.execute(f'''\
+select "id", "name", "group", "enqueued_at", "sweep_id"
 from "jobs"
-where exists (
-  select 1 from "job_queues" where "job_id" = "jobs"."id" and "queue" = ?
-)
+where {condition}
 order by "id" asc
-''', (queue,)).fetchall()
-        local_jobs = self.get_local_jobs(conn, rows)
-        return [*backend_jobs, *local_jobs]
+limit ? offset ?
+''', (*params, limit if limit is not None else -1, offset if offset is not None else 0))
+
+    def get_local_job_condition(self, queue, job_filter):
+        if job_filter is not None:
+            condition, params = job_filter.get_sql_condition()
+        else:
+            condition, params = '1', []
+        if queue is not None:
+            condition = f'''\
+({condition}) and exists (
+  select 1 from "job_queues" where "job_id" = "jobs"."id" and "queue" = ?
+)'''
+            params = [*params, queue]
+        return condition, params
 
     def parse_job_ids(self, job_ids):
         local_job_id_re = re.compile(r'^x([0-9]+)$')
@@ -341,6 +1647,39 @@ order by "id" asc
                 backend_jobs.append(job_id)
         return backend_jobs, local_jobs
 
+    def delete_local_jobs_where(self, conn, condition, params):
+        # Collect the IDs first, since the condition may refer to
+        # "job_queues".
+        conn.execute('drop table if exists temp."deleted_jobs"')
+        conn.execute(f'''\
+create temp table "deleted_jobs" as
+select "id", {LOCAL_JOB_COUNT} as "count" from "jobs" where {condition}
+''', params)
+        num_deleted, = conn.execute('''\
+select coalesce(sum("count"), 0) from temp."deleted_jobs"
+''').fetchone()
+        conn.execute('''\
+delete from "job_queues"
+where "job_id" in (select "id" from temp."deleted_jobs")
+''')
+        conn.execute('''\
+delete from "submission_keys"
+where "local_id" in (select "id" from temp."deleted_jobs")
+''')
+        conn.execute('''\
+delete from "jobs"
+where "id" in (select "id" from temp."deleted_jobs")
+''')
+        conn.execute('drop table temp."deleted_jobs"')
+        # Deleting a sweep's entry deletes the rest of the sweep.
+        conn.execute('''\
+delete from "sweeps"
+where not exists (
+  select 1 from "jobs" where "sweep_id" = "sweeps"."id"
+)
+''')
+        return num_deleted
+
     def delete_local_job(self, conn, job_id):
         # TODO It might be better to use ON DELETE CASCADE.
         conn.execute('''\
@@ -350,6 +1689,39 @@ delete from "job_queues" where "job_id" = ?
 delete from "jobs" where "id" = ?
 ''', (job_id,))
 
+    def intern_value(self, conn, table, column, value):
+        conn.execute(f'''\
+insert or ignore into "{table}"("{column}")
+values (?)
+''', (value,))
+        row_id, = conn.execute(f'''\
+select "id" from "{table}" where "{column}" = ?
+''', (value,)).fetchone()
+        return row_id
+
+    def prune_interned_values(self, conn):
+        conn.execute('''\
+delete from "command_prefixes"
+where not exists (
+  select 1 from "jobs" where "prefix_id" = "command_prefixes"."id"
+)
+''')
+        conn.execute('''\
+delete from "cwds"
+where not exists (
+  select 1 from "jobs" where "cwd_id" = "cwds"."id"
+) and not exists (
+  select 1 from "sweeps" where "cwd_id" = "cwds"."id"
+)
+''')
+
+    def unresolve_snapshot_jobs(self, conn):
+        conn.execute('''\
+update "snapshot_jobs"
+set "resolved" = 0
+where "queue" is null
+''')
+
     def log_message(self, message, file):
         time_str = datetime.datetime.now().strftime('%a %b %d %Y @ %I:%M:%S %p')
         print(f'[{time_str}] {message}', file=file)
@@ -360,20 +1732,49 @@ class Backend:
         """Get the current directory."""
         raise NotImplementedError
 
+    def get_current_time(self):
+        """Get the current local time."""
+        return datetime.datetime.now()
+
     def get_own_user(self):
         """Get the current user."""
         raise NotImplementedError
 
+    def get_daemon_id(self):
+        """Get a string that identifies this process among all processes
+        that share the database."""
+        return f'{socket.gethostname()}:{os.getpid()}'
+
     def connect_to_db(self):
         """Open a connection to the SQLite database."""
         raise NotImplementedError
 
+    def db_supports_wal(self):
+        """Return whether the filesystem holding the database supports
+        SQLite's WAL mode."""
+        return False
+
     def submit_job(self, queue, name, args, cwd):
-        """Submit a command to the backend."""
+        """Submit a command to the backend. Return the ID of the new job, or
+        None if it is not known."""
         raise NotImplementedError
 
+    def reserve_submission(self):
+        """Wait, if necessary, until a job may be submitted, so that the
+        next call to submit_job() does not wait. This is called outside of
+        any transaction. By default, it does nothing."""
+        pass
+
+    def split_command(self, args):
+        """Split the arguments of a command into a prefix that is likely to
+        be shared by many jobs and a suffix that is specific to this job.
+        Concatenating the two must give back the original arguments. By
+        default, the whole command is the prefix."""
+        return args, []
+
     def delete_jobs(self, job_ids):
-        """Cancel one or more running or pending jobs."""
+        """Cancel one or more running or pending jobs. Raise BackendError if
+        this fails for any of them."""
         raise NotImplementedError
 
     def get_own_jobs(self):
@@ -392,6 +1793,68 @@ class Backend:
         """Return a list of running jobs in a queue for all users."""
         raise NotImplementedError
 
+    def get_pending_jobs_in_queue(self, queue):
+        """Return a list of pending jobs in a queue for all users."""
+        raise NotImplementedError
+
+    def get_other_users_occupancy(self, queues):
+        """Return a dict that maps each of the given queues to a pair of the
+        numbers of slots that other users' jobs are running and pending in
+        it. By default, this lists the running and pending jobs of each
+        queue."""
+        user = self.get_own_user()
+        result = {}
+        for queue in queues:
+            running = sum(
+                job.slots
+                for job in self.get_running_jobs_in_queue(queue)
+                if job.user != user
+            )
+            pending = sum(
+                job.slots
+                for job in self.get_pending_jobs_in_queue(queue)
+                if job.user != user
+            )
+            result[queue] = (running, pending)
+        return result
+
+    def get_finished_jobs(self, start, end):
+        """Return the accounting records, as FinishedJob objects, of the
+        current user's jobs that started between two times and have finished.
+        Jobs that started close to either end may be included or not."""
+        raise NotImplementedError
+
+class Store:
+    """Where the database lives."""
+
+    def connect(self):
+        """Open a connection to the SQLite database."""
+        raise NotImplementedError
+
+    def supports_wal(self):
+        """Return whether the filesystem holding the database supports
+        SQLite's WAL mode."""
+        return False
+
+    def sync(self, conn):
+        """Called whenever a command or a daemon cycle is done with a
+        connection, outside of any transaction. Stores that keep a copy of
+        the database elsewhere can update it here."""
+        pass
+
+class BackendStore(Store):
+    """Use the database provided by the backend."""
+
+    def __init__(self, backend):
+        super().__init__()
+        self.backend = backend
+
+    def connect(self):
+        return self.backend.connect_to_db()
+
+    def supports_wal(self):
+        return self.backend.db_supports_wal()
+
 @dataclasses.dataclass
 class Job:
     id: str
@@ -402,6 +1865,144 @@ class Job:
     queue: str
     since: datetime.datetime
     local_id: int=None
+    group: str=None
+    # For a sweep's entry among the locally buffered jobs, its progress.
+    sweep: 'SweepProgress'=None
+
+@dataclasses.dataclass
+class SweepProgress:
+    id: int
+    # The name of the next point to be dispatched.
+    next_name: str
+    size: int
+    # The number of points not yet dispatched.
+    remaining: int
+
+@dataclasses.dataclass
+class SnapshotJob:
+    id: str
+    name: str
+    slots: int
+    state: str
+    queue: str
+    since: str
+    resolved: bool
+    group: str=None
+
+@dataclasses.dataclass
+class JobEvent:
+    time: datetime.datetime
+    job_id: str
+    name: str
+    queue: str
+    event: str
+    group: str=None
+
+@dataclasses.dataclass
+class DeleteFailure:
+    job_ids: list
+    message: str
+
+@dataclasses.dataclass
+class DeleteResult:
+    num_local_jobs: int
+    backend_jobs: list
+    failures: list
+
+class BackendError(RuntimeError):
+    pass
+
+class LeaseLostError(RuntimeError):
+
+    def __init__(self, holder):
+        super().__init__(f'the lease was taken over by {holder}')
+        self.holder = holder
+
+@dataclasses.dataclass
+class Limit:
+    queue: str
+    value: int
+    pending: int=None
+    next_change: 'LimitChange'=None
+    # For adaptive limits, the range that the value adapts within.
+    floor: int=None
+    ceiling: int=None
+
+@dataclasses.dataclass
+class LimitChange:
+    time: datetime.datetime
+    value: int
+    pending: int=None
+
+@dataclasses.dataclass
+class QueueStatus:
+    queue: str
+    limit: int=None
+    # Locally buffered jobs that may be submitted to this queue.
+    buffered: int=0
+    # Jobs pending and running in the backend as of the last snapshot.
+    pending: int=0
+    running: int=0
+    dispatched_per_hour: float=0.0
+    completed_per_hour: float=0.0
+    # In seconds.
+    mean_runtime: float=None
+    # How long until all of the above jobs are done, or None if unknown.
+    eta: datetime.timedelta=None
+
+@dataclasses.dataclass
+class StatusInfo:
+    time: datetime.datetime
+    snapshot_time: datetime.datetime
+    queues: list
+    total: QueueStatus
+    leader: 'LeaderLease'=None
+
+@dataclasses.dataclass
+class FinishedJob:
+    id: str
+    name: str
+    queue: str
+    start_time: datetime.datetime
+    end_time: datetime.datetime
+    exit_status: int
+    failed: bool
+    # The peak memory use in bytes, if known.
+    max_memory: float=None
+    task_id: str=None
+
+    def get_runtime(self):
+        if self.start_time is not None:
+            return max((self.end_time - self.start_time).total_seconds(), 0.0)
+        else:
+            return None
+
+@dataclasses.dataclass
+class RuntimeStats:
+    pattern: str
+    queue: str
+    count: int
+    failures: int
+    mean_runtime: float
+    max_runtime: float
+    max_memory: float
+
+@dataclasses.dataclass
+class LeaderLease:
+    holder: str
+    acquired_at: datetime.datetime
+    heartbeat: datetime.datetime
+    expires_at: datetime.datetime
+
+@dataclasses.dataclass
+class WaitResult:
+    # The selected jobs that are still locally buffered, pending, or running,
+    # not counting those in an error state.
+    remaining: list
+    # The selected jobs in an error state, which will not finish on their
+    # own.
+    failed: list
+    timed_out: bool=False
 
 @dataclasses.dataclass
 class Capacity:
@@ -418,11 +2019,151 @@ class ListOwnInfo:
     jobs: list
     queues: list
 
+# The maximum number of jobs to delete with one statement or command.
+DELETE_CHUNK_SIZE = 500
+# The first character of the IDs of placeholder rows in "snapshot_jobs" for
+# submitted jobs whose backend IDs are unknown. No backend uses it in IDs.
+PLACEHOLDER_PREFIX = '?'
+# A SQL expression for the number of jobs that a row of "jobs" stands for. A
+# sweep's entry stands for all of the sweep's points not yet dispatched.
+LOCAL_JOB_COUNT = '''\
+coalesce(
+  (select "size" - "next_index" + 1 from "sweeps" where "sweeps"."id" = "jobs"."sweep_id"),
+  1
+)'''
+# The number of locally buffered jobs read per transaction when streaming.
+LIST_PAGE_SIZE = 500
+# The default number of seconds between reads of the database in `wait`.
+WAIT_INTERVAL = 10.0
+# The fraction of the range of an adaptive limit that its target value must
+# move by before the limit changes.
+ADAPTIVE_LIMIT_HYSTERESIS = 0.2
+# How long, in seconds, the key of a submitted job keeps the same key from
+# being submitted again.
+SUBMISSION_KEY_LIFETIME = 30 * 24 * 3600.0
+# How long, in seconds, to keep the events of jobs that have finished.
+JOB_EVENT_HISTORY = 30 * 24 * 3600.0
+# The minimum number of seconds between reads of accounting records.
+ACCOUNTING_INTERVAL = 3600.0
+# The number of seconds of start times covered by each read of accounting
+# records, how many reads to do at most at once, and how far back to start
+# reading the first time.
+ACCOUNTING_WINDOW = 24 * 3600.0
+MAX_ACCOUNTING_WINDOWS = 7
+ACCOUNTING_HISTORY = 7 * 24 * 3600.0
+# How many seconds before the last snapshot accounting records are read up
+# to, to allow for clocks that differ between this machine and the
+# scheduler.
+ACCOUNTING_MARGIN = 60.0
+# How long, in seconds, jobs that are still running may keep the accounting
+# high-water mark from advancing.
+ACCOUNTING_MAX_LAG = 24 * 3600.0
+
 TABLES_FILE = pathlib.Path(__file__).parent / 'tables.sqlite'
+MIGRATIONS_DIR = pathlib.Path(__file__).parent / 'migrations'
+
+def estimate_drain_time(status):
+    # Use the observed completion rate, or, if nothing has completed lately,
+    # assume the queue will run at its limit with the usual run time.
+    remaining = status.buffered + status.pending + status.running
+    if remaining == 0:
+        return datetime.timedelta(0)
+    if status.completed_per_hour > 0:
+        rate = status.completed_per_hour
+    elif status.limit and status.mean_runtime:
+        rate = status.limit * 3600 / status.mean_runtime
+    else:
+        return None
+    return datetime.timedelta(hours=remaining / rate)
+
+def get_adaptive_limit(floor, ceiling, others_running, others_pending, previous):
+    # Use the full ceiling when nobody else is waiting, and back off toward
+    # the floor as the share of other users' jobs that are waiting grows.
+    others_total = others_running + others_pending
+    contention = others_pending / others_total if others_total > 0 else 0.0
+    target = round(ceiling - (ceiling - floor) * contention)
+    if previous is None:
+        return target
+    previous = min(max(previous, floor), ceiling)
+    # Ignore small changes, except that the extremes are always reached, so
+    # that idle capacity is used right away.
+    band = max(1, round(ADAPTIVE_LIMIT_HYSTERESIS * (ceiling - floor)))
+    if abs(target - previous) >= band or target in (floor, ceiling):
+        return target
+    else:
+        return previous
+
+def get_scheduled_limit(base_limit, schedules, time):
+    schedule = get_active_schedule(schedules, time)
+    if schedule is not None:
+        return Limit(base_limit.queue, schedule.value, schedule.pending)
+    else:
+        return Limit(base_limit.queue, base_limit.value, base_limit.pending)
+
+def get_next_limit_change(base_limit, schedules, time):
+    # Return the next time within a week at which the limit will be
+    # different, or None.
+    limit = get_scheduled_limit(base_limit, schedules, time)
+    for boundary in get_next_boundaries(schedules, time):
+        next_limit = get_scheduled_limit(base_limit, schedules, boundary)
+        if (next_limit.value, next_limit.pending) != (limit.value, limit.pending):
+            return LimitChange(boundary, next_limit.value, next_limit.pending)
+    return None
+
+def get_migration_files():
+    # Migration files are applied in the order of their numeric prefixes.
+    return sorted(MIGRATIONS_DIR.glob('*.sqlite'))
+
+def execute_script(conn, script):
+    # Unlike executescript(), this runs the statements inside the current
+    # transaction instead of committing it first.
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            conn.execute(statement)
+            statement = ''
+    if statement.strip():
+        raise ValueError(f'incomplete SQL statement: {statement!r}')
+
+def chunk_list(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i+size]
+
+def paginate(iterable, offset, limit):
+    start = offset if offset is not None else 0
+    stop = start + limit if limit is not None else None
+    return itertools.islice(iterable, start, stop)
+
+def is_pending_state(state):
+    # All of SGE's pending states (qw, hqw, hRwq, Eqw) contain a "q".
+    return 'q' in state
+
+def is_error_state(state):
+    return 'E' in state
+
+def get_submission_key(name, args, cwd, axes=None):
+    # Derive a key from everything that determines what a job does.
+    value = [name, args, cwd]
+    if axes is not None:
+        value.append(axes)
+    return hashlib.sha256(encode_json(value).encode('utf-8')).hexdigest()
+
+def get_name_pattern(name):
+    # Jobs in a series usually differ only in numbers, e.g. "train-lr0.1-3".
+    return re.sub(r'[0-9]+', '#', name)
+
+def encode_json(value):
+    return json.dumps(value, separators=(',', ':'))
 
 @dataclasses.dataclass
 class JobFilter:
-    name: str
+    name: str=None
+    queue: str=None
+    states: list=None
+    group: str=None
+    since: datetime.datetime=None
+    until: datetime.datetime=None
 
     def __post_init__(self):
         self._name_re = None
@@ -431,7 +2172,52 @@ class JobFilter:
         return filter(self.matches_job, jobs)
 
     def matches_job(self, job):
-        return (self.name is None or self.name_re.search(job.name) is not None)
+        return (
+            (self.name is None or self.name_re.search(job.name) is not None) and
+            (self.queue is None or (job.queue is not None and self.queue in job.queue.split())) and
+            (self.states is None or job.state in self.states) and
+            (self.group is None or job.group == self.group) and
+            (self.since is None or (job.since is not None and job.since >= self.since)) and
+            (self.until is None or (job.since is not None and job.since < self.until))
+        )
+
+    def get_sql_condition(self):
+        """Return a SQL expression over the "jobs" table that selects the
+        locally buffered jobs matching this filter, and its parameters. The
+        expression is never null."""
+        conditions = []
+        params = []
+        if self.name is not None:
+            # A sweep's entry is matched by its template, which is the name
+            # it is listed under, so the whole sweep is selected or not.
+            conditions.append('''\
+coalesce(
+  (select "name" from "sweeps" where "id" = "jobs"."sweep_id"),
+  "jobs"."name"
+) regexp ?''')
+            params.append(self.name)
+        if self.queue is not None:
+            conditions.append('''\
+exists (
+  select 1 from "job_queues" where "job_id" = "jobs"."id" and "queue" = ?
+)''')
+            params.append(self.queue)
+        if self.states is not None and '-' not in self.states:
+            # Locally buffered jobs always have the state "-".
+            conditions.append('0')
+        if self.group is not None:
+            conditions.append('coalesce("jobs"."group" = ?, 0)')
+            params.append(self.group)
+        if self.since is not None:
+            conditions.append('coalesce("jobs"."enqueued_at" >= ?, 0)')
+            params.append(self.since.timestamp())
+        if self.until is not None:
+            conditions.append('coalesce("jobs"."enqueued_at" < ?, 0)')
+            params.append(self.until.timestamp())
+        if conditions:
+            return ' and '.join(f'({c})' for c in conditions), params
+        else:
+            return '1', params
 
     @property
     def name_re(self):
@@ -440,4 +2226,19 @@ class JobFilter:
         return self._name_re
 
     def is_empty(self):
-        return self.name is None
+        return (
+            self.name is None and
+            self.queue is None and
+            self.states is None and
+            self.group is None and
+            self.since is None and
+            self.until is None
+        )
+
+def sqlite_regexp(pattern, s):
+    # SQLite evaluates "s regexp pattern" as regexp(pattern, s).
+    return s is not None and compile_regex(pattern).search(s) is not None
+
+@functools.lru_cache(maxsize=128)
+def compile_regex(pattern):
+    return re.compile(pattern)
@@ -0,0 +1,93 @@
+import dataclasses
+import sqlite3
+import time
+
+# Kinds of scheduler commands that have separate budgets.
+QUERY = 'query'
+SUBMIT = 'submit'
+
+@dataclasses.dataclass
+class Bucket:
+    # Tokens added per second.
+    rate: float
+    # The maximum number of tokens, i.e. the largest burst of commands.
+    capacity: int
+
+class TokenBucketRateLimiter:
+    """Limits how often commands of each kind are run, across all processes
+    that share the same database file.
+
+    Each kind of command has a token bucket that refills at a steady rate.
+    Running a command takes a token. When the bucket is empty, the caller
+    takes a token anyway, leaving the bucket in debt, and sleeps until that
+    token would have been added. This way, callers that arrive at the same
+    time are spaced out instead of all retrying at once.
+
+    The database is separate from the main one because the dispatcher holds
+    the write lock on the main database while it runs commands."""
+
+    def __init__(self, db_file, buckets, clock=time.time, sleep=time.sleep):
+        super().__init__()
+        self.db_file = db_file
+        self.buckets = buckets
+        self.clock = clock
+        self.sleep = sleep
+
+    def acquire(self, kind):
+        """Wait until a command of the given kind may be run."""
+        bucket = self.buckets.get(kind)
+        if bucket is not None:
+            wait = self.take_token(kind, bucket)
+            if wait > 0:
+                self.sleep(wait)
+
+    def take_token(self, kind, bucket):
+        # Return the number of seconds to wait before using the token.
+        conn = sqlite3.connect(self.db_file, timeout=60.0)
+        try:
+            conn.execute('''\
+create table if not exists "buckets" (
+  "kind" text not null,
+  "tokens" real not null,
+  "updated" real not null,
+  primary key ("kind")
+)
+''')
+            conn.execute('begin immediate')
+            now = self.clock()
+            row = conn.execute('''\
+select "tokens", "updated" from "buckets" where "kind" = ?
+''', (kind,)).fetchone()
+            if row is not None:
+                tokens, updated = row
+                tokens = min(bucket.capacity, tokens + max(0.0, now - updated) * bucket.rate)
+            else:
+                tokens = bucket.capacity
+            tokens -= 1
+            conn.execute('''\
+insert or replace into "buckets"("kind", "tokens", "updated")
+values (?, ?, ?)
+''', (kind, tokens, now))
+            conn.commit()
+        finally:
+            conn.close()
+        return max(0.0, -tokens / bucket.rate)
+
+def get_buckets(config):
+    """Get the token buckets for each kind of command from the rate limit
+    section of the config."""
+    result = {}
+    for kind, per_minute, burst in [
+        (QUERY, config.query_per_minute, config.query_burst),
+        (SUBMIT, config.submit_per_minute, config.submit_burst)
+    ]:
+        if per_minute is not None:
+            if per_minute <= 0:
+                raise ValueError(f'{kind}_per_minute must be positive')
+            if burst is not None and burst < 1:
+                raise ValueError(f'{kind}_burst must be at least 1')
+            result[kind] = Bucket(
+                rate=per_minute / 60,
+                capacity=burst if burst is not None else 1
+            )
+    return result
@@ -2,17 +2,44 @@ import datetime
 import itertools
 import os
 import pathlib
+import re
 import sqlite3
 import subprocess
 import xml.etree.ElementTree
 
-from .program import Backend, Job
+from .program import Backend, BackendError, FinishedJob, Job
+from .rate_limit import QUERY, SUBMIT
 
 DB_DIR = pathlib.Path.home() / '.local' / 'share'
 DB_FILE = DB_DIR / 'qfunnel.db'
+RATE_LIMIT_DB_FILE = DB_DIR / 'qfunnel-rate-limits.db'
+
+# Filesystems that cannot provide the shared memory that SQLite's WAL mode
+# needs, at least not across machines.
+NETWORK_FILESYSTEMS = {
+    'afs', 'ceph', 'cifs', 'fuse.glusterfs', 'fuse.sshfs', 'gpfs', 'lustre',
+    'nfs', 'nfs4', 'smb3', 'smbfs'
+}
+
+# Units of memory sizes in qacct's output.
+MEMORY_UNITS = {'B' : 1, 'K' : 1024, 'M' : 1024 ** 2, 'G' : 1024 ** 3, 'T' : 1024 ** 4}
+
+# qsub options that take no value.
+QSUB_FLAG_OPTIONS = {
+    '-clear', '-cwd', '-h', '-help', '-notify', '-terse', '-V', '-verify'
+}
+# qsub options that take two values. All others take exactly one.
+QSUB_TWO_VALUE_OPTIONS = {'-pe'}
 
 class RealBackend(Backend):
 
+    def __init__(self, rate_limiter=None):
+        super().__init__()
+        self.rate_limiter = rate_limiter
+        # Whether a token for a submit command has already been taken by
+        # reserve_submission().
+        self.has_submit_token = False
+
     def get_cwd(self):
         return str(pathlib.Path.cwd())
 
@@ -25,20 +52,46 @@ class RealBackend(Backend):
         # while running qstat.
         return sqlite3.connect(DB_FILE, timeout=60.0)
 
+    def db_supports_wal(self):
+        fs_type = get_filesystem_type(DB_DIR)
+        return fs_type is not None and fs_type not in NETWORK_FILESYSTEMS
+
     def submit_job(self, queue, name, args, cwd):
-        run_sge_command([
+        result = self.run_command(SUBMIT, [
             'qsub',
             '-q', queue,
             '-N', name,
             '-w', 'w',
             *args
-        ], cwd=cwd)
+        ], cwd=cwd, stdout=subprocess.PIPE, encoding='ascii')
+        # Pass the output of qsub through, as if it had not been captured.
+        print(result.stdout, end='')
+        return parse_qsub_job_id(result.stdout)
+
+    def split_command(self, args):
+        # Everything up to and including the job script (qsub options and the
+        # script path) is usually shared by all jobs in a sweep, while the
+        # arguments to the script vary.
+        i = 0
+        while i < len(args) and args[i].startswith('-'):
+            option = args[i]
+            if option in QSUB_FLAG_OPTIONS:
+                i += 1
+            elif option in QSUB_TWO_VALUE_OPTIONS:
+                i += 3
+            else:
+                i += 2
+        i = min(i + 1, len(args))
+        return args[:i], args[i:]
 
     def delete_jobs(self, job_ids):
-        run_sge_command(['qdel', *job_ids])
+        result = self.run_command(SUBMIT, ['qdel', *job_ids], capture_output=True, encoding='ascii')
+        print(result.stdout, end='')
+        if result.returncode != 0:
+            raise BackendError(result.stderr.strip() or f'qdel exited with status {result.returncode}')
 
     def get_own_jobs(self):
-        output = capture_sge_command_output([
+        output = self.capture_query_output([
             'qstat',
             '-u', self.get_own_user(),
             '-r',
@@ -50,7 +103,7 @@ class RealBackend(Backend):
         return [dict_to_job(job) for job in itertools.chain(running_jobs, pending_jobs)]
 
     def get_own_pending_jobs(self):
-        output = capture_sge_command_output([
+        output = self.capture_query_output([
             'qstat',
             '-u', self.get_own_user(),
             '-r',
@@ -61,7 +114,7 @@ class RealBackend(Backend):
         return [dict_to_job(job) for job in pending_jobs]
 
     def get_own_running_jobs_in_queue(self, queue):
-        output = capture_sge_command_output([
+        output = self.capture_query_output([
             'qstat',
             '-u', self.get_own_user(),
             '-q', queue,
@@ -74,7 +127,7 @@ class RealBackend(Backend):
         return [dict_to_job(job) for job in jobs]
 
     def get_running_jobs_in_queue(self, queue):
-        output = capture_sge_command_output([
+        output = self.capture_query_output([
             'qstat',
             '-q', queue,
             '-s', 'r',
@@ -85,11 +138,86 @@ class RealBackend(Backend):
         jobs = parse_xml_jobs(root.find('queue_info'))
         return [dict_to_job(job) for job in jobs]
 
+    def get_pending_jobs_in_queue(self, queue):
+        output = self.capture_query_output([
+            'qstat',
+            '-u', '*',
+            '-q', queue,
+            '-s', 'p',
+            '-r',
+            '-xml'
+        ])
+        root = parse_xml_output(output)
+        jobs = parse_xml_jobs(root.find('job_info'))
+        return [dict_to_job(job) for job in jobs]
+
+    def get_finished_jobs(self, start, end):
+        # qacct selects jobs by start time, to the minute.
+        result = self.run_command(QUERY, [
+            'qacct',
+            '-o', self.get_own_user(),
+            '-b', format_qacct_time(start),
+            '-e', format_qacct_time(end),
+            '-j'
+        ], capture_output=True, encoding='utf-8')
+        if result.returncode != 0:
+            # qacct exits with an error when no jobs match.
+            if not result.stdout.strip() and 'not found' in result.stderr:
+                return []
+            raise BackendError(result.stderr.strip() or f'qacct exited with status {result.returncode}')
+        return [dict_to_finished_job(d) for d in parse_qacct_output(result.stdout)]
+
+    def reserve_submission(self):
+        # Take the token now, while the database is not locked. It is kept
+        # until a submit command uses it.
+        if self.rate_limiter is not None and not self.has_submit_token:
+            self.rate_limiter.acquire(SUBMIT)
+            self.has_submit_token = True
+
+    def run_command(self, kind, args, **kwargs):
+        if kind == SUBMIT and self.has_submit_token:
+            self.has_submit_token = False
+        elif self.rate_limiter is not None:
+            self.rate_limiter.acquire(kind)
+        return run_sge_command(args, **kwargs)
+
+    def capture_query_output(self, args):
+        return self.run_command(QUERY, args, capture_output=True, encoding='ascii').stdout
+
+def get_filesystem_type(path):
+    # Find the mount point with the longest prefix of the path. Return None
+    # if the mount table is not available (e.g. on non-Linux systems).
+    path = os.path.realpath(path)
+    try:
+        with open('/proc/self/mounts') as fin:
+            lines = fin.readlines()
+    except OSError:
+        return None
+    result = None
+    result_len = -1
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        # Spaces in mount points are escaped as octal.
+        mount_point = fields[1].replace('\\040', ' ')
+        if (
+            (path == mount_point or path.startswith(mount_point.rstrip('/') + '/'))
+            and len(mount_point) > result_len
+        ):
+            result = fields[2]
+            result_len = len(mount_point)
+    return result
+
 def run_sge_command(args, **kwargs):
     return subprocess.run(args, **kwargs)
 
-def capture_sge_command_output(args):
-    return run_sge_command(args, capture_output=True, encoding='ascii').stdout
+def parse_qsub_job_id(s):
+    m = re.search(r'Your job(?:-array)? ([0-9]+)', s)
+    if m is not None:
+        return m.group(1)
+    else:
+        return None
 
 def parse_xml_output(s):
     return xml.etree.ElementTree.fromstring(s)
@@ -117,3 +245,56 @@ def dict_to_job(d):
 
 def parse_job_date(s):
     return datetime.datetime.fromisoformat(s)
+
+def format_qacct_time(d):
+    return d.strftime('%Y%m%d%H%M')
+
+def parse_qacct_output(s):
+    # Records are separated by lines of "=" and consist of lines of the form
+    # "key   value".
+    record = None
+    for line in s.splitlines():
+        if line.startswith('====='):
+            if record:
+                yield record
+            record = {}
+        elif record is not None and line.strip():
+            key, _, value = line.partition(' ')
+            record[key] = value.strip()
+    if record:
+        yield record
+
+def dict_to_finished_job(d):
+    task_id = d.get('taskid')
+    exit_status = int(d['exit_status'])
+    # "failed" is a code followed by an explanation, e.g. "100 : assumedly
+    # after job".
+    failed = int(d['failed'].split()[0]) != 0
+    memory = d.get('maxvmem')
+    return FinishedJob(
+        id=d['jobnumber'],
+        name=d['jobname'],
+        queue=d['qname'],
+        start_time=parse_qacct_date(d['start_time']),
+        end_time=parse_qacct_date(d['end_time']),
+        exit_status=exit_status,
+        failed=failed or exit_status != 0,
+        max_memory=parse_memory(memory) if memory is not None else None,
+        task_id=task_id if task_id not in (None, 'undefined') else None
+    )
+
+def parse_qacct_date(s):
+    # Jobs that never started have the start time "-/-". Older versions
+    # print dates like "Sat Jul  9 00:00:05 2022", newer ones in ISO format.
+    if s == '-/-':
+        return None
+    try:
+        return datetime.datetime.strptime(' '.join(s.split()), '%a %b %d %H:%M:%S %Y')
+    except ValueError:
+        return datetime.datetime.fromisoformat(s)
+
+def parse_memory(s):
+    m = re.fullmatch(r'([0-9.]+)([BKMGT]?)', s)
+    if m is None:
+        return None
+    return float(m.group(1)) * MEMORY_UNITS[m.group(2) or 'B']
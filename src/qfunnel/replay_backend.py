@@ -0,0 +1,182 @@
+import collections
+import datetime
+import json
+import subprocess
+import sqlite3
+import time
+
+from .real_backend import RealBackend, get_filesystem_type, NETWORK_FILESYSTEMS
+
+# Backend methods whose results come from the environment rather than from
+# scheduler commands, so they must be recorded in order to be replayed.
+ENVIRONMENT_METHODS = ['get_cwd', 'get_own_user', 'get_current_time']
+
+class RecordingBackend(RealBackend):
+    """A RealBackend that writes every backend call and every scheduler
+    command it runs to a trace file, one JSON object per line.
+
+    Command records contain the arguments, raw output, exit status, and
+    duration of each command. Call records contain the arguments and
+    duration of each backend method, plus the result for methods that read
+    the environment. A call record is written after the records of the
+    commands it ran."""
+
+    def __init__(self, trace_file, rate_limiter=None, clock=time.time):
+        super().__init__(rate_limiter)
+        self.trace_file = trace_file
+        self.clock = clock
+
+    def run_command(self, kind, args, **kwargs):
+        start = self.clock()
+        result = super().run_command(kind, args, **kwargs)
+        self.write_record({
+            'type' : 'command',
+            'kind' : kind,
+            'args' : list(args),
+            'cwd' : kwargs.get('cwd'),
+            'stdout' : result.stdout,
+            'stderr' : result.stderr,
+            'returncode' : result.returncode,
+            'start' : start,
+            'duration' : self.clock() - start
+        })
+        return result
+
+    def record_call(self, method, args, func):
+        start = self.clock()
+        result = func(*args)
+        record = {
+            'type' : 'call',
+            'method' : method,
+            'args' : [encode_result(arg) for arg in args],
+            'start' : start,
+            'duration' : self.clock() - start
+        }
+        if method in ENVIRONMENT_METHODS:
+            record['result'] = encode_result(result)
+        self.write_record(record)
+        return result
+
+    def write_record(self, record):
+        with open(self.trace_file, 'a') as fout:
+            print(json.dumps(record), file=fout)
+
+    def get_cwd(self):
+        return self.record_call('get_cwd', (), super().get_cwd)
+
+    def get_own_user(self):
+        return self.record_call('get_own_user', (), super().get_own_user)
+
+    def get_current_time(self):
+        return self.record_call('get_current_time', (), super().get_current_time)
+
+    def submit_job(self, queue, name, args, cwd):
+        return self.record_call('submit_job', (queue, name, args, cwd), super().submit_job)
+
+    def delete_jobs(self, job_ids):
+        return self.record_call('delete_jobs', (job_ids,), super().delete_jobs)
+
+    def get_own_jobs(self):
+        return self.record_call('get_own_jobs', (), super().get_own_jobs)
+
+    def get_own_pending_jobs(self):
+        return self.record_call('get_own_pending_jobs', (), super().get_own_pending_jobs)
+
+    def get_own_running_jobs_in_queue(self, queue):
+        return self.record_call('get_own_running_jobs_in_queue', (queue,), super().get_own_running_jobs_in_queue)
+
+    def get_running_jobs_in_queue(self, queue):
+        return self.record_call('get_running_jobs_in_queue', (queue,), super().get_running_jobs_in_queue)
+
+    def get_pending_jobs_in_queue(self, queue):
+        return self.record_call('get_pending_jobs_in_queue', (queue,), super().get_pending_jobs_in_queue)
+
+    def get_finished_jobs(self, start, end):
+        return self.record_call('get_finished_jobs', (start, end), super().get_finished_jobs)
+
+class ReplayBackend(RealBackend):
+    """A RealBackend that answers scheduler commands and environment queries
+    from a trace written by RecordingBackend, without running anything.
+
+    Commands are matched to recorded commands with the same arguments, and
+    successive runs of the same command get successive recorded outputs.
+    Once the recorded outputs for a command run out, the last one is
+    repeated, as is the last recorded result of each environment method.
+    This keeps replays deterministic even if the code under test runs a
+    different number of commands than were recorded.
+
+    If speedup is given, each command takes as long as it originally did
+    divided by speedup, so that timing-sensitive behavior can be reproduced
+    faster than real time. Otherwise, commands return immediately."""
+
+    def __init__(self, trace_file, db_file, speedup=None, sleep=time.sleep):
+        super().__init__()
+        self.db_file = db_file
+        self.speedup = speedup
+        self.sleep = sleep
+        self.commands = collections.defaultdict(collections.deque)
+        self.results = collections.defaultdict(collections.deque)
+        self.last_commands = {}
+        self.last_results = {}
+        with open(trace_file) as fin:
+            for line in fin:
+                record = json.loads(line)
+                if record['type'] == 'command':
+                    self.commands[command_key(record['args'])].append(record)
+                elif record['type'] == 'call' and 'result' in record:
+                    self.results[record['method']].append(record['result'])
+        self.commands_run = []
+
+    def connect_to_db(self):
+        return sqlite3.connect(self.db_file, timeout=60.0)
+
+    def db_supports_wal(self):
+        fs_type = get_filesystem_type(self.db_file)
+        return fs_type is not None and fs_type not in NETWORK_FILESYSTEMS
+
+    def run_command(self, kind, args, **kwargs):
+        key = command_key(args)
+        self.commands_run.append(list(args))
+        record = next_or_last(self.commands[key], self.last_commands, key)
+        if record is None:
+            raise ValueError(f'command not found in trace: {args!r}')
+        if self.speedup is not None:
+            self.sleep(record['duration'] / self.speedup)
+        return subprocess.CompletedProcess(
+            args=args,
+            returncode=record['returncode'],
+            stdout=record['stdout'],
+            stderr=record['stderr']
+        )
+
+    def get_cwd(self):
+        return self.get_result('get_cwd')
+
+    def get_own_user(self):
+        return self.get_result('get_own_user')
+
+    def get_current_time(self):
+        return decode_time(self.get_result('get_current_time'))
+
+    def get_result(self, method):
+        result = next_or_last(self.results[method], self.last_results, method)
+        if result is None:
+            raise ValueError(f'no result for {method} in trace')
+        return result
+
+def command_key(args):
+    return json.dumps(list(args))
+
+def next_or_last(queue, last_values, key):
+    if queue:
+        last_values[key] = queue.popleft()
+    return last_values.get(key)
+
+def encode_result(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    else:
+        return value
+
+def decode_time(s):
+    return datetime.datetime.fromisoformat(s)
@@ -0,0 +1,142 @@
+import dataclasses
+import datetime
+import re
+
+DAY_NAMES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+ALL_DAYS = (1 << len(DAY_NAMES)) - 1
+MINUTES_PER_DAY = 24 * 60
+
+@dataclasses.dataclass
+class LimitSchedule:
+    id: int
+    queue: str
+    # Bit mask of the days on which the window starts, with Monday as bit 0.
+    days: int
+    # Minutes since midnight. If end is not after start, the window ends on
+    # the next day.
+    start: int
+    end: int
+    value: int
+    pending: int=None
+
+    def is_active(self, time):
+        day = time.weekday()
+        minute = time.hour * 60 + time.minute
+        if self.start < self.end:
+            return has_day(self.days, day) and self.start <= minute < self.end
+        else:
+            return (
+                (has_day(self.days, day) and minute >= self.start) or
+                (has_day(self.days, (day - 1) % 7) and minute < self.end)
+            )
+
+    def get_boundaries(self, time):
+        # Yield the times at which this window starts or ends during the
+        # week following the given time, in no particular order.
+        midnight = time.replace(hour=0, minute=0, second=0, microsecond=0)
+        for offset in range(-1, 8):
+            day = midnight + datetime.timedelta(days=offset)
+            if has_day(self.days, day.weekday()):
+                yield day + datetime.timedelta(minutes=self.start)
+                end_day = day if self.start < self.end else day + datetime.timedelta(days=1)
+                yield end_day + datetime.timedelta(minutes=self.end)
+
+def has_day(days, day):
+    return bool(days & (1 << day))
+
+def get_active_schedule(schedules, time):
+    """Return the window that applies at the given time, or None. Later
+    windows take precedence over earlier ones."""
+    result = None
+    for schedule in schedules:
+        if schedule.is_active(time) and (result is None or schedule.id > result.id):
+            result = schedule
+    return result
+
+def get_next_boundaries(schedules, time):
+    """Return the sorted times after the given time at which any of the
+    windows starts or ends, within the next week."""
+    return sorted({
+        boundary
+        for schedule in schedules
+        for boundary in schedule.get_boundaries(time)
+        if boundary > time
+    })
+
+def parse_window(s):
+    """Parse a weekly time window such as "Mon-Fri 18:00-08:00",
+    "Sat,Sun 00:00-24:00", or "22:00-06:00" (every day). Return the day mask
+    and the start and end minutes."""
+    parts = s.split()
+    if len(parts) == 1:
+        days = ALL_DAYS
+        times, = parts
+    elif len(parts) == 2:
+        days = parse_days(parts[0])
+        times = parts[1]
+    else:
+        raise ValueError(f'invalid time window: {s!r}')
+    m = re.fullmatch(r'([0-9]{1,2}:[0-9]{2})-([0-9]{1,2}:[0-9]{2})', times)
+    if m is None:
+        raise ValueError(f'invalid time range: {times!r}')
+    start = parse_time_of_day(m.group(1))
+    end = parse_time_of_day(m.group(2))
+    if start == MINUTES_PER_DAY:
+        raise ValueError('a time window cannot start at 24:00')
+    if start == end:
+        raise ValueError('a time window cannot be empty')
+    return days, start, end
+
+def parse_days(s):
+    if s.lower() == 'daily':
+        return ALL_DAYS
+    days = 0
+    for part in s.lower().split(','):
+        names = part.split('-')
+        if len(names) > 2 or not all(name in DAY_NAMES for name in names):
+            raise ValueError(f'invalid days: {s!r}')
+        first = DAY_NAMES.index(names[0])
+        last = DAY_NAMES.index(names[-1])
+        day = first
+        while True:
+            days |= 1 << day
+            if day == last:
+                break
+            day = (day + 1) % 7
+    return days
+
+def parse_time_of_day(s):
+    hours, minutes = map(int, s.split(':'))
+    result = hours * 60 + minutes
+    if minutes >= 60 or result > MINUTES_PER_DAY:
+        raise ValueError(f'invalid time of day: {s!r}')
+    return result
+
+def format_window(days, start, end):
+    if days == ALL_DAYS:
+        day_str = 'daily'
+    else:
+        day_str = ','.join(format_day_run(first, last) for first, last in get_day_runs(days))
+    return f'{day_str} {format_time_of_day(start)}-{format_time_of_day(end)}'
+
+def get_day_runs(days):
+    # Group the days into runs of consecutive days, without wrapping around
+    # the end of the week.
+    runs = []
+    for day in range(len(DAY_NAMES)):
+        if has_day(days, day):
+            if runs and runs[-1][1] == day - 1:
+                runs[-1][1] = day
+            else:
+                runs.append([day, day])
+    return runs
+
+def format_day_run(first, last):
+    names = [DAY_NAMES[day].capitalize() for day in range(first, last + 1)]
+    if len(names) > 2:
+        return f'{names[0]}-{names[-1]}'
+    else:
+        return ','.join(names)
+
+def format_time_of_day(minutes):
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
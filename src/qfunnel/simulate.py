@@ -0,0 +1,249 @@
+import bisect
+import collections
+import dataclasses
+import datetime
+import heapq
+import itertools
+import math
+import random
+
+from .schedule import get_active_schedule
+
+# The run time, in seconds, assumed for jobs when there is no history.
+DEFAULT_RUNTIME = 3600.0
+# How far ahead, in seconds, to simulate before giving up on jobs that
+# never get to run.
+SIMULATION_HORIZON = 365 * 24 * 3600.0
+
+@dataclasses.dataclass
+class SimulatedEntry:
+    # The queues the entry's jobs may be submitted to, in order of preference.
+    queues: list
+    # The number of jobs in the entry. A sweep is a single entry whose jobs
+    # are dispatched one after the other.
+    count: int=1
+
+@dataclasses.dataclass
+class SimulatedQueue:
+    # The value and pending headroom of the queue's limit, or None if it is
+    # not limited.
+    limit: int=None
+    pending: int=None
+    # The total number of slots in the queue, or None if it is unbounded.
+    capacity: int=None
+    # The number of slots occupied by other users.
+    others: int=0
+
+@dataclasses.dataclass
+class Scenario:
+    start_time: datetime.datetime
+    # The locally buffered jobs, in priority order.
+    entries: list
+    queues: dict
+    # Windows that change the limits of queues over time.
+    schedules: list
+    # The queue, slots, and seconds elapsed of each job already running, and
+    # the queue and slots of each job already pending in the backend.
+    running: list
+    pending: list
+    # Sorted lists of past run times in seconds, by queue.
+    runtimes: dict
+    default_runtime: float=DEFAULT_RUNTIME
+
+@dataclasses.dataclass
+class SimulationConfig:
+    # Limits to use instead of the current ones, by queue. These replace any
+    # schedules for the same queue.
+    limits: dict
+    # The number of seconds in between checks.
+    interval: float
+
+@dataclasses.dataclass
+class SimulationResult:
+    config: SimulationConfig
+    # Seconds until the last job finishes, or None if some jobs were still
+    # unfinished at the horizon.
+    makespan: float
+    # The fraction of the limited slots that were occupied by running jobs,
+    # or None if no queue is limited.
+    utilization: float
+    # Percentiles of the seconds that locally buffered jobs wait before they
+    # start running.
+    wait_percentiles: dict
+    unfinished: int
+
+def simulate(scenario, config, seed=0, horizon=SIMULATION_HORIZON, percentiles=(50, 90, 99)):
+    """Replay the dispatcher's decisions in simulated time, starting from the
+    current buffer and backend jobs.
+
+    As in Program.check(), every check submits the highest-priority buffered
+    job that can go to a queue with open slots until there are none left.
+    The backend starts jobs as soon as there is room for them. Each job's run
+    time is drawn from the history of the queue it is submitted to, using
+    random numbers that depend only on the seed and the job's position in
+    the buffer, so that different configurations are compared on the same
+    jobs."""
+    rng = random.Random(seed)
+    queues = {
+        name : dataclasses.replace(queue)
+        for name, queue in scenario.queues.items()
+    }
+    fixed_queues = set()
+    for name, value in config.limits.items():
+        queue = queues.setdefault(name, SimulatedQueue())
+        queue.limit = value
+        fixed_queues.add(name)
+    schedules_by_queue = collections.defaultdict(list)
+    for schedule in scenario.schedules:
+        if schedule.queue not in fixed_queues and schedule.queue in queues:
+            schedules_by_queue[schedule.queue].append(schedule)
+    running = collections.Counter()
+    pending = collections.defaultdict(collections.deque)
+    finish_times = []
+    counter = 0
+    for queue, slots, elapsed in scenario.running:
+        queues.setdefault(queue, SimulatedQueue())
+        # Only count the history of jobs that ran longer than this one has.
+        runtime = draw_runtime(scenario, queue, rng.random(), elapsed)
+        heapq.heappush(finish_times, (max(runtime - elapsed, 0.0), counter, queue, slots))
+        counter += 1
+        running[queue] += slots
+    for queue, slots in scenario.pending:
+        queues.setdefault(queue, SimulatedQueue())
+        runtime = draw_runtime(scenario, queue, rng.random())
+        pending[queue].append((runtime, slots, None))
+    # Each queue keeps the indexes of the entries that may go to it, in
+    # priority order. Entries that have been used up are skipped lazily.
+    remaining = [entry.count for entry in scenario.entries]
+    offsets = list(itertools.accumulate(remaining))
+    uniforms = [rng.random() for i in range(sum(remaining))]
+    entries_by_queue = collections.defaultdict(collections.deque)
+    for i, entry in enumerate(scenario.entries):
+        for queue in entry.queues:
+            queues.setdefault(queue, SimulatedQueue())
+            entries_by_queue[queue].append(i)
+    num_buffered = sum(remaining)
+    waits = []
+    limits = {}
+    t = 0.0
+    next_check = 0.0
+    last_finish = 0.0
+    busy_time = 0.0
+    limited_time = 0.0
+
+    def has_room(queue, slots):
+        q = queues[queue]
+        return q.capacity is None or running[queue] + q.others + slots <= q.capacity
+
+    def start_pending(queue):
+        nonlocal counter
+        jobs = pending[queue]
+        while jobs and has_room(queue, jobs[0][1]):
+            runtime, slots, index = jobs.popleft()
+            if index is not None:
+                waits.append(t)
+            heapq.heappush(finish_times, (t + runtime, counter, queue, slots))
+            counter += 1
+            running[queue] += slots
+
+    def has_open_slots(queue):
+        limit = limits.get(queue)
+        if limit is None:
+            return True
+        value, headroom = limit
+        num_pending = sum(slots for runtime, slots, index in pending[queue])
+        taken = running[queue] + num_pending
+        if taken < value:
+            return True
+        headroom = headroom if headroom is not None else 0
+        return num_pending < headroom and taken < value + headroom
+
+    # Start the jobs already pending in the backend that fit right away.
+    for queue in list(pending):
+        start_pending(queue)
+
+    while num_buffered > 0 or finish_times or any(pending.values()):
+        # Let jobs finish before a check at the same time.
+        is_finish = bool(finish_times) and finish_times[0][0] <= next_check
+        next_t = finish_times[0][0] if is_finish else next_check
+        if next_t > horizon:
+            break
+        # Integrate the occupancy of the limited queues since the last event.
+        dt = next_t - t
+        for queue, (value, headroom) in limits.items():
+            busy_time += min(running[queue], value) * dt
+            limited_time += value * dt
+        t = next_t
+        if is_finish:
+            finish_time, _, queue, slots = heapq.heappop(finish_times)
+            running[queue] -= slots
+            last_finish = t
+            start_pending(queue)
+            continue
+        # Run a check.
+        now = scenario.start_time + datetime.timedelta(seconds=t)
+        limits = {}
+        for name, queue in queues.items():
+            if queue.limit is not None:
+                schedule = get_active_schedule(schedules_by_queue.get(name, ()), now)
+                if schedule is not None:
+                    limits[name] = (schedule.value, schedule.pending)
+                else:
+                    limits[name] = (queue.limit, queue.pending)
+        while True:
+            best = None
+            for queue, indexes in entries_by_queue.items():
+                while indexes and remaining[indexes[0]] == 0:
+                    indexes.popleft()
+                if not indexes:
+                    continue
+                i = indexes[0]
+                key = (i, scenario.entries[i].queues.index(queue))
+                if (best is None or key < best[0]) and has_open_slots(queue):
+                    best = (key, queue)
+            if best is None:
+                break
+            (i, _), queue = best
+            index = offsets[i] - remaining[i]
+            remaining[i] -= 1
+            num_buffered -= 1
+            runtime = draw_runtime(scenario, queue, uniforms[index])
+            pending[queue].append((runtime, 1, index))
+            start_pending(queue)
+        if not finish_times and not schedules_by_queue and not any(pending.values()):
+            # Nothing will ever change, so the rest of the jobs cannot run.
+            break
+        next_check += config.interval
+    unfinished = num_buffered + len(finish_times) + sum(len(jobs) for jobs in pending.values())
+    waits.sort()
+    return SimulationResult(
+        config=config,
+        makespan=last_finish if unfinished == 0 else None,
+        utilization=busy_time / limited_time if limited_time > 0 else None,
+        wait_percentiles={
+            p : get_percentile(waits, p) for p in percentiles
+        },
+        unfinished=unfinished
+    )
+
+def draw_runtime(scenario, queue, u, elapsed=0.0):
+    # Pick the run time at quantile u of the queue's history, falling back
+    # to the history of all queues and then to the default.
+    runtimes = scenario.runtimes.get(queue)
+    if not runtimes:
+        runtimes = scenario.runtimes.get(None)
+    if runtimes:
+        start = bisect.bisect_right(runtimes, elapsed) if elapsed > 0 else 0
+        if start < len(runtimes):
+            return runtimes[start + min(int(u * (len(runtimes) - start)), len(runtimes) - start - 1)]
+        else:
+            return elapsed
+    return max(scenario.default_runtime, elapsed)
+
+def get_percentile(values, p):
+    """Return the p-th percentile of a sorted list by the nearest-rank
+    method, or None if it is empty."""
+    if not values:
+        return None
+    rank = max(math.ceil(p / 100 * len(values)), 1)
+    return values[rank - 1]
@@ -0,0 +1,323 @@
+import collections
+import datetime
+import json
+import subprocess
+import time
+
+from .program import BackendError, FinishedJob, Job
+from .rate_limit import QUERY, SUBMIT
+from .real_backend import RealBackend, parse_memory
+
+# How long, in seconds, one squeue listing is used to answer queries before
+# squeue is run again. All of the queries in one dispatch cycle happen well
+# within this time, so each cycle runs squeue once.
+SNAPSHOT_MAX_AGE = 1.0
+
+# Fields requested from squeue when JSON output is not available. The job
+# name comes last because it is the only field that may contain the
+# separator.
+SQUEUE_FORMAT = '%i|%u|%C|%T|%P|%V|%S|%r|%j'
+SQUEUE_FORMAT_FIELDS = 9
+
+# Job states, mapped to the SGE-style state codes that the rest of QFunnel
+# understands. Any other state is passed through in lower case.
+SLURM_STATES = {
+    'PENDING' : 'qw',
+    'REQUEUED' : 'Rq',
+    'REQUEUE_HOLD' : 'hRq',
+    'REQUEUE_FED' : 'Rq',
+    'RUNNING' : 'r',
+    'CONFIGURING' : 'r',
+    'COMPLETING' : 'r',
+    'STAGE_OUT' : 'r',
+    'RESIZING' : 'r',
+    'SIGNALING' : 'r',
+    'SUSPENDED' : 's',
+    'STOPPED' : 's',
+    # Held after exiting with a special exit code.
+    'SPECIAL_EXIT' : 'Eqw'
+}
+RUNNING_STATES = {'r', 's'}
+# States of jobs that are done. squeue keeps listing them for a while, but
+# they no longer take up any slots, so they are left out.
+FINISHED_STATES = {
+    'BOOT_FAIL', 'CANCELLED', 'COMPLETED', 'DEADLINE', 'FAILED', 'NODE_FAIL',
+    'OUT_OF_MEMORY', 'PREEMPTED', 'REVOKED', 'TIMEOUT'
+}
+# Reasons for which a pending job will not run without intervention. Like
+# SGE's Eqw, such jobs are given an error state.
+ERROR_REASONS = {
+    'BadConstraints', 'DependencyNeverSatisfied', 'InvalidAccount',
+    'InvalidQOS', 'JobLaunchFailure', 'launch failed requeued held'
+}
+
+# Fields requested from sacct. The job name comes last because it is the
+# only field that may contain the separator.
+SACCT_FORMAT = 'JobID,Partition,Start,End,ExitCode,MaxRSS,State,JobName'
+SACCT_FORMAT_FIELDS = 8
+# sacct states of jobs that are not done yet.
+UNFINISHED_STATES = {'PENDING', 'RUNNING', 'REQUEUED', 'RESIZING', 'SUSPENDED'}
+
+# sbatch options that take no value when not written with "=".
+SBATCH_FLAG_OPTIONS = {
+    '-h', '-H', '-I', '-k', '-O', '-Q', '-s', '-v', '-V', '-W',
+    '--contiguous', '--exclusive', '--get-user-env', '--help', '--hold',
+    '--ignore-pbs', '--kill-on-invalid-dep', '--nice', '--no-kill',
+    '--no-requeue', '--overcommit', '--oversubscribe', '--parsable',
+    '--quiet', '--reboot', '--requeue', '--spread-job', '--test-only',
+    '--usage', '--use-min-nodes', '--verbose', '--version', '--wait'
+}
+
+class SlurmBackend(RealBackend):
+    """A backend for Slurm. Partitions play the role of queues.
+
+    Rather than running a separate query for each question, this backend
+    lists all jobs with a single squeue call and answers every query from
+    that listing until it is older than max_age seconds or a job is submitted
+    or cancelled. It uses squeue's JSON output when available, and falls back
+    to --format otherwise. It shares its database and the rest of its
+    environment with RealBackend."""
+
+    def __init__(self, rate_limiter=None, max_age=SNAPSHOT_MAX_AGE, clock=time.monotonic):
+        super().__init__(rate_limiter)
+        self.max_age = max_age
+        self.clock = clock
+        self.use_json = True
+        self.snapshot = None
+        self.snapshot_time = None
+
+    def submit_job(self, queue, name, args, cwd):
+        result = self.run_command(SUBMIT, [
+            'sbatch',
+            '--parsable',
+            f'--partition={queue}',
+            f'--job-name={name}',
+            *args
+        ], cwd=cwd, capture_output=True, encoding='utf-8')
+        self.snapshot = None
+        # Pass the output of sbatch through, as if it had not been captured.
+        print(result.stdout, end='')
+        if result.returncode != 0:
+            # Fail so that the dispatcher's transaction is rolled back and
+            # the job stays buffered.
+            raise BackendError(result.stderr.strip() or f'sbatch exited with status {result.returncode}')
+        return parse_sbatch_job_id(result.stdout)
+
+    def split_command(self, args):
+        # As with qsub, the sbatch options and the job script are usually
+        # shared by all jobs in a sweep.
+        i = 0
+        while i < len(args) and args[i].startswith('-'):
+            option = args[i]
+            if '=' in option or option in SBATCH_FLAG_OPTIONS:
+                i += 1
+            elif not option.startswith('--') and len(option) > 2:
+                # A short option with its value attached, as in -pgpu.
+                i += 1
+            else:
+                i += 2
+        i = min(i + 1, len(args))
+        return args[:i], args[i:]
+
+    def delete_jobs(self, job_ids):
+        result = self.run_command(SUBMIT, ['scancel', *job_ids], capture_output=True, encoding='utf-8')
+        self.snapshot = None
+        print(result.stdout, end='')
+        if result.returncode != 0:
+            raise BackendError(result.stderr.strip() or f'scancel exited with status {result.returncode}')
+
+    def get_own_jobs(self):
+        user = self.get_own_user()
+        return [job for job in self.get_all_jobs() if job.user == user]
+
+    def get_own_pending_jobs(self):
+        return [job for job in self.get_own_jobs() if job.state not in RUNNING_STATES]
+
+    def get_own_running_jobs_in_queue(self, queue):
+        user = self.get_own_user()
+        return [job for job in self.get_running_jobs_in_queue(queue) if job.user == user]
+
+    def get_running_jobs_in_queue(self, queue):
+        return [
+            job for job in self.get_all_jobs()
+            if job.queue == queue and job.state in RUNNING_STATES
+        ]
+
+    def get_pending_jobs_in_queue(self, queue):
+        return [
+            job for job in self.get_all_jobs()
+            if job.queue == queue and job.state not in RUNNING_STATES
+        ]
+
+    def get_other_users_occupancy(self, queues):
+        # Count every queue in one pass over a single listing.
+        user = self.get_own_user()
+        result = {queue : (0, 0) for queue in queues}
+        for job in self.get_all_jobs():
+            if job.user != user and job.queue in result:
+                running, pending = result[job.queue]
+                if job.state in RUNNING_STATES:
+                    running += job.slots
+                else:
+                    pending += job.slots
+                result[job.queue] = (running, pending)
+        return result
+
+    def get_finished_jobs(self, start, end):
+        # sacct selects the jobs that were running at any time in the window,
+        # so keep only the ones that started in it.
+        result = self.run_command(QUERY, [
+            'sacct',
+            '--user', self.get_own_user(),
+            '--starttime', start.strftime('%Y-%m-%dT%H:%M:%S'),
+            '--endtime', end.strftime('%Y-%m-%dT%H:%M:%S'),
+            '--noheader',
+            '--parsable2',
+            f'--format={SACCT_FORMAT}'
+        ], capture_output=True, encoding='utf-8')
+        if result.returncode != 0:
+            raise BackendError(result.stderr.strip() or f'sacct exited with status {result.returncode}')
+        return [
+            job for job in parse_sacct_output(result.stdout)
+            if job.start_time is not None and start <= job.start_time < end
+        ]
+
+    def get_all_jobs(self):
+        now = self.clock()
+        if self.snapshot is None or now - self.snapshot_time > self.max_age:
+            self.snapshot = self.list_jobs()
+            self.snapshot_time = now
+        return self.snapshot
+
+    def list_jobs(self):
+        if self.use_json:
+            result = self.run_command(QUERY, ['squeue', '--all', '--json'],
+                capture_output=True, encoding='utf-8')
+            if result.returncode == 0:
+                return parse_squeue_json(result.stdout)
+            # Older versions of Slurm, and builds without the JSON plugin,
+            # reject --json.
+            self.use_json = False
+        result = self.run_command(QUERY, [
+            'squeue', '--all', '--noheader', f'--format={SQUEUE_FORMAT}'
+        ], capture_output=True, encoding='utf-8')
+        if result.returncode != 0:
+            raise BackendError(result.stderr.strip() or f'squeue exited with status {result.returncode}')
+        return parse_squeue_text(result.stdout)
+
+def parse_sbatch_job_id(s):
+    # sbatch --parsable prints "id" or "id;cluster".
+    job_id = s.strip().split(';', 1)[0]
+    return job_id or None
+
+def parse_squeue_json(s):
+    jobs = []
+    for d in json.loads(s)['jobs']:
+        # Newer versions of Slurm give the state as a list of flags.
+        state = d['job_state']
+        if isinstance(state, list):
+            state = state[0]
+        if state not in FINISHED_STATES:
+            jobs.append(json_to_job(d, state))
+    return jobs
+
+def json_to_job(d, state):
+    # Newer versions of Slurm wrap numbers in {"set": ..., "number": ...}.
+    job_id = str(get_json_number(d['job_id']))
+    array_task_id = get_json_number(d.get('array_task_id'))
+    if array_task_id is not None:
+        job_id = f'{get_json_number(d["array_job_id"])}_{array_task_id}'
+    state = convert_state(state, d.get('state_reason'))
+    start_time = get_json_number(d.get('start_time'))
+    if state in RUNNING_STATES and start_time:
+        since = start_time
+    else:
+        since = get_json_number(d.get('submit_time'))
+    return Job(
+        id=job_id,
+        user=d['user_name'],
+        name=d['name'],
+        slots=get_json_number(d.get('cpus')) or 1,
+        state=state,
+        queue=d['partition'],
+        since=datetime.datetime.fromtimestamp(since) if since else None
+    )
+
+def get_json_number(value):
+    if isinstance(value, dict):
+        if value.get('set', True) and not value.get('infinite', False):
+            return value.get('number')
+        else:
+            return None
+    else:
+        return value
+
+def parse_squeue_text(s):
+    jobs = []
+    for line in s.splitlines():
+        if not line:
+            continue
+        job_id, user, cpus, state, partition, submit_time, start_time, reason, name = \
+            line.split('|', SQUEUE_FORMAT_FIELDS - 1)
+        if state in FINISHED_STATES:
+            continue
+        state = convert_state(state, reason)
+        if state in RUNNING_STATES and start_time not in ('N/A', 'Unknown'):
+            since = start_time
+        else:
+            since = submit_time
+        jobs.append(Job(
+            id=job_id,
+            user=user,
+            name=name,
+            slots=int(cpus),
+            state=state,
+            queue=partition,
+            since=datetime.datetime.fromisoformat(since) if since not in ('N/A', 'Unknown') else None
+        ))
+    return jobs
+
+def convert_state(state, reason=None):
+    result = SLURM_STATES.get(state, state.lower())
+    if 'q' in result and reason in ERROR_REASONS:
+        result = 'Eqw'
+    elif state == 'PENDING' and reason is not None and 'Held' in reason:
+        result = 'h' + result
+    return result
+
+def parse_sacct_output(s):
+    # Each job is followed by its steps (e.g. "123.batch"), which are the
+    # only lines that report memory use.
+    jobs = collections.OrderedDict()
+    for line in s.splitlines():
+        if not line:
+            continue
+        job_id, partition, start, end, exit_code, max_rss, state, name = \
+            line.split('|', SACCT_FORMAT_FIELDS - 1)
+        job_id, dot, step = job_id.partition('.')
+        if dot:
+            job = jobs.get(job_id)
+            memory = parse_memory(max_rss) if max_rss else None
+            if job is not None and memory is not None:
+                job.max_memory = max(job.max_memory or 0.0, memory)
+            continue
+        # States may have details appended, e.g. "CANCELLED by 123".
+        state = state.split()[0] if state else state
+        if state in UNFINISHED_STATES or end in ('', 'Unknown'):
+            continue
+        exit_status = int(exit_code.split(':')[0])
+        jobs[job_id] = FinishedJob(
+            id=job_id,
+            name=name,
+            queue=partition,
+            start_time=parse_sacct_date(start),
+            end_time=parse_sacct_date(end),
+            exit_status=exit_status,
+            failed=state != 'COMPLETED' or exit_status != 0
+        )
+    return list(jobs.values())
+
+def parse_sacct_date(s):
+    if s in ('', 'None', 'Unknown'):
+        return None
+    return datetime.datetime.fromisoformat(s)
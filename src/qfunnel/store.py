@@ -0,0 +1,92 @@
+import contextlib
+import os
+import pathlib
+import sqlite3
+import time
+
+from .program import Store
+from .real_backend import NETWORK_FILESYSTEMS, get_filesystem_type
+
+# How often, in seconds, LocalSnapshotStore exports the database by default.
+SNAPSHOT_INTERVAL = 300.0
+
+class SqliteStore(Store):
+    """A database in a file at a given path."""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = pathlib.Path(path)
+
+    def connect(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        return sqlite3.connect(self.path, timeout=60.0)
+
+    def supports_wal(self):
+        fs_type = get_filesystem_type(self.path.parent)
+        return fs_type is not None and fs_type not in NETWORK_FILESYSTEMS
+
+class LocalSnapshotStore(SqliteStore):
+    """A database on node-local disk, which is much faster than a network
+    filesystem and supports WAL mode, with a copy exported to a more durable
+    location (e.g. the home directory) at most every interval seconds.
+
+    If the local database is missing, for example because the node was
+    rebooted, it is restored from the latest export. Any changes made since
+    that export are lost. All commands that share the database must run on
+    the same node."""
+
+    def __init__(self, path, snapshot_path, interval=SNAPSHOT_INTERVAL, clock=time.time):
+        super().__init__(path)
+        self.snapshot_path = pathlib.Path(snapshot_path)
+        self.interval = interval
+        self.clock = clock
+
+    def connect(self):
+        if not self.path.exists() and self.snapshot_path.exists():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # A leftover write-ahead log belongs to the lost database and
+            # must not be applied to the restored one.
+            for suffix in ['-wal', '-shm']:
+                try:
+                    self.path.with_name(self.path.name + suffix).unlink()
+                except FileNotFoundError:
+                    pass
+            with contextlib.closing(sqlite3.connect(self.snapshot_path, timeout=60.0)) as source:
+                copy_database(source, self.path)
+        return super().connect()
+
+    def sync(self, conn):
+        # The modification time of the export records when it was made, so
+        # that every process agrees on when the next one is due.
+        try:
+            last_export = self.snapshot_path.stat().st_mtime
+        except FileNotFoundError:
+            last_export = None
+        if last_export is None or self.clock() - last_export >= self.interval:
+            self.export(conn)
+
+    def export(self, conn):
+        self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        copy_database(conn, self.snapshot_path)
+
+def copy_database(source, path):
+    # Write a consistent copy to a temporary file next to the destination,
+    # then move it into place, so that readers of the destination never see a
+    # partial copy.
+    path = pathlib.Path(path)
+    temp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        dest = sqlite3.connect(temp_path)
+        try:
+            source.backup(dest)
+            # The copy may end up on a filesystem without WAL support.
+            dest.execute('pragma journal_mode = delete')
+        finally:
+            dest.close()
+        os.replace(temp_path, path)
+    except:
+        try:
+            temp_path.unlink()
+        except FileNotFoundError:
+            pass
+        raise
@@ -0,0 +1,52 @@
+import re
+
+PARAMETER_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+INTEGER_RANGE_RE = re.compile(r'^(-?[0-9]+)\.\.(-?[0-9]+)$')
+
+def parse_axis(s):
+    """Parse a sweep axis such as "lr=0.1,0.01" or "seed=1..10" (an
+    inclusive range of integers) into its name and list of values."""
+    name, sep, values_str = s.partition('=')
+    if not sep or not PARAMETER_NAME_RE.match(name):
+        raise ValueError(f'invalid axis: {s!r}')
+    return name, parse_values(values_str)
+
+def parse_values(s):
+    """Parse a comma-separated list of values, in which "1..10" stands for
+    an inclusive range of integers."""
+    values = []
+    for item in s.split(','):
+        m = INTEGER_RANGE_RE.match(item)
+        if m is not None:
+            start, end = int(m.group(1)), int(m.group(2))
+            if end < start:
+                raise ValueError(f'empty range: {item!r}')
+            values.extend(str(i) for i in range(start, end + 1))
+        else:
+            values.append(item)
+    return values
+
+def get_sweep_size(axes):
+    size = 1
+    for name, values in axes:
+        size *= len(values)
+    return size
+
+def get_point(axes, index):
+    """Return the parameter values of the point with the given index, in the
+    same order as itertools.product(), without enumerating the points before
+    it."""
+    result = {}
+    for name, values in reversed(axes):
+        index, i = divmod(index, len(values))
+        result[name] = values[i]
+    return result
+
+def fill_template(template, point):
+    """Replace each {parameter} in a string with its value. Braces around
+    anything else are left alone, so that templates can contain e.g. shell
+    syntax."""
+    if not point:
+        return template
+    pattern = '|'.join(re.escape(name) for name in point)
+    return re.sub(r'\{(' + pattern + r')\}', lambda m: point[m.group(1)], template)
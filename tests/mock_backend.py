@@ -4,7 +4,7 @@ import datetime
 import sqlite3
 import tempfile
 
-from qfunnel.program import Backend, Job
+from qfunnel.program import Backend, BackendError, FinishedJob, Job
 
 class MockBackend(Backend):
 
@@ -14,22 +14,42 @@ class MockBackend(Backend):
         self.running_jobs_by_name = {}
         self.job_id_counter = 0
         self.capacities = {}
+        self.cwd = '/fake/directory'
+        self.commands_by_name = {}
+        self.current_time = datetime.datetime(2022, 7, 9)
+        self.daemon_id = 'localhost:1'
+        self.finished_jobs = []
 
     def get_cwd(self):
-        return '/fake/directory'
+        return self.cwd
+
+    def get_current_time(self):
+        return self.current_time
 
     def get_own_user(self):
         return 'myuser'
 
+    def get_daemon_id(self):
+        return self.daemon_id
+
     def connect_to_db(self):
         return sqlite3.connect(self.db_file_name)
 
+    def db_supports_wal(self):
+        return True
+
     def submit_job(self, queue, name, args, cwd):
-        self.add_job(queue, name)
+        job = self.add_job(queue, name)
+        self.commands_by_name[name] = (args, cwd)
+        return job.id
 
     def delete_jobs(self, job_ids):
+        unknown_job_ids = [job_id for job_id in job_ids if self.job_id_to_name(job_id) is None]
         for job_id in job_ids:
-            self.finish_job(self.job_id_to_name(job_id))
+            if job_id not in unknown_job_ids:
+                self.finish_job(self.job_id_to_name(job_id))
+        if unknown_job_ids:
+            raise BackendError(f'unknown jobs: {" ".join(unknown_job_ids)}')
 
     def get_own_jobs(self):
         own_user = self.get_own_user()
@@ -46,6 +66,12 @@ class MockBackend(Backend):
     def get_running_jobs_in_queue(self, queue):
         return [job for job in self.get_all_jobs() if job.queue == queue and job.state == 'r']
 
+    def get_pending_jobs_in_queue(self, queue):
+        return [job for job in self.get_all_jobs() if job.queue == queue and job.state == 'qw']
+
+    def get_finished_jobs(self, start, end):
+        return [job for job in self.finished_jobs if start <= job.start_time <= end]
+
     def add_job(self, queue, name, user=None):
         if user is None:
             user = self.get_own_user()
@@ -60,7 +86,7 @@ class MockBackend(Backend):
                 state = 'qw'
         else:
             state = 'r'
-        self.running_jobs_by_name[name] = Job(
+        job = self.running_jobs_by_name[name] = Job(
             id=str(self.job_id_counter),
             user=user,
             name=name,
@@ -70,6 +96,7 @@ class MockBackend(Backend):
             since=datetime.datetime(2022, 7, 9)
         )
         self.job_id_counter += 1
+        return job
 
     def jobs_with_state(self, state):
         result = collections.defaultdict(set)
@@ -92,8 +119,19 @@ class MockBackend(Backend):
             if job.id == job_id:
                 return job.name
 
-    def finish_job(self, name):
+    def finish_job(self, name, exit_status=0, max_memory=None):
         old_job = self.running_jobs_by_name.pop(name)
+        if old_job.user == self.get_own_user() and old_job.state == 'r':
+            self.finished_jobs.append(FinishedJob(
+                id=old_job.id,
+                name=old_job.name,
+                queue=old_job.queue,
+                start_time=old_job.since,
+                end_time=self.current_time,
+                exit_status=exit_status,
+                failed=exit_status != 0,
+                max_memory=max_memory
+            ))
         pending_jobs = self.get_own_pending_jobs()
         if pending_jobs:
             pending_jobs[0].state = 'r'
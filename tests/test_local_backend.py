@@ -0,0 +1,136 @@
+import datetime
+import pathlib
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+import pytest
+
+from qfunnel.config import load_config
+from qfunnel.local_backend import LocalBackend
+from qfunnel.program import BackendError, Program
+
+class TempLocalBackend(LocalBackend):
+
+    def __init__(self, temp_dir, max_processes):
+        super().__init__(temp_dir / 'local.db', max_processes)
+        self.temp_dir = temp_dir
+
+    def get_cwd(self):
+        return str(self.temp_dir)
+
+    def connect_to_db(self):
+        return sqlite3.connect(self.temp_dir / 'qfunnel.db')
+
+def wait_until_finished(program, backend):
+    max_running = 0
+    for i in range(200):
+        program.check()
+        jobs = backend.get_own_jobs()
+        max_running = max(max_running, sum(job.state == 'r' for job in jobs))
+        if program.count_own_jobs() == 0:
+            return max_running
+        time.sleep(0.05)
+    raise AssertionError('jobs did not finish')
+
+def test_local_backend(monkeypatch):
+    monkeypatch.setenv('USER', 'alice')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = pathlib.Path(temp_dir)
+        backend = TempLocalBackend(temp_dir, max_processes=2)
+        program = Program(backend)
+        program.set_limit('gpu0', 1)
+        program.set_limit('gpu1', 1)
+        start = datetime.datetime.now() - datetime.timedelta(minutes=1)
+        for i in range(4):
+            program.submit(['gpu0', 'gpu1'], f'job{i}', ['sh', '-c', 'echo $QFUNNEL_QUEUE; sleep 0.2; exit 3'])
+        assert wait_until_finished(program, backend) == 2
+        finished = backend.get_finished_jobs(start, datetime.datetime.now())
+        assert len(finished) == 4
+        assert all(job.exit_status == 3 and job.failed for job in finished)
+        assert all(job.start_time <= job.end_time for job in finished)
+        for job in finished:
+            output = (temp_dir / f'{job.name}.o{job.id}').read_text()
+            assert output == f'{job.queue}\n'
+        # A new backend object sees the same jobs.
+        other = TempLocalBackend(temp_dir, max_processes=2)
+        assert len(other.get_finished_jobs(start, datetime.datetime.now())) == 4
+
+def test_local_backend_delete(monkeypatch):
+    monkeypatch.setenv('USER', 'alice')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = pathlib.Path(temp_dir)
+        backend = TempLocalBackend(temp_dir, max_processes=1)
+        running_id = backend.submit_job('cpu', 'long', ['sleep', '60'], str(temp_dir))
+        pending_id = backend.submit_job('cpu', 'next', ['sleep', '60'], str(temp_dir))
+        assert [(job.id, job.state) for job in backend.get_own_jobs()] == [
+            (running_id, 'r'),
+            (pending_id, 'qw')
+        ]
+        backend.delete_jobs([running_id])
+        # Deleting the running job makes room for the pending one.
+        assert [(job.id, job.state) for job in backend.get_own_jobs()] == [(pending_id, 'r')]
+        backend.delete_jobs([pending_id])
+        assert backend.get_own_jobs() == []
+        with pytest.raises(BackendError):
+            backend.delete_jobs([pending_id])
+
+def test_local_backend_config():
+    with tempfile.NamedTemporaryFile('w', suffix='.ini') as fout:
+        fout.write('[backend]\ntype = local\nmax_processes = 3\n')
+        fout.flush()
+        config = load_config(fout.name)
+        assert config.backend.type == 'local'
+        assert config.backend.max_processes == 3
+
+def test_local_backend_pid_reuse(monkeypatch):
+    monkeypatch.setenv('USER', 'alice')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = pathlib.Path(temp_dir)
+        backend = TempLocalBackend(temp_dir, max_processes=1)
+        job_id = backend.submit_job('cpu', 'long', ['sleep', '60'], str(temp_dir))
+        # Another qf process recognizes the job's process.
+        other = TempLocalBackend(temp_dir, max_processes=1)
+        assert [(job.id, job.state) for job in other.get_own_jobs()] == [(job_id, 'r')]
+        # Pretend that the job's process ID now belongs to an unrelated
+        # process, which must be neither mistaken for the job nor killed.
+        unrelated = subprocess.Popen(['sleep', '60'], start_new_session=True)
+        try:
+            with sqlite3.connect(temp_dir / 'local.db') as conn:
+                # The job's process started before the unrelated one.
+                conn.execute('update "local_jobs" set "pid" = ?, "process_start" = "process_start" - 1', (unrelated.pid,))
+            assert other.get_own_jobs() == []
+            with pytest.raises(BackendError):
+                other.delete_jobs([job_id])
+            assert unrelated.poll() is None
+        finally:
+            unrelated.kill()
+            unrelated.wait()
+            for process in backend.processes.values():
+                process.kill()
+                process.wait()
+
+def test_local_backend_delete_cleans_up(monkeypatch):
+    monkeypatch.setenv('USER', 'alice')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = pathlib.Path(temp_dir)
+        backend = TempLocalBackend(temp_dir, max_processes=1)
+        # The job outlives its shell for a moment after it is deleted, and
+        # writes the exit status file on its way out.
+        job_id = backend.submit_job('cpu', 'stubborn', ['sh', '-c',
+            'trap "sleep 0.3; echo 0 > .stubborn.s$QFUNNEL_JOB_ID" TERM; sleep 60 & wait'],
+            str(temp_dir))
+        time.sleep(0.2)
+        backend.delete_jobs([job_id])
+        assert backend.get_own_jobs() == []
+        status_file = temp_dir / f'.stubborn.s{job_id}'
+        for i in range(100):
+            time.sleep(0.05)
+            backend.get_own_jobs()
+            with sqlite3.connect(temp_dir / 'local.db') as conn:
+                lingering, = conn.execute('select "lingering" from "local_jobs"').fetchone()
+            if not lingering:
+                break
+        assert not lingering
+        assert not status_file.exists()
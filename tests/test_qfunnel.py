@@ -1,5 +1,15 @@
+import datetime
+import io
+import sqlite3
+
+import pytest
+
 from qfunnel.cli import Program
-from qfunnel.program import JobFilter
+from qfunnel.format import format_json_array, format_json_lines, format_tsv
+from qfunnel.program import BackendError, FinishedJob, JobFilter, Limit, LimitChange, RuntimeStats, TABLES_FILE
+from qfunnel.real_backend import RealBackend, dict_to_finished_job, parse_qacct_output
+from qfunnel.schedule import format_window, parse_window
+from qfunnel.sweep import parse_axis
 
 from mock_backend import get_mock_backend
 
@@ -262,3 +272,884 @@ def test_bump_nothing_and_everything_selected():
         for i in range(5, 10):
             assert jobs[i].state == '-'
             assert jobs[i].name == f'job-{i}'
+
+def test_submit_preserves_command():
+    with get_mock_backend() as backend:
+        backend.split_command = RealBackend().split_command
+        program = Program(backend)
+        program.set_limit('gpu@@a', 0)
+        expected = {}
+        for i in range(10):
+            args = ['-l', 'gpu_card=1', '-pe', 'smp', '4', '-cwd', 'train.bash', '--seed', str(i)]
+            if i % 2 == 0:
+                backend.cwd = '/fake/other'
+            else:
+                backend.cwd = '/fake/directory'
+            program.submit(['gpu@@a'], f'job-{i}', args, deferred=True)
+            expected[f'job-{i}'] = (args, backend.cwd)
+        with program.get_db_connection() as conn:
+            assert conn.execute('select count(*) from "command_prefixes"').fetchone() == (1,)
+            assert conn.execute('select count(*) from "cwds"').fetchone() == (2,)
+        program.set_limit('gpu@@a', 10)
+        program.check()
+        assert backend.commands_by_name == expected
+        with program.get_db_connection() as conn:
+            assert conn.execute('select count(*) from "command_prefixes"').fetchone() == (0,)
+            assert conn.execute('select count(*) from "cwds"').fetchone() == (0,)
+
+def test_split_command():
+    backend = RealBackend()
+    assert backend.split_command(['-l', 'gpu_card=1', 'job.bash', '--lr', '0.1']) == \
+        (['-l', 'gpu_card=1', 'job.bash'], ['--lr', '0.1'])
+    assert backend.split_command(['-V', '-pe', 'smp', '8', 'job.bash']) == \
+        (['-V', '-pe', 'smp', '8', 'job.bash'], [])
+    assert backend.split_command(['-l']) == (['-l'], [])
+
+def test_migrate_legacy_db():
+    with get_mock_backend() as backend:
+        conn = sqlite3.connect(backend.db_file_name)
+        conn.executescript(TABLES_FILE.read_text())
+        conn.execute('''insert into "jobs"("id", "name", "command_json", "cwd") values (7, 'old-job', '["-l","x","old.bash"]', '/old')''')
+        conn.execute('''insert into "job_queues"("job_id", "queue") values (7, 'gpu@@a')''')
+        conn.commit()
+        conn.close()
+        program = Program(backend)
+        jobs = program.list_own_jobs().jobs
+        assert [(job.id, job.name, job.queue) for job in jobs] == [('x7', 'old-job', 'gpu@@a')]
+        program.check()
+        assert backend.commands_by_name == { 'old-job' : (['-l', 'x', 'old.bash'], '/old') }
+
+def test_readers_do_not_wait_for_writer():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 0)
+        program.submit(['gpu@@a'], 'job', ['script.bash'])
+        with program.get_db_connection() as writer:
+            assert writer.execute('pragma journal_mode').fetchone() == ('wal',)
+            with program.lock_db(writer):
+                writer.execute('delete from "limits"')
+                backend.connect_to_db = lambda: sqlite3.connect(backend.db_file_name, timeout=0)
+                assert program.get_limit('gpu@@a') == 0
+                assert [job.name for job in program.list_own_jobs().jobs] == ['job']
+
+def test_rollback_journal_fallback():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.get_all_limits()
+        backend.db_supports_wal = lambda: False
+        with program.get_db_connection() as conn:
+            assert conn.execute('pragma journal_mode').fetchone() == ('delete',)
+
+def test_watch_reuses_connection(monkeypatch):
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 1)
+        for i in range(3):
+            program.submit(['gpu@@a'], f'job-{i}', ['script.bash'], deferred=True)
+        connect_to_db = backend.connect_to_db
+        connections = []
+        def counting_connect_to_db():
+            connections.append(None)
+            return connect_to_db()
+        backend.connect_to_db = counting_connect_to_db
+        cycles = []
+        def fake_sleep(seconds):
+            backend.finish_job(f'job-{len(cycles)}')
+            cycles.append(seconds)
+            if len(cycles) == 3:
+                raise KeyboardInterrupt
+        monkeypatch.setattr('time.sleep', fake_sleep)
+        try:
+            program.watch(1, stdout=io.StringIO(), stderr=io.StringIO())
+        except KeyboardInterrupt:
+            pass
+        assert len(connections) == 1
+        assert backend.running_jobs() == {}
+        assert program.list_own_jobs().jobs == []
+
+def test_job_events():
+    with get_mock_backend() as backend:
+        backend.set_capacity('gpu@@a', 1)
+        program = Program(backend)
+        program.set_limit('gpu@@a', 2)
+        for i in range(3):
+            program.submit(['gpu@@a'], f'job-{i}', ['script.bash'])
+        assert [(e.name, e.event) for e in program.get_job_events()] == [
+            ('job-0', 'submitted'),
+            ('job-0', 'started'),
+            ('job-1', 'submitted')
+        ]
+        backend.current_time = datetime.datetime(2022, 7, 10)
+        backend.finish_job('job-0')
+        backend.running_jobs_by_name['job-1'].state = 'Eqw'
+        program.check()
+        events = program.get_job_events(since=backend.current_time)
+        assert [(e.name, e.queue, e.event) for e in events] == [
+            ('job-1', 'gpu@@a', 'error'),
+            ('job-0', 'gpu@@a', 'finished'),
+            ('job-2', 'gpu@@a', 'submitted')
+        ]
+        assert all(e.time == backend.current_time for e in events)
+        # Old events are pruned, except those of jobs that are still there.
+        backend.current_time += datetime.timedelta(days=31)
+        program.check()
+        assert sorted({e.name for e in program.get_job_events()}) == ['job-1', 'job-2']
+
+def test_snapshot_avoids_per_queue_queries():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 2)
+        program.set_limit('gpu@@b', 2)
+        get_own_running_jobs_in_queue = backend.get_own_running_jobs_in_queue
+        queried_queues = []
+        def counting_get_own_running_jobs_in_queue(queue):
+            queried_queues.append(queue)
+            return get_own_running_jobs_in_queue(queue)
+        backend.get_own_running_jobs_in_queue = counting_get_own_running_jobs_in_queue
+        for i in range(6):
+            program.submit(['gpu@@a', 'gpu@@b'], f'job-{i}', ['script.bash'])
+        assert backend.running_jobs() == {
+            'gpu@@a' : {'job-0', 'job-1'},
+            'gpu@@b' : {'job-2', 'job-3'}
+        }
+        assert queried_queues == []
+        # A job submitted without qfunnel shows up already running, so its
+        # queue has to be looked up.
+        backend.add_job('gpu@@a', 'outside-job')
+        backend.finish_job('job-0')
+        backend.finish_job('job-2')
+        program.check()
+        assert queried_queues == ['gpu@@a']
+        assert backend.running_jobs() == {
+            'gpu@@a' : {'job-1', 'outside-job'},
+            'gpu@@b' : {'job-3', 'job-4'}
+        }
+        program.check()
+        assert queried_queues == ['gpu@@a']
+
+def test_submit_with_unknown_job_id():
+    with get_mock_backend() as backend:
+        # Some submit commands print output that the job ID cannot be
+        # parsed from (e.g. qsub -terse).
+        submit_job = backend.submit_job
+        def submit_job_without_id(queue, name, args, cwd):
+            submit_job(queue, name, args, cwd)
+            return None
+        backend.submit_job = submit_job_without_id
+        program = Program(backend)
+        program.set_limit('gpu@@a', 2)
+        for i in range(5):
+            program.submit(['gpu@@a'], f'job-{i}', ['script.bash'], deferred=True)
+        program.check()
+        assert backend.running_jobs() == {'gpu@@a' : {'job-0', 'job-1'}}
+        assert len(program.list_own_jobs().jobs) == 5
+        # The next snapshot replaces the placeholders with the real jobs.
+        backend.finish_job('job-0')
+        program.check()
+        assert backend.running_jobs() == {'gpu@@a' : {'job-1', 'job-2'}}
+        # Only the job submitted since then is still known by a placeholder.
+        events = program.get_job_events()
+        assert [e.name for e in events if (e.job_id or '').startswith('?')] == ['job-2']
+        assert [e.job_id for e in events if e.event == 'submitted' and e.name == 'job-1'] == \
+            [backend.running_jobs_by_name['job-1'].id]
+
+def test_wait_with_unknown_job_id(monkeypatch):
+    with get_mock_backend() as backend:
+        submit_job = backend.submit_job
+        def submit_job_without_id(queue, name, args, cwd):
+            submit_job(queue, name, args, cwd)
+            return None
+        backend.submit_job = submit_job_without_id
+        program = Program(backend)
+        program.submit(['gpu@@a'], 'job-0', ['script.bash'], deferred=True)
+        job, = program.list_own_jobs().jobs
+        program.check()
+        # The job is followed through its placeholder, and then through the
+        # job that the next snapshot finds in its place.
+        cycles = []
+        def fake_sleep(seconds):
+            cycles.append(seconds)
+            if len(cycles) == 2:
+                backend.finish_job('job-0')
+            program.check()
+        monkeypatch.setattr('time.sleep', fake_sleep)
+        result = program.wait([job.id], seconds=5, stderr=io.StringIO())
+        assert result.remaining == []
+        assert cycles == [5, 5]
+
+def test_iter_and_count_jobs():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 3)
+        program.set_limit('gpu@@b', 0)
+        for i in range(10):
+            program.submit(['gpu@@a', 'gpu@@b'], f'job-{i}', ['script.bash'])
+        program.submit(['gpu@@b'], 'other', ['script.bash'], deferred=True)
+        jobs = program.iter_own_jobs()
+        assert not isinstance(jobs, list)
+        assert [job.name for job in jobs] == [*(f'job-{i}' for i in range(10)), 'other']
+        jobs = program.iter_own_jobs(offset=2, limit=3)
+        assert [(job.name, job.state) for job in jobs] == [('job-2', 'r'), ('job-3', '-'), ('job-4', '-')]
+        jobs = program.iter_queue_jobs('gpu@@a', JobFilter(name='[05]'), offset=1)
+        assert [job.name for job in jobs] == ['job-5']
+        assert program.count_own_jobs() == 11
+        assert program.count_own_jobs(JobFilter(name='job')) == 10
+        assert program.count_queue_jobs('gpu@@a') == 10
+        assert program.count_queue_jobs('gpu@@b') == 8
+        assert program.count_queue_jobs('gpu@@b', JobFilter(name='other')) == 1
+
+def test_iter_jobs_releases_lock_between_pages(monkeypatch):
+    monkeypatch.setattr('qfunnel.program.LIST_PAGE_SIZE', 2)
+    with get_mock_backend() as backend:
+        # Without WAL, any open read transaction keeps writers out.
+        backend.db_supports_wal = lambda: False
+        program = Program(backend)
+        for i in range(5):
+            program.submit(['gpu@@a'], f'job-{i}', ['script.bash'], deferred=True)
+        names = []
+        for job in program.iter_own_jobs(offset=1):
+            names.append(job.name)
+            conn = sqlite3.connect(backend.db_file_name, timeout=0)
+            try:
+                conn.execute('begin exclusive')
+                conn.rollback()
+            finally:
+                conn.close()
+        assert names == ['job-1', 'job-2', 'job-3', 'job-4']
+        assert [job.name for job in program.iter_own_jobs(offset=1, limit=3)] == ['job-1', 'job-2', 'job-3']
+
+def test_machine_readable_formats():
+    assert list(format_json_array([])) == ['[]']
+    assert list(format_json_array([{'a' : 1}, {'a' : 2}])) == ['[{"a": 1}', ',{"a": 2}', ']']
+    assert list(format_json_lines([{'a' : 1}, {'a' : 2}])) == ['{"a": 1}', '{"a": 2}']
+    assert list(format_tsv(['a', 'b'], [['x\ty', 'z\\']])) == ['a\tb', 'x\\ty\tz\\\\']
+
+def test_job_filter():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 2)
+        program.set_limit('gpu@@b', 0)
+        for i in range(6):
+            backend.current_time = datetime.datetime(2022, 7, 9, i)
+            queues = ['gpu@@a'] if i % 2 == 0 else ['gpu@@b']
+            program.submit(queues, f'job-{i}', ['script.bash'], group='even' if i % 2 == 0 else 'odd')
+        def names(job_filter):
+            return [job.name for job in program.list_own_jobs(job_filter).jobs]
+        assert names(JobFilter(group='even')) == ['job-0', 'job-2', 'job-4']
+        assert names(JobFilter(group='even', states=['-'])) == ['job-4']
+        assert names(JobFilter(group='even', states=['r'])) == ['job-0', 'job-2']
+        assert names(JobFilter(queue='gpu@@b')) == ['job-1', 'job-3', 'job-5']
+        assert names(JobFilter(name='-[1-3]$')) == ['job-2', 'job-1', 'job-3']
+        assert names(JobFilter(
+            since=datetime.datetime(2022, 7, 9, 2),
+            until=datetime.datetime(2022, 7, 9, 5)
+        )) == ['job-3', 'job-4']
+        assert program.count_own_jobs(JobFilter(group='odd', name='[15]')) == 2
+        program.bump(JobFilter(group='odd', name='5'))
+        assert names(JobFilter(states=['-'])) == ['job-5', 'job-1', 'job-3', 'job-4']
+
+def test_job_filter_sql():
+    assert JobFilter().get_sql_condition() == ('1', [])
+    condition, params = JobFilter(name='a.c', states=['r', '-'], group='g').get_sql_condition()
+    assert params == ['a.c', 'g']
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        with program.get_db_connection() as conn:
+            assert conn.execute('select ? regexp ?', ('a.c', 'xabcx')).fetchone() == (0,)
+            assert conn.execute('select ? regexp ?', ('xabcx', 'a.c')).fetchone() == (1,)
+
+def test_delete_matching(monkeypatch):
+    monkeypatch.setattr('qfunnel.program.DELETE_CHUNK_SIZE', 2)
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 5)
+        for i in range(10):
+            program.submit(['gpu@@a'], f'sweep-{i}', ['script.bash'])
+        for i in range(3):
+            program.submit(['gpu@@a'], f'keep-{i}', ['script.bash'])
+        result = program.delete_matching(JobFilter(name='sweep', states=['-']))
+        assert result.num_local_jobs == 5
+        assert result.backend_jobs == []
+        assert [job.name for job in program.list_own_jobs().jobs] == [
+            *(f'sweep-{i}' for i in range(5)),
+            *(f'keep-{i}' for i in range(3))
+        ]
+        result = program.delete_matching(JobFilter(name='sweep-[0-2]'), local_only=True)
+        assert result.num_local_jobs == 0
+        assert backend.running_jobs() == { 'gpu@@a' : {f'sweep-{i}' for i in range(5)} }
+        result = program.delete_matching(JobFilter(name='sweep-[0-2]'))
+        assert result.num_local_jobs == 0
+        assert sorted(result.backend_jobs) == ['0', '1', '2']
+        assert backend.running_jobs() == { 'gpu@@a' : {'sweep-3', 'sweep-4'} }
+
+def test_delete_reports_failures(monkeypatch):
+    monkeypatch.setattr('qfunnel.program.DELETE_CHUNK_SIZE', 2)
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 4)
+        for i in range(6):
+            program.submit(['gpu@@a'], f'job-{i}', ['script.bash'])
+        result = program.delete(['0', '1', '2', '99', 'x1', 'x2'])
+        assert result.num_local_jobs == 2
+        assert result.backend_jobs == ['0', '1']
+        assert len(result.failures) == 1
+        assert result.failures[0].job_ids == ['2', '99']
+        assert backend.running_jobs() == { 'gpu@@a' : {'job-3'} }
+        assert program.count_own_jobs() == 1
+
+def test_pending_headroom():
+    with get_mock_backend() as backend:
+        backend.set_capacity('gpu@@a', 2)
+        program = Program(backend)
+        program.set_limit('gpu@@a', 2, pending=1)
+        assert program.get_limit_settings() == [Limit('gpu@@a', 2, 1)]
+        for i in range(5):
+            program.submit(['gpu@@a'], f'job-{i}', ['script.bash'])
+        assert backend.running_jobs() == { 'gpu@@a' : {'job-0', 'job-1'} }
+        assert backend.pending_jobs() == { 'gpu@@a' : {'job-2'} }
+        # The backend starts the pending job as soon as a slot frees up.
+        backend.finish_job('job-0')
+        assert backend.running_jobs() == { 'gpu@@a' : {'job-1', 'job-2'} }
+        program.check()
+        assert backend.pending_jobs() == { 'gpu@@a' : {'job-3'} }
+        assert program.count_own_jobs(JobFilter(states=['-'])) == 1
+        program.set_limit('gpu@@a', 2)
+        backend.finish_job('job-1')
+        program.check()
+        assert backend.running_jobs() == { 'gpu@@a' : {'job-2', 'job-3'} }
+        assert backend.pending_jobs() == {}
+
+def test_limit_schedules():
+    with get_mock_backend() as backend:
+        # Saturday at noon.
+        backend.current_time = datetime.datetime(2022, 7, 9, 12)
+        backend.set_capacity('gpu@@a', 10)
+        program = Program(backend)
+        with pytest.raises(ValueError):
+            program.add_limit_schedule('gpu@@a', *parse_window('Sat,Sun 00:00-24:00'), 3)
+        program.set_limit('gpu@@a', 1)
+        weekend_id = program.add_limit_schedule('gpu@@a', *parse_window('Sat,Sun 00:00-24:00'), 3)
+        program.add_limit_schedule('gpu@@a', *parse_window('Mon-Fri 18:00-08:00'), 2, pending=1)
+        assert program.get_limit('gpu@@a') == 3
+        assert program.get_limit_settings() == [
+            Limit('gpu@@a', 3, next_change=LimitChange(datetime.datetime(2022, 7, 11), 1))
+        ]
+        for i in range(5):
+            program.submit(['gpu@@a'], f'job-{i}', ['script.bash'])
+        assert backend.running_jobs() == { 'gpu@@a' : {'job-0', 'job-1', 'job-2'} }
+        backend.current_time = datetime.datetime(2022, 7, 11, 12)
+        assert program.get_limit_settings()[0].next_change == \
+            LimitChange(datetime.datetime(2022, 7, 11, 18), 2, 1)
+        backend.finish_job('job-0')
+        program.check()
+        assert backend.running_jobs() == { 'gpu@@a' : {'job-1', 'job-2'} }
+        # The overnight window carries over into Tuesday morning.
+        backend.current_time = datetime.datetime(2022, 7, 12, 7, 59)
+        assert program.get_limit('gpu@@a') == 2
+        backend.finish_job('job-1')
+        backend.finish_job('job-2')
+        program.check()
+        assert backend.running_jobs() == { 'gpu@@a' : {'job-3', 'job-4'} }
+        program.delete_limit_schedule(weekend_id)
+        assert len(program.get_limit_schedules()) == 1
+        program.delete_limit('gpu@@a')
+        assert program.get_limit_schedules() == []
+
+def test_parse_window():
+    assert parse_window('Mon-Fri 18:00-08:00') == (0b0011111, 18 * 60, 8 * 60)
+    assert parse_window('sat,sun 00:00-24:00') == (0b1100000, 0, 24 * 60)
+    assert parse_window('Fri-Mon 9:30-17:00') == (0b1110001, 9 * 60 + 30, 17 * 60)
+    assert parse_window('22:00-06:00') == (0b1111111, 22 * 60, 6 * 60)
+    assert format_window(*parse_window('Sat,Sun 00:00-24:00')) == 'Sat,Sun 00:00-24:00'
+    assert format_window(*parse_window('22:00-06:00')) == 'daily 22:00-06:00'
+    assert format_window(*parse_window('Mon-Wed,Fri 18:00-08:00')) == 'Mon-Wed,Fri 18:00-08:00'
+    for s in ['Mon 10:00-10:00', 'Someday 10:00-11:00', '25:00-26:00', 'Mon 10:00']:
+        with pytest.raises(ValueError):
+            parse_window(s)
+
+def test_status():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 2)
+        for i in range(6):
+            program.submit(['gpu@@a'], f'job-{i}', ['script.bash'])
+        program.check()
+        backend.current_time += datetime.timedelta(hours=1)
+        backend.finish_job('job-0')
+        backend.finish_job('job-1')
+        program.check()
+        assert backend.running_jobs() == { 'gpu@@a' : {'job-2', 'job-3'} }
+        info = program.get_status()
+        assert info.snapshot_time == backend.current_time
+        status, = info.queues
+        assert status.queue == 'gpu@@a'
+        assert status.limit == 2
+        # Jobs submitted during the last check count as queued until the
+        # next one.
+        assert (status.buffered, status.pending, status.running) == (2, 2, 0)
+        assert status.dispatched_per_hour == 4
+        assert status.completed_per_hour == 2
+        assert status.mean_runtime == 3600
+        assert status.eta == datetime.timedelta(hours=2)
+        assert info.total.buffered == 2
+        assert info.total.eta == datetime.timedelta(hours=2)
+        # History older than the window is ignored. With no recent
+        # completions, the estimate falls back to the limit and the mean run
+        # time.
+        backend.current_time += datetime.timedelta(hours=30)
+        status, = program.get_status(hours=24).queues
+        assert status.completed_per_hour == 0
+        assert status.mean_runtime == 3600
+        assert status.eta == datetime.timedelta(hours=2)
+
+def test_leader_lease(monkeypatch):
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 1)
+        program.submit(['gpu@@a'], 'job-0', ['script.bash'], deferred=True)
+        # Another daemon holds the lease.
+        with program.get_db_connection() as conn:
+            program.renew_lease(conn, 'otherhost:2', 60)
+        assert program.get_status().leader.holder == 'otherhost:2'
+        stdout = io.StringIO()
+        running_jobs = []
+        def fake_sleep(seconds):
+            running_jobs.append(backend.running_jobs())
+            if len(running_jobs) == 2:
+                assert program.get_status().leader.holder == 'localhost:1'
+                raise KeyboardInterrupt
+            # The other daemon stops renewing the lease.
+            backend.current_time += datetime.timedelta(seconds=61)
+        monkeypatch.setattr('time.sleep', fake_sleep)
+        try:
+            program.watch(30, stdout=stdout, stderr=io.StringIO())
+        except KeyboardInterrupt:
+            pass
+        assert running_jobs == [{}, { 'gpu@@a' : {'job-0'} }]
+        assert 'standing by; otherhost:2 is the leader' in stdout.getvalue()
+        # The lease is released when the daemon stops.
+        assert program.get_status().leader is None
+        with program.get_db_connection() as conn:
+            lease = program.renew_lease(conn, 'localhost:1', 90)
+            assert lease.expires_at == backend.current_time + datetime.timedelta(seconds=90)
+            assert program.renew_lease(conn, 'otherhost:2', 90).holder == 'localhost:1'
+
+def test_leader_lease_slow_cycle(monkeypatch):
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        for i in range(4):
+            program.submit(['gpu@@a'], f'job-{i}', ['script.bash'], deferred=True)
+        # Waiting to submit takes longer than the lease would last on its
+        # own, while another daemon tries to take over.
+        takeover_attempts = []
+        def slow_reserve_submission():
+            backend.current_time += datetime.timedelta(seconds=40)
+            with program.get_db_connection() as conn:
+                takeover_attempts.append(program.renew_lease(conn, 'otherhost:2', 60).holder)
+        backend.reserve_submission = slow_reserve_submission
+        def fake_sleep(seconds):
+            raise KeyboardInterrupt
+        monkeypatch.setattr('time.sleep', fake_sleep)
+        stdout = io.StringIO()
+        try:
+            program.watch(30, stdout=stdout, stderr=io.StringIO(), lease_seconds=60)
+        except KeyboardInterrupt:
+            pass
+        assert takeover_attempts == ['localhost:1'] * 4
+        assert backend.running_jobs() == {'gpu@@a' : {'job-0', 'job-1', 'job-2', 'job-3'}}
+        # A daemon that loses the lease anyway stops dispatching.
+        for i in range(4, 8):
+            program.submit(['gpu@@a'], f'job-{i}', ['script.bash'], deferred=True)
+        reservations = []
+        def stolen_reserve_submission():
+            reservations.append(None)
+            if len(reservations) == 2:
+                with program.get_db_connection() as conn:
+                    conn.execute('update "leader_lease" set "holder" = ?', ('otherhost:2',))
+                    conn.commit()
+        backend.reserve_submission = stolen_reserve_submission
+        try:
+            program.watch(30, stdout=stdout, stderr=io.StringIO(), lease_seconds=60)
+        except KeyboardInterrupt:
+            pass
+        assert 'lost leadership to otherhost:2' in stdout.getvalue()
+        assert backend.running_jobs()['gpu@@a'] == {'job-0', 'job-1', 'job-2', 'job-3', 'job-4'}
+
+def test_sweep():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 2)
+        program.submit(['gpu@@a'], 'before', ['script.bash'], deferred=True)
+        program.sweep(
+            ['gpu@@a'],
+            'train-{lr}-{seed}',
+            ['-l', 'h_rt=1:00:00', 'train.bash', '--lr', '{lr}', '--seed={seed}', '${HOME}'],
+            [parse_axis('lr=0.1,0.01'), parse_axis('seed=1..3')],
+            deferred=True
+        )
+        program.submit(['gpu@@a'], 'after', ['script.bash'], deferred=True)
+        # Only one point of the sweep is stored at a time.
+        with program.get_db_connection() as conn:
+            assert conn.execute('select count(*) from "jobs"').fetchone() == (3,)
+        jobs = program.list_own_jobs().jobs
+        assert [job.name for job in jobs] == ['before', 'train-{lr}-{seed}', 'after']
+        assert (jobs[1].sweep.size, jobs[1].sweep.remaining) == (6, 6)
+        assert [job.name for job in program.expand_sweeps(jobs)] == [
+            'before',
+            'train-0.1-1', 'train-0.1-2', 'train-0.1-3',
+            'train-0.01-1', 'train-0.01-2', 'train-0.01-3',
+            'after'
+        ]
+        program.check()
+        assert backend.running_jobs() == { 'gpu@@a' : {'before', 'train-0.1-1'} }
+        assert backend.commands_by_name['train-0.1-1'][0] == \
+            ['-l', 'h_rt=1:00:00', 'train.bash', '--lr', '0.1', '--seed=1', '${HOME}']
+        # The next point takes the place of the dispatched one, ahead of
+        # jobs submitted after the sweep.
+        jobs = program.list_own_jobs(JobFilter(states=['-'])).jobs
+        assert [(job.name, job.sweep.remaining if job.sweep else None) for job in jobs] == \
+            [('train-{lr}-{seed}', 5), ('after', None)]
+        for name in ['before', 'train-0.1-1', 'train-0.1-2', 'train-0.1-3']:
+            backend.finish_job(name)
+            program.check()
+        backend.finish_job('train-0.01-2')
+        program.check()
+        assert backend.running_jobs() == { 'gpu@@a' : {'train-0.01-1', 'train-0.01-3'} }
+        jobs = program.list_own_jobs(JobFilter(states=['-'])).jobs
+        assert [job.name for job in jobs] == ['after']
+        with program.get_db_connection() as conn:
+            assert conn.execute('select count(*) from "sweeps"').fetchone() == (0,)
+
+def test_delete_sweep():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 0)
+        program.sweep(['gpu@@a'], 'job-{i}', ['script.bash', '{i}'], [('i', ['1', '2', '3'])])
+        # The sweep's entry counts as all of its jobs.
+        assert program.count_own_jobs() == 3
+        assert program.count_queue_jobs('gpu@@a') == 3
+        status = program.get_status()
+        assert [(queue.queue, queue.buffered) for queue in status.queues] == [('gpu@@a', 3)]
+        assert status.total.buffered == 3
+        job, = program.list_own_jobs().jobs
+        assert program.delete([job.id]).num_local_jobs == 3
+        assert program.list_own_jobs().jobs == []
+        with program.get_db_connection() as conn:
+            assert conn.execute('select count(*) from "sweeps"').fetchone() == (0,)
+            assert conn.execute('select count(*) from "cwds"').fetchone() == (0,)
+
+def test_sweep_name_filter():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 0)
+        program.submit(['gpu@@a'], 'train-0.1', ['script.bash'])
+        program.sweep(['gpu@@a'], 'train-{lr}', ['script.bash', '{lr}'], [parse_axis('lr=0.1,0.2,0.3')])
+        # Names are matched against the sweep's template, the name it is
+        # listed under, not against its next point.
+        assert [job.name for job in program.list_own_jobs(JobFilter(name='^train-0.1$')).jobs] == ['train-0.1']
+        result = program.delete_matching(JobFilter(name='^train-0.1$'))
+        assert result.num_local_jobs == 1
+        jobs = program.list_own_jobs().jobs
+        assert [(job.name, job.sweep.remaining) for job in jobs] == [('train-{lr}', 3)]
+        program.submit(['gpu@@a'], 'other', ['script.bash'])
+        program.bump(JobFilter(name='^other$'))
+        assert [job.name for job in program.list_own_jobs().jobs] == ['other', 'train-{lr}']
+        program.bump(JobFilter(name=r'^train-\{lr\}$'))
+        assert [job.name for job in program.list_own_jobs().jobs] == ['train-{lr}', 'other']
+
+def test_adaptive_limit():
+    with get_mock_backend() as backend:
+        backend.set_capacity('gpu@@a', 6)
+        for i in range(12):
+            backend.add_job('gpu@@a', f'other-{i}', 'otheruser')
+        program = Program(backend)
+        program.set_limit('gpu@@a', 20, floor=0)
+        program.set_limit('gpu@@b', 5)
+        # Other users' jobs are counted once per check, only for adaptive
+        # limits, and without holding the write lock.
+        get_other_users_occupancy = backend.get_other_users_occupancy
+        occupancy_queries = []
+        def checking_get_other_users_occupancy(queues):
+            conn = sqlite3.connect(backend.db_file_name, timeout=0)
+            try:
+                conn.execute('begin immediate')
+                conn.rollback()
+            finally:
+                conn.close()
+            occupancy_queries.append(queues)
+            return get_other_users_occupancy(queues)
+        backend.get_other_users_occupancy = checking_get_other_users_occupancy
+        # Before the first check, the ceiling applies.
+        assert program.get_limit_settings() == [Limit('gpu@@a', 20, floor=0, ceiling=20), Limit('gpu@@b', 5)]
+        # Half of the other users' jobs are waiting.
+        program.check()
+        assert program.get_limit('gpu@@a') == 10
+        for i in range(6, 11):
+            backend.finish_job(f'other-{i}')
+        program.check()
+        assert program.get_limit('gpu@@a') == 17
+        # Small changes in contention do not change the limit.
+        backend.add_job('gpu@@a', 'other-12', 'otheruser')
+        program.check()
+        assert program.get_limit('gpu@@a') == 17
+        # Once nobody else is waiting, the whole ceiling is used.
+        backend.finish_job('other-11')
+        backend.finish_job('other-12')
+        program.check()
+        assert program.get_limit('gpu@@a') == 20
+        assert occupancy_queries == [['gpu@@a']] * 4
+        with pytest.raises(ValueError):
+            program.set_limit('gpu@@a', 5, floor=6)
+
+def test_wait(monkeypatch):
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 1)
+        program.submit(['gpu@@a'], 'job-0', ['script.bash'], group='g')
+        program.submit(['gpu@@a'], 'job-1', ['script.bash'], group='g')
+        program.submit(['gpu@@a'], 'other', ['script.bash'], deferred=True)
+        job_0, job_1, other = program.list_own_jobs().jobs
+        assert (job_0.id, job_1.id) == ('0', 'x1')
+        # Waiting itself never queries the backend; only the daemon does.
+        queries = []
+        get_own_jobs = backend.get_own_jobs
+        def counting_get_own_jobs():
+            queries.append(None)
+            return get_own_jobs()
+        backend.get_own_jobs = counting_get_own_jobs
+        cycles = []
+        def fake_sleep(seconds):
+            cycles.append(seconds)
+            backend.finish_job(['job-0', 'job-1'][len(cycles) - 1])
+            program.check()
+        monkeypatch.setattr('time.sleep', fake_sleep)
+        # The locally buffered job is followed after it is submitted.
+        result = program.wait(['x1'], seconds=5, stderr=io.StringIO())
+        assert result.remaining == [] and result.failed == []
+        assert cycles == [5, 5]
+        assert len(queries) == 2
+        assert backend.running_jobs() == { 'gpu@@a' : {'other'} }
+        # Jobs stuck in an error state end the wait.
+        backend.running_jobs_by_name['other'].state = 'Eqw'
+        program.check()
+        result = program.wait(job_filter=JobFilter(name='^other$'), stderr=io.StringIO())
+        assert [job.name for job in result.failed] == ['other']
+        assert len(queries) == 3
+        # Time out while the jobs in the group are still buffered.
+        program.submit(['gpu@@a'], 'job-2', ['script.bash'], group='g')
+        clock = [0.0]
+        monkeypatch.setattr('time.monotonic', lambda: clock[0])
+        def slow_sleep(seconds):
+            clock[0] += seconds
+        monkeypatch.setattr('time.sleep', slow_sleep)
+        stderr = io.StringIO()
+        result = program.wait(job_filter=JobFilter(group='g'), timeout=12, seconds=5, stderr=stderr)
+        assert result.timed_out
+        assert [job.name for job in result.remaining] == ['job-2']
+        assert clock == [12.0]
+        assert len(queries) == 4
+        assert 'no daemon is running' in stderr.getvalue()
+
+def test_ingest_accounting():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 5)
+        for name in ['train-1', 'train-2', 'eval-10', 'train-3']:
+            program.submit(['gpu@@a'], name, ['script.bash'])
+        windows = []
+        get_finished_jobs = backend.get_finished_jobs
+        def counting_get_finished_jobs(start, end):
+            windows.append((start, end))
+            return get_finished_jobs(start, end)
+        backend.get_finished_jobs = counting_get_finished_jobs
+        backend.current_time += datetime.timedelta(hours=1)
+        backend.finish_job('train-1', max_memory=2 * 1024 ** 3)
+        backend.finish_job('train-2', exit_status=1, max_memory=1024 ** 3)
+        backend.finish_job('eval-10')
+        program.check()
+        with program.get_db_connection() as conn:
+            # The first read covers the last week, one day at a time, up to
+            # the start of the job that is still running.
+            program.ingest_accounting(conn)
+            assert len(windows) == 7
+            assert windows[-1][1] == datetime.datetime(2022, 7, 9)
+            assert program.get_runtime_stats() == [
+                RuntimeStats('eval-#', 'gpu@@a', 1, 0, 3600.0, 3600.0, None),
+                RuntimeStats('train-#', 'gpu@@a', 2, 1, 3600.0, 3600.0, 2 * 1024 ** 3)
+            ]
+            # Reads happen at most once an hour.
+            backend.current_time += datetime.timedelta(minutes=30)
+            backend.finish_job('train-3')
+            program.check()
+            program.ingest_accounting(conn)
+            assert len(windows) == 7
+            # Records that were already read are not counted twice.
+            backend.current_time += datetime.timedelta(hours=1)
+            program.check()
+            program.ingest_accounting(conn)
+            assert len(windows) == 8
+            assert windows[-1] == (datetime.datetime(2022, 7, 9), datetime.datetime(2022, 7, 9, 2, 29))
+        assert [(s.pattern, s.count) for s in program.get_runtime_stats('^train')] == [('train-#', 3)]
+        status, = program.get_status().queues
+        assert status.mean_runtime == (3 * 3600 + 5400) / 4
+        # Only jobs that finished within the window count.
+        status, = program.get_status(hours=1).queues
+        assert status.mean_runtime == 5400
+
+def test_ingest_accounting_job_started_after_snapshot():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        backend.current_time = datetime.datetime(2022, 7, 9, 2)
+        program.check()
+        # A job starts after the snapshot and is still running when the
+        # accounting records are read, so it is not among them yet.
+        job = backend.add_job('gpu@@a', 'late')
+        job.since = datetime.datetime(2022, 7, 9, 2, 10)
+        backend.current_time = datetime.datetime(2022, 7, 9, 2, 20)
+        with program.get_db_connection() as conn:
+            program.ingest_accounting(conn)
+            assert program.get_runtime_stats() == []
+            backend.current_time = datetime.datetime(2022, 7, 9, 3, 10)
+            backend.finish_job('late')
+            backend.current_time = datetime.datetime(2022, 7, 9, 4)
+            program.check()
+            program.ingest_accounting(conn)
+        assert [(s.pattern, s.count, s.mean_runtime) for s in program.get_runtime_stats()] == [('late', 1, 3600.0)]
+
+def test_ingest_accounting_failure():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.check()
+        calls = []
+        def failing_get_finished_jobs(start, end):
+            calls.append((start, end))
+            raise BackendError('error: unable to open accounting file')
+        backend.get_finished_jobs = failing_get_finished_jobs
+        stderr = io.StringIO()
+        with program.get_db_connection() as conn:
+            program.ingest_accounting(conn, stderr)
+            assert len(calls) == 1
+            assert 'unable to open accounting file' in stderr.getvalue()
+            # The failed read still counts toward the interval.
+            backend.current_time += datetime.timedelta(minutes=30)
+            program.check()
+            program.ingest_accounting(conn, stderr)
+            assert len(calls) == 1
+            backend.current_time += datetime.timedelta(hours=1)
+            program.check()
+            program.ingest_accounting(conn, stderr)
+            assert len(calls) == 2
+
+def test_ingest_accounting_long_running_job():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.submit(['gpu@@a'], 'long', ['script.bash'])
+        backend.current_time += datetime.timedelta(days=3)
+        program.check()
+        windows = []
+        get_finished_jobs = backend.get_finished_jobs
+        def counting_get_finished_jobs(start, end):
+            windows.append((start, end))
+            return get_finished_jobs(start, end)
+        backend.get_finished_jobs = counting_get_finished_jobs
+        with program.get_db_connection() as conn:
+            program.ingest_accounting(conn)
+        # A job that has been running for days holds the high-water mark
+        # back by at most a day.
+        assert windows[-1][1] == backend.current_time - datetime.timedelta(days=1, minutes=1)
+
+def test_parse_qacct_output():
+    output = """\
+==============================================================
+qname        gpu
+hostname     qa-xp-001.crc.nd.edu
+owner        myuser
+jobname      train-1
+jobnumber    123
+taskid       undefined
+qsub_time    Fri Jul  8 23:00:00 2022
+start_time   Sat Jul  9 00:00:05 2022
+end_time     Sat Jul  9 01:00:05 2022
+failed       0
+exit_status  0
+maxvmem      1.500G
+==============================================================
+qname        gpu
+jobname      sweep
+jobnumber    124
+taskid       3
+start_time   -/-
+end_time     2022-07-09 00:10:00.000000
+failed       100 : assumedly after job
+exit_status  137
+maxvmem      512.000K
+"""
+    assert [dict_to_finished_job(d) for d in parse_qacct_output(output)] == [
+        FinishedJob(
+            id='123',
+            name='train-1',
+            queue='gpu',
+            start_time=datetime.datetime(2022, 7, 9, 0, 0, 5),
+            end_time=datetime.datetime(2022, 7, 9, 1, 0, 5),
+            exit_status=0,
+            failed=False,
+            max_memory=1.5 * 1024 ** 3
+        ),
+        FinishedJob(
+            id='124',
+            name='sweep',
+            queue='gpu',
+            start_time=None,
+            end_time=datetime.datetime(2022, 7, 9, 0, 10),
+            exit_status=137,
+            failed=True,
+            max_memory=512 * 1024,
+            task_id='3'
+        )
+    ]
+
+def test_submission_keys():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 1)
+        def submit_all():
+            return [
+                program.submit(['gpu@@a'], f'job-{i}', ['script.bash', str(i)], dedupe=True)
+                for i in range(3)
+            ]
+        assert submit_all() == [True, True, True]
+        # Running the same script again submits nothing, whether the jobs are
+        # running or buffered.
+        assert submit_all() == [False, False, False]
+        assert backend.running_jobs() == { 'gpu@@a' : {'job-0'} }
+        assert [job.name for job in program.list_own_jobs().jobs] == ['job-0', 'job-1', 'job-2']
+        # Keys follow jobs when they are reordered, and are forgotten when
+        # they are deleted.
+        program.bump(JobFilter(name='job-2'))
+        program.delete_matching(JobFilter(name='job-1'))
+        assert submit_all() == [False, True, False]
+        backend.finish_job('job-0')
+        program.check()
+        assert backend.running_jobs() == { 'gpu@@a' : {'job-2'} }
+        assert submit_all() == [False, False, False]
+        # Explicit keys do not depend on the command.
+        assert program.submit(['gpu@@a'], 'other', ['other.bash'], key='job-key')
+        assert not program.submit(['gpu@@a'], 'other-2', ['other.bash', '2'], key='job-key')
+        # Keys of submitted jobs expire.
+        backend.current_time += datetime.timedelta(days=31)
+        backend.finish_job('job-2')
+        program.check()
+        assert submit_all() == [True, False, True]
+        # Canceling jobs forgets their keys too.
+        program.delete_matching(JobFilter())
+        program.check()
+        assert submit_all() == [True, True, True]
+        program.delete_matching(JobFilter())
+        program.check()
+        # A sweep keeps its key until all of its points are gone.
+        assert program.sweep(['gpu@@a'], 's-{i}', ['s.bash'], [('i', ['1', '2'])], key='sweep') is not None
+        assert program.sweep(['gpu@@a'], 's-{i}', ['s.bash'], [('i', ['1', '2'])], key='sweep') is None
+        backend.finish_job('s-1')
+        program.check()
+        assert backend.running_jobs() == { 'gpu@@a' : {'s-2'} }
+        assert program.sweep(['gpu@@a'], 's-{i}', ['s.bash'], [('i', ['1', '2'])], key='sweep') is None
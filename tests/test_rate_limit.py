@@ -0,0 +1,131 @@
+import sqlite3
+import subprocess
+import tempfile
+
+from qfunnel.config import load_config
+from qfunnel.program import Program
+from qfunnel.rate_limit import QUERY, SUBMIT, Bucket, TokenBucketRateLimiter, get_buckets
+from qfunnel.real_backend import RealBackend
+
+from mock_backend import get_mock_backend
+
+class FakeClock:
+
+    def __init__(self):
+        super().__init__()
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+def test_token_bucket():
+    with tempfile.NamedTemporaryFile() as db_file:
+        clock = FakeClock()
+        buckets = { QUERY : Bucket(rate=0.5, capacity=2) }
+        limiter = TokenBucketRateLimiter(db_file.name, buckets, clock.time, clock.sleep)
+        limiter.acquire(QUERY)
+        limiter.acquire(QUERY)
+        assert clock.sleeps == []
+        limiter.acquire(QUERY)
+        assert clock.sleeps == [2.0]
+        # Commands without a budget are not limited.
+        limiter.acquire(SUBMIT)
+        assert clock.sleeps == [2.0]
+        clock.now += 100
+        limiter.acquire(QUERY)
+        limiter.acquire(QUERY)
+        assert clock.sleeps == [2.0]
+
+def test_token_bucket_shared_between_processes():
+    with tempfile.NamedTemporaryFile() as db_file:
+        clock = FakeClock()
+        buckets = { SUBMIT : Bucket(rate=1.0, capacity=1) }
+        limiters = [
+            TokenBucketRateLimiter(db_file.name, buckets, clock.time, lambda seconds: clock.sleeps.append(seconds))
+            for i in range(3)
+        ]
+        # Callers that arrive at the same time are spaced out.
+        for limiter in limiters:
+            limiter.acquire(SUBMIT)
+        assert clock.sleeps == [1.0, 2.0]
+
+def test_rate_limit_config():
+    with tempfile.NamedTemporaryFile('w', suffix='.ini') as config_file:
+        config_file.write('[rate_limit]\nquery_per_minute = 30\nsubmit_per_minute = 6\nsubmit_burst = 3\n')
+        config_file.flush()
+        config = load_config(config_file.name)
+    assert get_buckets(config.rate_limit) == {
+        QUERY : Bucket(rate=0.5, capacity=1),
+        SUBMIT : Bucket(rate=0.1, capacity=3)
+    }
+    assert get_buckets(load_config('/nonexistent/qfunnel.ini').rate_limit) == {}
+
+def test_reserved_submission(monkeypatch):
+    monkeypatch.setattr('qfunnel.real_backend.run_sge_command',
+        lambda args, **kwargs: subprocess.CompletedProcess(args, 0, 'Your job 1 ("job") has been submitted\n', ''))
+    with tempfile.NamedTemporaryFile() as db_file:
+        clock = FakeClock()
+        buckets = { SUBMIT : Bucket(rate=1.0, capacity=1) }
+        backend = RealBackend(TokenBucketRateLimiter(db_file.name, buckets, clock.time, clock.sleep))
+        # Reserving twice takes only one token.
+        backend.reserve_submission()
+        backend.reserve_submission()
+        assert clock.sleeps == []
+        assert backend.submit_job('q', 'job', ['job.bash'], '/tmp') == '1'
+        assert clock.sleeps == []
+        # The wait happens when reserving, not when submitting.
+        backend.reserve_submission()
+        assert clock.sleeps == [1.0]
+        backend.submit_job('q', 'job', ['job.bash'], '/tmp')
+        assert clock.sleeps == [1.0]
+
+def test_submissions_reserved_outside_write_lock():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 2)
+        for i in range(3):
+            program.submit(['gpu@@a'], f'job-{i}', ['script.bash'], deferred=True)
+        was_locked = []
+        backend.reserve_submission = lambda: was_locked.append(is_db_locked(backend))
+        program.check()
+        assert backend.running_jobs() == {'gpu@@a' : {'job-0', 'job-1'}}
+        # No submission is reserved once nothing more can be submitted.
+        assert was_locked == [False, False]
+        program.check()
+        assert was_locked == [False, False]
+
+def test_queries_outside_write_lock():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 2)
+        # A job submitted without qfunnel shows up already running, so the
+        # next check queries each limited queue to find it.
+        backend.add_job('gpu@@a', 'outside-job')
+        was_locked = []
+        def wrap_query(query):
+            def wrapped_query(*args):
+                was_locked.append(is_db_locked(backend))
+                return query(*args)
+            return wrapped_query
+        backend.get_own_jobs = wrap_query(backend.get_own_jobs)
+        backend.get_own_running_jobs_in_queue = wrap_query(backend.get_own_running_jobs_in_queue)
+        program.check()
+        assert was_locked == [False, False]
+        with program.get_db_connection() as conn:
+            assert conn.execute('select "queue" from "snapshot_jobs"').fetchall() == [('gpu@@a',)]
+
+def is_db_locked(backend):
+    conn = sqlite3.connect(backend.db_file_name, timeout=0)
+    try:
+        conn.execute('begin immediate')
+        conn.rollback()
+        return False
+    except sqlite3.OperationalError:
+        return True
+    finally:
+        conn.close()
@@ -0,0 +1,74 @@
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+
+from qfunnel.program import Program
+from qfunnel.replay_backend import RecordingBackend, ReplayBackend
+
+QSTAT_OUTPUT = '''\
+<?xml version='1.0'?>
+<job_info>
+  <queue_info>
+    <job_list state="running">
+      <JB_job_number>100</JB_job_number>
+      <JB_owner>alice</JB_owner>
+      <full_job_name>old-job</full_job_name>
+      <slots>1</slots>
+      <state>r</state>
+      <queue_name>long@node1</queue_name>
+      <JAT_start_time>2022-07-08T12:00:00</JAT_start_time>
+    </job_list>
+  </queue_info>
+  <job_info>
+  </job_info>
+</job_info>
+'''
+
+class TempRecordingBackend(RecordingBackend):
+
+    def __init__(self, trace_file, db_file):
+        super().__init__(trace_file)
+        self.db_file = db_file
+
+    def connect_to_db(self):
+        return sqlite3.connect(self.db_file)
+
+def write_script(path, content):
+    path.write_text(content)
+    path.chmod(0o755)
+
+def run_session(program):
+    program.set_limit('long', 2)
+    program.submit(['long'], 'a', ['job.bash'])
+    program.submit(['long'], 'b', ['job.bash'])
+    return [(job.name, job.queue) for job in program.list_own_jobs().jobs]
+
+def test_record_and_replay(monkeypatch):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = pathlib.Path(temp_dir)
+        bin_dir = temp_dir / 'bin'
+        bin_dir.mkdir()
+        (temp_dir / 'qstat.xml').write_text(QSTAT_OUTPUT)
+        write_script(bin_dir / 'qstat', f'#!/bin/sh\ncat {temp_dir}/qstat.xml\n')
+        write_script(bin_dir / 'qsub', '#!/bin/sh\necho "Your job 101 (\\"$4\\") has been submitted"\n')
+        monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+        monkeypatch.setenv('USER', 'alice')
+        trace_file = temp_dir / 'trace.jsonl'
+        recorded = run_session(Program(TempRecordingBackend(trace_file, temp_dir / 'record.db')))
+        records = [json.loads(line) for line in trace_file.read_text().splitlines()]
+        commands = [r for r in records if r['type'] == 'command']
+        assert any(r['args'][0] == 'qsub' for r in commands)
+        assert all(r['duration'] >= 0 for r in records)
+        assert any(r['args'][0] == 'qstat' and r['stdout'] == QSTAT_OUTPUT for r in commands)
+        assert any(r['type'] == 'call' and r['method'] == 'get_own_user' and r['result'] == 'alice' for r in records)
+        # Replaying must not depend on the scheduler or the environment.
+        monkeypatch.setenv('PATH', '')
+        monkeypatch.setenv('USER', 'bob')
+        sleeps = []
+        backend = ReplayBackend(trace_file, temp_dir / 'replay.db', speedup=10.0, sleep=sleeps.append)
+        replayed = run_session(Program(backend))
+        assert replayed == recorded == [('old-job', 'long@node1')]
+        assert backend.commands_run == [r['args'] for r in commands]
+        assert sleeps == [r['duration'] / 10.0 for r in commands]
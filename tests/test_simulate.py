@@ -0,0 +1,118 @@
+import datetime
+import time
+
+from qfunnel.program import Program
+from qfunnel.simulate import (
+    Scenario,
+    SimulatedEntry,
+    SimulatedQueue,
+    SimulationConfig,
+    get_percentile,
+    simulate
+)
+
+from mock_backend import get_mock_backend
+
+def get_scenario(entries, queues, runtimes, **kwargs):
+    return Scenario(
+        start_time=datetime.datetime(2022, 7, 9),
+        entries=entries,
+        queues=queues,
+        schedules=[],
+        running=[],
+        pending=[],
+        runtimes=runtimes,
+        **kwargs
+    )
+
+def test_simulate():
+    scenario = get_scenario(
+        [SimulatedEntry(['gpu@@a'], count=10)],
+        {'gpu@@a' : SimulatedQueue(2)},
+        {'gpu@@a' : [100.0]}
+    )
+    result = simulate(scenario, SimulationConfig({}, 60.0))
+    # Two jobs start at each check once the previous two have finished at
+    # 100 seconds, so the last pair starts at 480.
+    assert result.makespan == 580.0
+    assert result.unfinished == 0
+    assert result.wait_percentiles == {50 : 240.0, 90 : 480.0, 99 : 480.0}
+    assert 0.8 < result.utilization < 0.9
+    # A higher limit and more frequent checks drain the buffer sooner.
+    result = simulate(scenario, SimulationConfig({'gpu@@a' : 5}, 10.0))
+    assert result.makespan == 200.0
+    # The backend only starts jobs when there is room for them.
+    scenario.queues['gpu@@a'].capacity = 3
+    scenario.queues['gpu@@a'].others = 2
+    result = simulate(scenario, SimulationConfig({'gpu@@a' : 5}, 10.0))
+    assert result.makespan == 1000.0
+    # Jobs that can never run are reported.
+    result = simulate(scenario, SimulationConfig({'gpu@@a' : 0}, 10.0))
+    assert (result.makespan, result.unfinished) == (None, 10)
+
+def test_simulate_is_fast():
+    scenario = get_scenario(
+        [SimulatedEntry(['gpu@@a', 'gpu@@b'], count=1000), SimulatedEntry(['gpu@@b'], count=1000)],
+        {'gpu@@a' : SimulatedQueue(20), 'gpu@@b' : SimulatedQueue(10)},
+        {None : [float(i) for i in range(60, 7200, 60)]}
+    )
+    start = time.perf_counter()
+    results = [
+        simulate(scenario, SimulationConfig({'gpu@@a' : limit}, interval))
+        for limit in (10, 20, 40)
+        for interval in (60.0, 600.0)
+    ]
+    assert time.perf_counter() - start < 5.0
+    assert all(result.unfinished == 0 for result in results)
+    # Run times do not depend on the configuration, so more slots help.
+    assert results[4].makespan < results[0].makespan
+
+def test_get_percentile():
+    assert get_percentile([], 50) is None
+    assert get_percentile([1, 2, 3, 4], 50) == 2
+    assert get_percentile([1, 2, 3, 4], 100) == 4
+    assert get_percentile([1, 2, 3, 4], 0) == 1
+
+def test_simulation_scenario():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        program.set_limit('gpu@@a', 1, pending=2)
+        program.submit(['gpu@@a'], 'job-0', ['script.bash'])
+        program.check()
+        backend.current_time += datetime.timedelta(minutes=30)
+        backend.finish_job('job-0')
+        backend.set_capacity('gpu@@a', 1)
+        program.submit(['gpu@@b', 'gpu@@a'], 'job-1', ['script.bash'], deferred=True)
+        program.sweep(['gpu@@a'], 'job-{i}', ['script.bash', '{i}'], [('i', ['2', '3', '4', '5'])], deferred=True)
+        program.check()
+        backend.current_time += datetime.timedelta(minutes=10)
+        program.check()
+        scenario = program.get_simulation_scenario()
+        assert scenario.runtimes == {'gpu@@a' : [1800.0], None : [1800.0]}
+        # The sweep has one point left, while two wait in the backend.
+        assert scenario.entries == [SimulatedEntry(['gpu@@a'], 1)]
+        assert scenario.queues == {'gpu@@a' : SimulatedQueue(1, 2)}
+        assert scenario.running == [('gpu@@b', 1, 2400.0), ('gpu@@a', 1, 2400.0)]
+        assert scenario.pending == [('gpu@@a', 1), ('gpu@@a', 1)]
+        result = simulate(scenario, SimulationConfig({}, 600.0))
+        assert result.unfinished == 0
+
+def test_simulate_unlimited_backend_queue():
+    with get_mock_backend() as backend:
+        program = Program(backend)
+        backend.set_capacity('gpu@@b', 1)
+        program.submit(['gpu@@b'], 'job-0', ['script.bash'])
+        program.submit(['gpu@@b'], 'job-1', ['script.bash'])
+        program.check()
+        scenario = program.get_simulation_scenario()
+        assert scenario.queues == {}
+        assert scenario.running == [('gpu@@b', 1, 0.0)]
+        assert scenario.pending == [('gpu@@b', 1)]
+        # The queue's capacity is not known, so the pending job starts too.
+        result = simulate(scenario, SimulationConfig({}, 600.0))
+        assert (result.makespan, result.unfinished) == (3600.0, 0)
+    # Jobs pending in a queue with nothing else going on start right away.
+    scenario = get_scenario([], {}, {'gpu@@c' : [100.0]})
+    scenario.pending.append(('gpu@@c', 1))
+    result = simulate(scenario, SimulationConfig({}, 600.0))
+    assert (result.makespan, result.unfinished) == (100.0, 0)
@@ -0,0 +1,247 @@
+import datetime
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+
+import pytest
+
+from qfunnel.config import load_config
+from qfunnel.program import BackendError, FinishedJob, Program
+from qfunnel.slurm_backend import SlurmBackend, parse_sacct_output, parse_squeue_json, parse_squeue_text
+
+SQUEUE_JSON = {
+    'jobs' : [
+        {
+            'job_id' : 11,
+            'user_name' : 'alice',
+            'name' : 'train',
+            'cpus' : {'set' : True, 'infinite' : False, 'number' : 4},
+            'job_state' : ['RUNNING'],
+            'state_reason' : 'None',
+            'partition' : 'gpu',
+            'submit_time' : {'set' : True, 'infinite' : False, 'number' : 1657281600},
+            'start_time' : {'set' : True, 'infinite' : False, 'number' : 1657285200}
+        },
+        {
+            'job_id' : 12,
+            'user_name' : 'bob',
+            'name' : 'eval',
+            'cpus' : 1,
+            'job_state' : 'RUNNING',
+            'state_reason' : 'None',
+            'partition' : 'gpu',
+            'submit_time' : 1657281600,
+            'start_time' : 1657285200
+        },
+        {
+            'job_id' : 13,
+            'array_job_id' : 13,
+            'array_task_id' : 2,
+            'user_name' : 'alice',
+            'name' : 'sweep',
+            'cpus' : 1,
+            'job_state' : 'PENDING',
+            'state_reason' : 'Priority',
+            'partition' : 'cpu',
+            'submit_time' : 1657281600,
+            'start_time' : 0
+        },
+        {
+            'job_id' : 14,
+            'user_name' : 'alice',
+            'name' : 'held',
+            'cpus' : 1,
+            'job_state' : 'PENDING',
+            'state_reason' : 'JobHeldUser',
+            'partition' : 'gpu',
+            'submit_time' : 1657281600,
+            'start_time' : 0
+        }
+    ]
+}
+
+SQUEUE_TEXT = '''\
+11|alice|4|RUNNING|gpu|2022-07-08T12:00:00|2022-07-08T13:00:00|None|train|a
+12|bob|1|RUNNING|gpu|2022-07-08T12:00:00|2022-07-08T13:00:00|None|eval
+13_2|alice|1|PENDING|cpu|2022-07-08T12:00:00|N/A|Priority|sweep
+'''
+
+def write_script(path, content):
+    path.write_text(content)
+    path.chmod(0o755)
+
+def install_fake_slurm(monkeypatch, temp_dir, json_supported=True, sbatch_fails=False):
+    bin_dir = temp_dir / 'bin'
+    bin_dir.mkdir()
+    log_file = temp_dir / 'log'
+    (temp_dir / 'squeue.json').write_text(json.dumps(SQUEUE_JSON))
+    (temp_dir / 'squeue.txt').write_text(SQUEUE_TEXT)
+    if json_supported:
+        json_branch = f'cat {temp_dir}/squeue.json'
+    else:
+        json_branch = 'echo "squeue: unrecognized option \'--json\'" >&2; exit 1'
+    write_script(bin_dir / 'squeue', f'''\
+#!/bin/sh
+echo "squeue $*" >> {log_file}
+case "$*" in
+  *--json*) {json_branch} ;;
+  *) cat {temp_dir}/squeue.txt ;;
+esac
+''')
+    if sbatch_fails:
+        sbatch_output = 'echo "sbatch: error: invalid partition specified" >&2; exit 1'
+    else:
+        sbatch_output = 'echo "15;cluster"'
+    write_script(bin_dir / 'sbatch', f'''\
+#!/bin/sh
+echo "sbatch $*" >> {log_file}
+{sbatch_output}
+''')
+    write_script(bin_dir / 'scancel', f'''\
+#!/bin/sh
+echo "scancel $*" >> {log_file}
+''')
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('USER', 'alice')
+    return log_file
+
+def read_log(log_file):
+    return log_file.read_text().splitlines()
+
+def test_slurm_single_squeue_per_cycle(monkeypatch):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = pathlib.Path(temp_dir)
+        log_file = install_fake_slurm(monkeypatch, temp_dir)
+        backend = SlurmBackend(max_age=60)
+        own_jobs = backend.get_own_jobs()
+        assert [(j.id, j.state, j.queue, j.slots) for j in own_jobs] == [
+            ('11', 'r', 'gpu', 4),
+            ('13_2', 'qw', 'cpu', 1),
+            ('14', 'hqw', 'gpu', 1)
+        ]
+        assert own_jobs[0].since.timestamp() == 1657285200
+        assert own_jobs[1].since.timestamp() == 1657281600
+        assert [j.id for j in backend.get_own_pending_jobs()] == ['13_2', '14']
+        assert [j.id for j in backend.get_own_running_jobs_in_queue('gpu')] == ['11']
+        assert [j.id for j in backend.get_running_jobs_in_queue('gpu')] == ['11', '12']
+        assert backend.get_running_jobs_in_queue('cpu') == []
+        assert backend.get_other_users_occupancy(['gpu', 'cpu']) == {'gpu' : (1, 0), 'cpu' : (0, 0)}
+        assert read_log(log_file) == ['squeue --all --json']
+        job_id = backend.submit_job('cpu', 'new', ['--mem=1G', 'job.bash', 'x'], str(temp_dir))
+        assert job_id == '15'
+        # Submitting a job invalidates the listing.
+        backend.get_own_jobs()
+        backend.delete_jobs(['11', '12'])
+        assert read_log(log_file) == [
+            'squeue --all --json',
+            'sbatch --parsable --partition=cpu --job-name=new --mem=1G job.bash x',
+            'squeue --all --json',
+            'scancel 11 12'
+        ]
+
+class TempSlurmBackend(SlurmBackend):
+
+    def __init__(self, temp_dir):
+        super().__init__(max_age=0, clock=lambda: 0)
+        self.temp_dir = temp_dir
+
+    def get_cwd(self):
+        return str(self.temp_dir)
+
+    def connect_to_db(self):
+        return sqlite3.connect(self.temp_dir / 'qfunnel.db')
+
+def test_slurm_submit_failure(monkeypatch):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = pathlib.Path(temp_dir)
+        log_file = install_fake_slurm(monkeypatch, temp_dir, sbatch_fails=True)
+        (temp_dir / 'squeue.json').write_text(json.dumps({'jobs' : []}))
+        program = Program(TempSlurmBackend(temp_dir))
+        assert program.submit(['gpu'], 'new', ['job.bash'], deferred=True, dedupe=True)
+        with pytest.raises(BackendError, match='invalid partition'):
+            program.check()
+        assert 'sbatch --parsable --partition=gpu --job-name=new job.bash' in read_log(log_file)
+        # The job is still buffered, and nothing was recorded as submitted.
+        assert [job.name for job in program.list_own_jobs().jobs] == ['new']
+        assert program.get_job_events() == []
+
+def test_slurm_format_fallback(monkeypatch):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = pathlib.Path(temp_dir)
+        log_file = install_fake_slurm(monkeypatch, temp_dir, json_supported=False)
+        backend = SlurmBackend(max_age=0, clock=lambda: 0)
+        jobs = backend.get_own_jobs()
+        assert [(j.id, j.name, j.state, j.queue) for j in jobs] == [
+            ('11', 'train|a', 'r', 'gpu'),
+            ('13_2', 'sweep', 'qw', 'cpu')
+        ]
+        assert [j.id for j in backend.get_running_jobs_in_queue('gpu')] == ['11', '12']
+        # After --json fails once, it is not tried again.
+        assert read_log(log_file)[0] == 'squeue --all --json'
+        assert all('--json' not in line for line in read_log(log_file)[1:])
+
+def test_slurm_split_command():
+    backend = SlurmBackend()
+    assert backend.split_command(['-p', 'gpu', '--mem=4G', '--exclusive', '-c4', 'job.bash', 'a', 'b']) == \
+        (['-p', 'gpu', '--mem=4G', '--exclusive', '-c4', 'job.bash'], ['a', 'b'])
+    assert backend.split_command(['--time', '1:00', 'job.bash']) == (['--time', '1:00', 'job.bash'], [])
+
+def test_slurm_states():
+    def make_job(job_id, state, reason='None', submit_time=1657281600):
+        return {
+            'job_id' : job_id,
+            'user_name' : 'alice',
+            'name' : 'job',
+            'cpus' : 1,
+            'job_state' : [state],
+            'state_reason' : reason,
+            'partition' : 'gpu',
+            'submit_time' : submit_time,
+            'start_time' : 0
+        }
+    jobs = parse_squeue_json(json.dumps({
+        'jobs' : [
+            make_job(1, 'COMPLETED'),
+            make_job(2, 'FAILED'),
+            make_job(3, 'CANCELLED'),
+            make_job(4, 'TIMEOUT'),
+            make_job(5, 'PENDING', 'DependencyNeverSatisfied'),
+            make_job(6, 'REQUEUE_HOLD', 'launch failed requeued held'),
+            make_job(7, 'PENDING', 'Priority', {'set' : False, 'infinite' : False, 'number' : 0})
+        ]
+    }))
+    # Finished jobs are left out, and jobs that will never run are errors.
+    assert [(j.id, j.state, j.since) for j in jobs] == [
+        ('5', 'Eqw', datetime.datetime.fromtimestamp(1657281600)),
+        ('6', 'Eqw', datetime.datetime.fromtimestamp(1657281600)),
+        ('7', 'qw', None)
+    ]
+    jobs = parse_squeue_text("""\
+1|alice|1|COMPLETED|gpu|2022-07-08T12:00:00|2022-07-08T13:00:00|None|done
+2|alice|1|NODE_FAIL|gpu|2022-07-08T12:00:00|2022-07-08T13:00:00|None|lost
+3|alice|1|PENDING|gpu|N/A|N/A|BadConstraints|bad
+""")
+    assert [(j.id, j.state, j.since) for j in jobs] == [('3', 'Eqw', None)]
+
+def test_backend_config():
+    with tempfile.NamedTemporaryFile('w', suffix='.ini') as fout:
+        assert load_config(fout.name).backend.type == 'sge'
+        fout.write('[backend]\ntype = slurm\n')
+        fout.flush()
+        assert load_config(fout.name).backend.type == 'slurm'
+
+def test_parse_sacct_output():
+    output = """\
+21|gpu|2022-07-09T00:00:00|2022-07-09T01:00:00|0:0||COMPLETED|train|a
+21.batch||2022-07-09T00:00:00|2022-07-09T01:00:00|0:0|2048K|COMPLETED|batch
+22|gpu|2022-07-09T00:00:00|2022-07-09T00:30:00|0:9||CANCELLED by 1000|eval
+23|gpu|2022-07-09T00:00:00|Unknown|0:0||RUNNING|still-running
+"""
+    assert parse_sacct_output(output) == [
+        FinishedJob('21', 'train|a', 'gpu', datetime.datetime(2022, 7, 9), datetime.datetime(2022, 7, 9, 1),
+            0, False, 2048 * 1024),
+        FinishedJob('22', 'eval', 'gpu', datetime.datetime(2022, 7, 9), datetime.datetime(2022, 7, 9, 0, 30),
+            0, True)
+    ]
@@ -0,0 +1,40 @@
+import pathlib
+import sqlite3
+import tempfile
+import time
+
+from qfunnel.program import Program
+from qfunnel.store import LocalSnapshotStore
+
+from mock_backend import get_mock_backend
+
+def count_snapshot_jobs(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('select count(*) from "jobs"').fetchone()[0]
+    finally:
+        conn.close()
+
+def test_local_snapshot_store():
+    with get_mock_backend() as backend, tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = pathlib.Path(temp_dir)
+        local_path = temp_dir / 'local' / 'qfunnel.db'
+        snapshot_path = temp_dir / 'home' / 'qfunnel.db'
+        offset = [0.0]
+        store = LocalSnapshotStore(local_path, snapshot_path, interval=60,
+            clock=lambda: time.time() + offset[0])
+        program = Program(backend, store)
+        program.set_limit('gpu@@a', 0)
+        # The first use of the database exports it right away.
+        assert snapshot_path.exists()
+        program.submit(['gpu@@a'], 'job-0', ['script.bash'])
+        program.submit(['gpu@@a'], 'job-1', ['script.bash'])
+        assert count_snapshot_jobs(snapshot_path) == 0
+        offset[0] += 61
+        assert len(program.list_own_jobs().jobs) == 2
+        assert count_snapshot_jobs(snapshot_path) == 2
+        assert list(snapshot_path.parent.iterdir()) == [snapshot_path]
+        # If the local database is lost, it is restored from the export.
+        local_path.unlink()
+        assert [job.name for job in program.list_own_jobs().jobs] == ['job-0', 'job-1']
+        assert program.get_limit('gpu@@a') == 0